@@ -15,15 +15,31 @@ from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
+def preload_images(decode, image_list, num_threads=8):
+    """decode every image once (thread pool) into one uint8 tensor [N, C, H, W]"""
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(num_threads) as pool:
+        return torch.stack(list(pool.map(decode, image_list)))
+
+
 class ImageFolder(data.Dataset):
-    def __init__(self, args, file_path, data_type):
+    """
+    Images are cropped / resized once in PIL and converted to a uint8 tensor (decoder); only the random
+    augmentation of the train split runs on the float tensor per sample (augmentation). With
+    args["dataset"]["preload"] (or preload=True) all decoded images are kept in RAM as one uint8 tensor.
+    """
+    def __init__(self, args, file_path, data_type, preload=None):
         self.args = args
         self.model_name = args["dataset"]["model_name"]
         self.data_type = data_type
+        self.decoder, self.augmentation = self.get_decoder(), self.get_augmentation()
         self.processor = self.get_processor()
         self.image_list, self.label_list = self.get_list(file_path)
         self.num_img = len(self.image_list)
         self.n_classes = args["dataset"]["n_classes"]
+        if preload is None:
+            preload = args["dataset"].get("preload", False)
+        self.images = preload_images(self.decode, self.image_list) if preload else None
         print("Load " + str(self.num_img) + " images")
 
     def get_list(self, file_path):
@@ -47,11 +63,13 @@ class ImageFolder(data.Dataset):
             img = img.convert('L')
         return img
 
-    def get_processor(self):
+    def get_decoder(self):
+        # PIL image -> cropped / resized uint8 tensor [C, H, W]
+        if self.args['dataset']['name'] == "cifar":
+            return transforms.PILToTensor()
+
         if self.args['dataset']['name'] == "FaceNet":
             re_size = 112
-        elif self.args['dataset']['name'] == "cifar":
-            re_size = 32
         else:
             re_size = 64
 
@@ -60,55 +78,42 @@ class ImageFolder(data.Dataset):
 
             offset_height = (218 - crop_size) // 2
             offset_width = (178 - crop_size) // 2
-            crop = lambda x: x[:, offset_height:offset_height + crop_size, offset_width:offset_width + crop_size]
 
         elif self.args['dataset']['name'] == 'facescrub':
             crop_size = 64
             offset_height = (64 - crop_size) // 2
             offset_width = (64 - crop_size) // 2
-            crop = lambda x: x[:, offset_height:offset_height + crop_size, offset_width:offset_width + crop_size]
-
-        elif self.args['dataset']['name'] == "cifar":
-            proc = []
-            if self.data_type == "train":
-                proc.append(transforms.ToTensor())
-                proc.append(transforms.RandomCrop(32, padding=4)),
-                proc.append(transforms.ToPILImage())
-                proc.append(transforms.RandomHorizontalFlip(p=0.5))
-                proc.append(transforms.ToTensor())
 
-            else:
-                proc.append(transforms.ToTensor())
-                proc.append(transforms.ToPILImage())
-                proc.append(transforms.ToTensor())
-
-            return transforms.Compose(proc)
+        # crop + Resize on the PIL image, same pixels as ToTensor -> tensor crop -> ToPILImage -> Resize
+        crop = lambda img: img.crop((offset_width, offset_height, offset_width + crop_size, offset_height + crop_size))
+        return transforms.Compose([transforms.Lambda(crop),
+                                   transforms.Resize((re_size, re_size)),
+                                   transforms.PILToTensor()])
 
+    def get_augmentation(self):
+        # float tensor -> float tensor, random ops of the train split
         proc = []
         if self.data_type == "train":
-            proc.append(transforms.ToTensor())
-            proc.append(transforms.Lambda(crop))
-            proc.append(transforms.ToPILImage())
-            proc.append(transforms.Resize((re_size, re_size)))
+            if self.args['dataset']['name'] == "cifar":
+                proc.append(transforms.RandomCrop(32, padding=4))
             proc.append(transforms.RandomHorizontalFlip(p=0.5))
-
             # proc.append(transforms.Pad(5))
             # proc.append(transforms.RandomCrop((re_size, re_size)))
-            proc.append(transforms.ToTensor())
-            # proc.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
-        else:
-            proc.append(transforms.ToTensor())
-            proc.append(transforms.Lambda(crop))
-            proc.append(transforms.ToPILImage())
-            proc.append(transforms.Resize((re_size, re_size)))
-            proc.append(transforms.ToTensor())
-            # proc.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
-
+        # proc.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
         return transforms.Compose(proc)
 
+    def get_processor(self):
+        # full per-sample pipeline: PIL image -> float tensor in [0, 1]
+        return transforms.Compose([self.decoder, transforms.ConvertImageDtype(torch.float), self.augmentation])
+
+    def decode(self, path):
+        return self.decoder(self.load_img(path))
+
     def __getitem__(self, index):
-        processer = self.get_processor()
-        img = processer(self.load_img(self.image_list[index]))
+        if self.images is not None:
+            img = self.augmentation(self.images[index].float().div_(255))
+        else:
+            img = self.processor(self.load_img(self.image_list[index]))
         label = self.label_list[index]
 
         return img, label
@@ -118,14 +123,18 @@ class ImageFolder(data.Dataset):
 
 
 class GrayFolder(data.Dataset):
-    def __init__(self, args, file_path, mode):
+    def __init__(self, args, file_path, mode, preload=None):
         self.args = args
         self.model_name = args["dataset"]["model_name"]
         self.mode = mode
+        self.decoder = self.get_decoder()
         self.processor = self.get_processor()
         self.image_list, self.label_list = self.get_list(file_path)
         self.num_img = len(self.image_list)
         self.n_classes = args["dataset"]["n_classes"]
+        if preload is None:
+            preload = args["dataset"].get("preload", False)
+        self.images = preload_images(self.decode, self.image_list) if preload else None
         print("Load " + str(self.num_img) + " images")
 
     def get_list(self, file_path):
@@ -148,7 +157,7 @@ class GrayFolder(data.Dataset):
         img = img.convert('L')
         return img
 
-    def get_processor(self):
+    def get_decoder(self):
         proc = []
         if self.args['dataset']['name'] == "mnist":
             if self.args['dataset']['model_name'] == "SCNN" or self.args['dataset']['model_name'] == "MCNN":
@@ -158,13 +167,21 @@ class GrayFolder(data.Dataset):
         else:
             re_size = 128
         proc.append(transforms.Resize((re_size, re_size)))
-        proc.append(transforms.ToTensor())
+        proc.append(transforms.PILToTensor())
 
         return transforms.Compose(proc)
 
+    def get_processor(self):
+        return transforms.Compose([self.decoder, transforms.ConvertImageDtype(torch.float)])
+
+    def decode(self, path):
+        return self.decoder(self.load_img(path))
+
     def __getitem__(self, index):
-        processer = self.get_processor()
-        img = processer(self.load_img(self.image_list[index]))
+        if self.images is not None:
+            img = self.images[index].float().div_(255)
+        else:
+            img = self.processor(self.load_img(self.image_list[index]))
         if self.mode == "gan":
             return img
 
@@ -41,6 +41,8 @@ def multilayer_hsic(model, criterion, inputs, target, a1, a2, n_classes, ktype,
         total_loss += cross_loss
         h_target = utils.to_categorical(target, num_classes=n_classes).float()
         h_data = inputs.view(bs, -1)
+        # h_data / h_target kernels are the same for every layer, computed once per step
+        kernel_cache = {}
         for hidden in hiddens:
             hidden = hidden.view(bs, -1)
 
@@ -50,7 +52,8 @@ def multilayer_hsic(model, criterion, inputs, target, a1, a2, n_classes, ktype,
                     h_target=h_target.float(),
                     h_data=h_data,
                     sigma=5.,
-                    ktype=ktype
+                    ktype=ktype,
+                    cache=kernel_cache
                 )
             elif measure == 'COCO':
                 hxz_l, hyz_l = hsic.coco_objective(
@@ -58,7 +61,8 @@ def multilayer_hsic(model, criterion, inputs, target, a1, a2, n_classes, ktype,
                     h_target=h_target.float(),
                     h_data=h_data,
                     sigma=5.,
-                    ktype=ktype
+                    ktype=ktype,
+                    cache=kernel_cache
                 )
 
             temp_hsic = a1 * hxz_l - a2 * hyz_l
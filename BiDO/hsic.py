@@ -1,21 +1,21 @@
 import torch
-import numpy as np
 from torch.autograd import Variable, grad
 
+# All kernels stay on the device (and dtype) of their input. Centring is done implicitly by subtracting
+# row / column means instead of multiplying with H = I - 1/m, and the HSIC-CCA projections use
+# torch.linalg.solve instead of explicit inverses.
+
 
 def sigma_estimation(X, Y):
     """ sigma from median distance
     """
-    D = distmat(torch.cat([X, Y]))
-    D = D.detach().cpu().numpy()
-    Itri = np.tril_indices(D.shape[0], -1)
-    Tri = D[Itri]
-    med = np.median(Tri)
-    if med <= 0:
-        med = np.mean(Tri)
-    if med < 1E-2:
-        med = 1E-2
-    return med
+    D = distmat(torch.cat([X, Y])).detach()
+    Itri = torch.tril_indices(D.size(0), D.size(0), -1, device=D.device)
+    Tri = D[Itri[0], Itri[1]]
+    # linear interpolation = np.median for an even number of entries
+    med = torch.quantile(Tri, 0.5)
+    med = torch.where(med <= 0, Tri.mean(), med)
+    return med.clamp_min(1E-2)
 
 
 def distmat(X):
@@ -29,108 +29,113 @@ def distmat(X):
     return D
 
 
-def coco_kernelmat(X, sigma, ktype='gaussian'):
-    """ kernel matrix baker
+def _kernel(X, sigma, ktype='gaussian'):
+    """ uncentred kernel matrix
     """
-    m = int(X.size()[0])
-    H = torch.eye(m) - (1. / m) * torch.ones([m, m])
-
     if ktype == "gaussian":
         Dxx = distmat(X)
 
         if sigma:
             variance = 2. * sigma * sigma * X.size()[1]
-            Kx = torch.exp(-Dxx / variance).type(torch.FloatTensor)  # kernel matrices
-            # print(sigma, torch.mean(Kx), torch.max(Kx), torch.min(Kx))
+            Kx = torch.exp(-Dxx / variance)  # kernel matrices
         else:
+            sx = None
             try:
                 sx = sigma_estimation(X, X)
-                Kx = torch.exp(-Dxx / (2. * sx * sx)).type(torch.FloatTensor)
+                Kx = torch.exp(-Dxx / (2. * sx * sx))
             except RuntimeError as e:
                 raise RuntimeError("Unstable sigma {} with maximum/minimum input ({},{})".format(
                     sx, torch.max(X), torch.min(X)))
 
     ## Adding linear kernel
     elif ktype == "linear":
-        Kx = torch.mm(X, X.T).type(torch.FloatTensor)
+        Kx = torch.mm(X, X.T)
 
     elif ktype == 'IMQ':
         Dxx = distmat(X)
         Kx = 1 * torch.rsqrt(Dxx + 1)
 
-    Kxc = torch.mm(H, torch.mm(Kx, H))
+    return Kx.float()
+
+
+def coco_kernelmat(X, sigma, ktype='gaussian'):
+    """ doubly centred kernel matrix H K H
+    """
+    Kx = _kernel(X, sigma, ktype)
+    Kxc = Kx - Kx.mean(dim=0, keepdim=True) - Kx.mean(dim=1, keepdim=True) + Kx.mean()
 
     return Kxc
 
 
-def coco_normalized_cca(x, y, sigma, ktype='gaussian'):
+def coco_normalized_cca(x, y, sigma, ktype='gaussian', L=None):
+    """ L: optional precomputed coco_kernelmat(y), e.g. shared by all layers of one step
+    """
     m = int(x.size()[0])
     K = coco_kernelmat(x, sigma=sigma)
-    L = coco_kernelmat(y, sigma=sigma, ktype=ktype)
+    if L is None:
+        L = coco_kernelmat(y, sigma=sigma, ktype=ktype)
 
     res = torch.sqrt(torch.norm(torch.mm(K, L))) / m
     return res
 
 
-def coco_objective(hidden, h_target, h_data, sigma, ktype='gaussian'):
-    coco_hx_val = coco_normalized_cca(hidden, h_data, sigma=sigma)
-    coco_hy_val = coco_normalized_cca(hidden, h_target, sigma=sigma, ktype=ktype)
+def coco_objective(hidden, h_target, h_data, sigma, ktype='gaussian', cache=None):
+    """ cache: dict living for one training step; kernels of h_data / h_target are computed once
+    and reused by every hidden layer
+    """
+    if cache is None:
+        cache = {}
+    if ('coco', 'data', sigma) not in cache:
+        cache[('coco', 'data', sigma)] = coco_kernelmat(h_data, sigma=sigma)
+    if ('coco', 'target', sigma, ktype) not in cache:
+        cache[('coco', 'target', sigma, ktype)] = coco_kernelmat(h_target, sigma=sigma, ktype=ktype)
+    coco_hx_val = coco_normalized_cca(hidden, h_data, sigma=sigma, L=cache[('coco', 'data', sigma)])
+    coco_hy_val = coco_normalized_cca(hidden, h_target, sigma=sigma, ktype=ktype,
+                                      L=cache[('coco', 'target', sigma, ktype)])
 
     return coco_hx_val, coco_hy_val
 
 
 def kernelmat(X, sigma, ktype='gaussian'):
-    """ kernel matrix baker
+    """ right-centred kernel matrix K H
     """
-    m = int(X.size()[0])
-    H = torch.eye(m) - (1. / m) * torch.ones([m, m])
+    Kx = _kernel(X, sigma, ktype)
+    Kxc = Kx - Kx.mean(dim=1, keepdim=True)
 
-    if ktype == "gaussian":
-        Dxx = distmat(X)
-
-        if sigma:
-            variance = 2. * sigma * sigma * X.size()[1]
-            Kx = torch.exp(-Dxx / variance).type(torch.FloatTensor)  # kernel matrices
-            # print(sigma, torch.mean(Kx), torch.max(Kx), torch.min(Kx))
-        else:
-            try:
-                sx = sigma_estimation(X, X)
-                Kx = torch.exp(-Dxx / (2. * sx * sx)).type(torch.FloatTensor)
-            except RuntimeError as e:
-                raise RuntimeError("Unstable sigma {} with maximum/minimum input ({},{})".format(
-                    sx, torch.max(X), torch.min(X)))
-
-
-    elif ktype == "linear":
-        Kx = torch.mm(X, X.T).type(torch.FloatTensor)
-
-    elif ktype == 'IMQ':
-        Dxx = distmat(X)
-        Kx = 1 * torch.rsqrt(Dxx + 1)
+    return Kxc
 
-    Kxc = torch.mm(Kx, H)
 
-    return Kxc
+def cca_projection(Kxc, epsilon=1E-5):
+    """ R = Kxc (Kxc + epsilon * m * I)^-1, via a linear solve
+    """
+    m = Kxc.size(0)
+    K_I = torch.eye(m, device=Kxc.device, dtype=Kxc.dtype)
+    return torch.linalg.solve(Kxc + epsilon * m * K_I, Kxc, left=False)
 
 
-def hsic_normalized_cca(x, y, sigma, ktype='gaussian'):
-    m = int(x.size()[0])
-    Kxc = kernelmat(x, sigma=sigma)
-    Kyc = kernelmat(y, sigma=sigma, ktype=ktype)
-
-    epsilon = 1E-5
-    K_I = torch.eye(m)
-    Kxc_i = torch.inverse(Kxc + epsilon * m * K_I)
-    Kyc_i = torch.inverse(Kyc + epsilon * m * K_I)
-    Rx = (Kxc.mm(Kxc_i))
-    Ry = (Kyc.mm(Kyc_i))
+def hsic_normalized_cca(x, y, sigma, ktype='gaussian', Ry=None):
+    """ Ry: optional precomputed cca_projection(kernelmat(y)), e.g. shared by all layers of one step
+    """
+    Rx = cca_projection(kernelmat(x, sigma=sigma))
+    if Ry is None:
+        Ry = cca_projection(kernelmat(y, sigma=sigma, ktype=ktype))
     Pxy = torch.sum(torch.mul(Rx, Ry.t()))
 
     return Pxy
 
 
-def hsic_objective(hidden, h_target, h_data, sigma, ktype='gaussian'):
-    hsic_hx_val = hsic_normalized_cca(hidden, h_data, sigma=sigma)
-    hsic_hy_val = hsic_normalized_cca(hidden, h_target, sigma=sigma, ktype=ktype)
+def hsic_objective(hidden, h_target, h_data, sigma, ktype='gaussian', cache=None):
+    """ cache: dict living for one training step; projections of h_data / h_target are computed once
+    and reused by every hidden layer
+    """
+    if cache is None:
+        cache = {}
+    if ('hsic', 'data', sigma) not in cache:
+        cache[('hsic', 'data', sigma)] = cca_projection(kernelmat(h_data, sigma=sigma))
+    if ('hsic', 'target', sigma, ktype) not in cache:
+        cache[('hsic', 'target', sigma, ktype)] = cca_projection(kernelmat(h_target, sigma=sigma, ktype=ktype))
+    hsic_hx_val = hsic_normalized_cca(hidden, h_data, sigma=sigma, Ry=cache[('hsic', 'data', sigma)])
+    hsic_hy_val = hsic_normalized_cca(hidden, h_target, sigma=sigma, ktype=ktype,
+                                      Ry=cache[('hsic', 'target', sigma, ktype)])
 
     return hsic_hx_val, hsic_hy_val
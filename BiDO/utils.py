@@ -1,10 +1,9 @@
 import numpy as np
-import torch, random, sys, json, time, copy, os
+import torch, sys, json, time, os
 from . import dataloader
 import torch.nn as nn
 from datetime import datetime
 from torch.utils.data import sampler
-from collections import defaultdict
 from torch.autograd import Variable
 import torchvision.utils as tvls
 
@@ -143,55 +142,65 @@ class RandomIdentitySampler(sampler.Sampler):
     """
     Randomly sample N identities, then for each identity,
     randomly sample K instances, therefore batch size is N*K.
+
+    labels: label of every sample (array, list or path to a .npy index). By default the dataset's
+    label_list / targets are used, the dataset is only iterated (images loaded) if it has neither.
     """
 
-    def __init__(self, dataset, batch_size, num_instances):
+    def __init__(self, dataset, batch_size, num_instances, labels=None):
         self.data_source = dataset
         self.batch_size = batch_size
         self.num_instances = num_instances
         self.num_pids_per_batch = self.batch_size // self.num_instances
-        self.index_dic = defaultdict(list)
-        # changed according to the dataset
-        for index, inputs in enumerate(self.data_source):
-            self.index_dic[inputs[1]].append(index)
-
-        self.pids = list(self.index_dic.keys())
+        if labels is None:
+            labels = getattr(dataset, 'label_list', None)
+        if labels is None:
+            labels = getattr(dataset, 'targets', None)
+        if labels is None:
+            labels = [inputs[1] for inputs in self.data_source]
+        elif isinstance(labels, str):
+            labels = np.load(labels)
+        labels = np.asarray(labels, dtype=np.int64)
+
+        # samples grouped by identity: order[starts[i]:starts[i] + counts[i]] are the samples of pids[i]
+        self.order = np.argsort(labels, kind='stable')
+        self.pids, starts, counts = np.unique(labels[self.order], return_index=True, return_counts=True)
+        self.starts, self.counts = starts, counts
+        self.group = np.repeat(np.arange(len(counts)), counts)  # identity number of every entry of order
 
         # estimate number of examples in an epoch
-        self.length = 0
-        for pid in self.pids:
-            idxs = self.index_dic[pid]
-            num = len(idxs)
-            if num < self.num_instances:
-                num = self.num_instances
-            self.length += num - num % self.num_instances
+        num = np.maximum(counts, self.num_instances)
+        self.length = int((num - num % self.num_instances).sum())
 
     def __iter__(self):
-        batch_idxs_dict = defaultdict(list)
-
-        for pid in self.pids:
-            idxs = copy.deepcopy(self.index_dic[pid])
-            if len(idxs) < self.num_instances:
-                idxs = np.random.choice(idxs, size=self.num_instances, replace=True)
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.num_instances:
-                    batch_idxs_dict[pid].append(batch_idxs)
-                    batch_idxs = []
-
-        avai_pids = copy.deepcopy(self.pids)
-        final_idxs = []
-
-        while len(avai_pids) >= self.num_pids_per_batch:
-            selected_pids = random.sample(avai_pids, self.num_pids_per_batch)
-            for pid in selected_pids:
-                batch_idxs = batch_idxs_dict[pid].pop(0)
-                final_idxs.extend(batch_idxs)
-                if len(batch_idxs_dict[pid]) == 0:
-                    avai_pids.remove(pid)
-
+        K, P = self.num_instances, self.num_pids_per_batch
+        counts, starts = self.counts, self.starts
+        # samples grouped by identity, in random order inside each identity
+        shuffled = self.order[np.lexsort((np.random.rand(len(self.order)), self.group))]
+        # per identity: its first count - count % K shuffled samples, or K drawn with replacement if count < K
+        effective = np.where(counts < K, K, counts - counts % K)
+        g = np.repeat(np.arange(len(counts)), effective)
+        pos = np.arange(len(g)) - np.repeat(np.cumsum(effective) - effective, effective)
+        pos = np.where(counts[g] < K, (np.random.rand(len(g)) * counts[g]).astype(np.int64), pos)
+        all_chunks = shuffled[starts[g] + pos].reshape(-1, K)
+        num_chunks = effective // K
+        chunk_offsets = np.cumsum(num_chunks) - num_chunks
+
+        # every batch takes the next chunk of P distinct identities that still have chunks left
+        used = np.zeros(len(counts), dtype=np.int64)
+        avai = np.nonzero(num_chunks > 0)[0]
+        selected_chunks = []
+        while len(avai) >= P:
+            selected = np.random.choice(avai, size=P, replace=False)
+            selected_chunks.append(chunk_offsets[selected] + used[selected])
+            used[selected] += 1
+            if (used[selected] == num_chunks[selected]).any():
+                avai = avai[used[avai] < num_chunks[avai]]
+
+        if not selected_chunks:
+            final_idxs = []
+        else:
+            final_idxs = all_chunks[np.concatenate(selected_chunks)].reshape(-1).tolist()
         self.length = len(final_idxs)
         return iter(final_idxs)
 
@@ -32,6 +32,7 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import hashlib
 import os
 import pathlib
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
@@ -71,6 +72,14 @@ parser.add_argument('-c', '--gpu', default='', type=str,
                     help='GPU to use (leave blank for CPU only)')
 parser.add_argument('--dataset', default='celeba', type=str,
                     help='celeba | mnist | cifar')
+parser.add_argument('--cache-dir', default='./fid_stats_cache', type=str,
+                    help='Directory for the cached (mu, sigma) of the reference image folder (first path)')
+
+# evaluator checkpoints per dataset, see load_evaluator
+EVALUATOR_CKPT = {'celeba': './eval_ckp/FaceNet_95.88.tar',
+                  'mnist': './eval_ckp/SCNN_99.42.tar'}
+_evaluators = {}
+_file_hashes = {}
 
 
 class FaceNet(torch.nn.Module):
@@ -106,6 +115,60 @@ def imread(dataset, filename):
         return tmp
 
 
+def feature_dims(dataset, dims):
+    # the mnist / celeba evaluators return 512-d features whatever dims is
+    if dataset == 'mnist' or dataset == 'celeba':
+        return 512
+    return dims
+
+
+class ActivationStatistics:
+    """
+    Running mean / covariance of evaluator features, accumulated on the device in float64
+    (sum and sum of outer products), so activations never leave the GPU.
+    """
+    def __init__(self, dims, device):
+        self.count = 0
+        self.sum = torch.zeros(dims, dtype=torch.float64, device=device)
+        self.sum_outer = torch.zeros(dims, dims, dtype=torch.float64, device=device)
+
+    def update(self, feats):
+        feats = feats.reshape(feats.size(0), -1).double()
+        self.count += feats.size(0)
+        self.sum += feats.sum(dim=0)
+        self.sum_outer += feats.t() @ feats
+
+    def mean_cov(self):
+        """mu [dims], unbiased sigma [dims, dims] (as np.cov(rowvar=False)), both torch float64."""
+        mu = self.sum / self.count
+        sigma = (self.sum_outer - self.count * torch.outer(mu, mu)) / max(self.count - 1, 1)
+        return mu, sigma
+
+
+def iter_image_files(dataset, files, batch_size=50):
+    """Yield [B, C, H, W] float batches in [0, 1] read from image files."""
+    for start in range(0, len(files), batch_size):
+        images = np.stack([imread(dataset, str(f)) for f in files[start:start + batch_size]])
+        # Reshape to (n_images, 3, height, width)
+        yield torch.from_numpy(images.transpose((0, 3, 1, 2))).float().div_(255)
+
+
+def accumulate_statistics(batches, model, dims, cuda=False, verbose=False):
+    """Feed image batches ([B, C, H, W] tensors in [0, 1]) through the evaluator, returns ActivationStatistics."""
+    model.eval()
+    device = 'cuda' if cuda else 'cpu'
+    stats = ActivationStatistics(dims, device)
+    with torch.no_grad():
+        for i, batch in enumerate(tqdm(batches)):
+            if verbose:
+                print('\rPropagating batch %d' % (i + 1), end='', flush=True)
+            pred = model(batch.to(device, non_blocking=True).float())[0]
+            stats.update(pred)
+    if verbose:
+        print(' done')
+    return stats
+
+
 def get_activations(dataset, files, model, batch_size=50, dims=2048,
                     cuda=False, verbose=False):
     """Calculates the activations of the pool_3 layer for all images.
@@ -114,10 +177,6 @@ def get_activations(dataset, files, model, batch_size=50, dims=2048,
     -- files       : List of image files paths
     -- model       : Instance of inception model
     -- batch_size  : Batch size of images for the model to process at once.
-                     Make sure that the number of samples is a multiple of
-                     the batch size, otherwise some samples are ignored. This
-                     behavior is retained to match the original FID score
-                     implementation.
     -- dims        : Dimensionality of features returned by Inception
     -- cuda        : If set to True, use GPU
     -- verbose     : If set to True and parameter out_step is given, the number
@@ -128,50 +187,13 @@ def get_activations(dataset, files, model, batch_size=50, dims=2048,
        query tensor.
     """
     model.eval()
-
-    if batch_size > len(files):
-        print(('Warning: batch size is bigger than the data size. '
-               'Setting batch size to data size'))
-        batch_size = len(files)
-
-    if dataset == 'mnist':
-        dims = 512
-
-    if dataset == 'celeba':
-        dims = 512
-
-    pred_arr = np.empty((len(files), dims))
-
-    for i in tqdm(range(0, len(files), batch_size)):
-        if verbose:
-            print('\rPropagating batch %d/%d' % (i + 1, batch_size),
-                  end='', flush=True)
-        start = i
-        end = i + batch_size
-
-        images = np.array([imread(dataset, str(f)).astype(np.float32)
-                           for f in files[start:end]])
-
-        # Reshape to (n_images, 3, height, width)
-        images = images.transpose((0, 3, 1, 2))
-        images /= 255
-
-        batch = torch.from_numpy(images).type(torch.FloatTensor)
-        if cuda:
-            batch = batch.cuda()
-
-        pred = model(batch)[0]
-        # If model output is not scalar, apply global spatial average pooling.
-        # This happens if you choose a dimensionality not equal 2048.
-        # if dataset == 'celeba':
-        #     if pred.size(2) != 1 or pred.size(3) != 1:
-        #         pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
-
-        pred_arr[start:end] = pred.cpu().data.numpy().reshape(pred.size(0), -1)
-
-    if verbose:
-        print(' done')
-    return pred_arr
+    device = 'cuda' if cuda else 'cpu'
+    preds = []
+    with torch.no_grad():
+        for batch in tqdm(iter_image_files(dataset, files, batch_size)):
+            pred = model(batch.to(device))[0]
+            preds.append(pred.reshape(pred.size(0), -1).cpu())
+    return torch.cat(preds).numpy().astype(np.float64)
 
 
 def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
@@ -231,6 +253,22 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
             np.trace(sigma2) - 2 * tr_covmean)
 
 
+def calculate_frechet_distance_torch(mu1, sigma1, mu2, sigma2):
+    """Frechet distance on the device of the inputs.
+
+    Tr(sqrt(C_1 C_2)) is computed from the eigenvalues of sqrt(C_1) C_2 sqrt(C_1), which is symmetric PSD and
+    similar to C_1 C_2, using two eigh calls instead of scipy.linalg.sqrtm on the host.
+    """
+    mu1 = torch.as_tensor(mu1).double()
+    mu2, sigma1, sigma2 = (torch.as_tensor(x).to(mu1.device, torch.float64) for x in (mu2, sigma1, sigma2))
+    diff = mu1 - mu2
+    evals, evecs = torch.linalg.eigh(sigma1)
+    sqrt_sigma1 = (evecs * evals.clamp_min(0).sqrt().unsqueeze(0)) @ evecs.t()
+    m = sqrt_sigma1 @ sigma2 @ sqrt_sigma1
+    tr_covmean = torch.linalg.eigvalsh((m + m.t()) / 2).clamp_min(0).sqrt().sum()
+    return (diff.dot(diff) + torch.trace(sigma1) + torch.trace(sigma2) - 2 * tr_covmean).item()
+
+
 def calculate_activation_statistics(dataset, files, model, batch_size=50,
                                     dims=2048, cuda=False, verbose=False):
     """Calculation of the statistics used by the FID.
@@ -250,59 +288,120 @@ def calculate_activation_statistics(dataset, files, model, batch_size=50,
     -- sigma : The covariance matrix of the activations of the pool_3 layer of
                the inception model.
     """
-    act = get_activations(dataset, files, model, batch_size, dims, cuda, verbose)
-    mu = np.mean(act, axis=0)
-    sigma = np.cov(act, rowvar=False)
-    return mu, sigma
-
-
-def _compute_statistics_of_path(dataset, path, model, batch_size, dims, cuda):
-    if path.endswith('.npz'):
-        f = np.load(path)
-        m, s = f['mu'][:], f['sigma'][:]
-        f.close()
-    else:
-        path = pathlib.Path(path)
-        files = list(path.glob('*.jpg')) + list(path.glob('*.png'))
-        m, s = calculate_activation_statistics(dataset, files, model, batch_size,
-                                               dims, cuda)
-
-    return m, s
-
-
-def calculate_fid_given_paths(dataset, paths, batch_size, cuda, dims):
-    """Calculates the FID of two paths"""
-    for p in paths:
-        if not os.path.exists(p):
-            raise RuntimeError('Invalid path: %s' % p)
-
+    stats = accumulate_statistics(iter_image_files(dataset, files, batch_size), model,
+                                  feature_dims(dataset, dims), cuda, verbose)
+    mu, sigma = stats.mean_cov()
+    return mu.cpu().numpy(), sigma.cpu().numpy()
+
+
+def _file_sha1(path):
+    # content hash of a checkpoint, memoised on (path, size, mtime)
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def statistics_cache_key(dataset, files, dims):
+    """Cache key of a folder's statistics: dataset, evaluator checkpoint content, dims and the image files."""
+    h = hashlib.sha1('{}-{}'.format(dataset, dims).encode())
+    if dataset in EVALUATOR_CKPT and os.path.exists(EVALUATOR_CKPT[dataset]):
+        h.update(_file_sha1(EVALUATOR_CKPT[dataset]).encode())
+    for f in sorted(files):
+        st = os.stat(f)
+        h.update('{}:{}:{}'.format(os.path.basename(f), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+
+def load_evaluator(dataset, cuda=True):
+    """Evaluator network for dataset, loaded once per process."""
+    if dataset in _evaluators:
+        return _evaluators[dataset]
     if dataset == 'celeba':
         model = FaceNet(1000)
         model = torch.nn.DataParallel(model).cuda()
-        path_E = './eval_ckp/FaceNet_95.88.tar'
-        ckp_E = torch.load(path_E)
+        ckp_E = torch.load(EVALUATOR_CKPT[dataset])
         model.load_state_dict(ckp_E['state_dict'], strict=False)
 
     elif dataset == 'mnist':
         model = SCNN(10)
 
-        path_E = './eval_ckp/SCNN_99.42.tar'
-        ckp_E = torch.load(path_E)
+        ckp_E = torch.load(EVALUATOR_CKPT[dataset])
         model = torch.nn.DataParallel(model).to('cuda')
         model.load_state_dict(ckp_E['state_dict'])
+    else:
+        raise ValueError('No FID evaluator for dataset %s' % dataset)
 
     if cuda:
         model.cuda()
+    model.eval()
+    _evaluators[dataset] = model
+    return model
+
+
+def _compute_statistics_of_path(dataset, path, model, batch_size, dims, cuda, cache_dir=None):
+    """(mu, sigma) of a .npz file or an image folder; folder statistics are cached as .npz in cache_dir."""
+    if path.endswith('.npz'):
+        f = np.load(path)
+        m, s = f['mu'][:], f['sigma'][:]
+        f.close()
+        return m, s
+
+    path = pathlib.Path(path)
+    files = list(path.glob('*.jpg')) + list(path.glob('*.png'))
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, '{}_{}.npz'.format(dataset, statistics_cache_key(dataset, files, dims)))
+        if os.path.exists(cache_file):
+            return _compute_statistics_of_path(dataset, cache_file, model, batch_size, dims, cuda)
+    m, s = calculate_activation_statistics(dataset, files, model, batch_size,
+                                           dims, cuda)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_file, mu=m, sigma=s)
+    return m, s
+
+
+def calculate_fid_given_paths(dataset, paths, batch_size, cuda, dims, cache_dir='./fid_stats_cache'):
+    """Calculates the FID of two paths; only the statistics of the reference paths[0] are cached, the generated
+    folder paths[1] changes between calls and is always recomputed"""
+    for p in paths:
+        if not os.path.exists(p):
+            raise RuntimeError('Invalid path: %s' % p)
+
+    model = load_evaluator(dataset, cuda)
 
     m1, s1 = _compute_statistics_of_path(dataset, paths[0], model, batch_size,
-                                         dims, cuda)
+                                         dims, cuda, cache_dir)
     m2, s2 = _compute_statistics_of_path(dataset, paths[1], model, batch_size,
                                          dims, cuda)
-    fid_value = calculate_frechet_distance(m1, s1, m2, s2)
+    device = 'cuda' if cuda else 'cpu'
+    fid_value = calculate_frechet_distance_torch(torch.from_numpy(m1).to(device), s1, m2, s2)
 
     return fid_value
 
 
+def calculate_fid_given_tensors(dataset, ref_path, images, batch_size=50, cuda=True, dims=2048,
+                                cache_dir='./fid_stats_cache'):
+    """
+    FID between a reference (image folder or .npz, cached) and generated images given as tensors.
+
+    images: [N, C, H, W] tensor in [0, 1] or an iterable of such batches (e.g. straight from the generator);
+    they are streamed through the evaluator without being written to disk.
+    """
+    model = load_evaluator(dataset, cuda)
+    m1, s1 = _compute_statistics_of_path(dataset, ref_path, model, batch_size, dims, cuda, cache_dir)
+    if torch.is_tensor(images):
+        images = images.split(batch_size)
+    m2, s2 = accumulate_statistics(images, model, feature_dims(dataset, dims), cuda).mean_cov()
+    return calculate_frechet_distance_torch(m2, s2, m1, s1)
+
+
 if __name__ == '__main__':
     args = parser.parse_args()
     # os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
@@ -311,5 +410,6 @@ if __name__ == '__main__':
                                           args.path,
                                           args.batch_size,
                                           args.gpu != '',
-                                          args.dims)
+                                          args.dims,
+                                          args.cache_dir)
     print('FID: ', fid_value)
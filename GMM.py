@@ -0,0 +1,202 @@
+import math
+from collections import namedtuple
+
+import torch
+import torch.nn.functional as F
+
+# ============================================================================
+# GPU-native Gaussian mixture fitting (EM in torch) + torch PCA
+# Replaces the sklearn PCA + GaussianMixture(covariance_type='full') round-trip. Covariances are kept in
+# factored form, the D x D matrices are only materialised on request (covariance_matrix).
+# ============================================================================
+
+# Fitted mixture. Per covariance_type the covariance of component k is
+# - 'diag':    diag(var[k])
+# - 'lowrank': factor[k] @ factor[k].T + diag(var[k])        factor: [K, d, r]
+# - 'full':    chol[k] @ chol[k].T                            chol:   [K, d, d] (lower Cholesky factor)
+# If basis ([d, D], PCA components) is set the mixture lives in the d-dimensional PCA space: the covariance in
+# the original space is basis.T @ cov_k @ basis, the means are already mapped back to the original space.
+GMMParams = namedtuple('GMMParams', ['means', 'weights', 'covariance_type', 'var', 'factor', 'chol',
+                                     'basis', 'pca_mean', 'log_likelihood', 'converged'])
+
+
+def pca_lowrank(X, n_components, niter=4):
+    """
+    PCA via torch.pca_lowrank (randomised SVD), stays on the device of X.
+
+    Returns:
+    - mean [D], components [n_components, D] (rows, like sklearn's components_), explained_variance [n_components]
+    """
+    N = X.size(0)
+    q = min(n_components, N, X.size(1))
+    mean = X.mean(dim=0)
+    _, S, V = torch.pca_lowrank(X, q=q, center=True, niter=niter)
+    explained_variance = S ** 2 / max(N - 1, 1)
+    return mean, V.t(), explained_variance
+
+
+def _estimate_log_gaussian_prob(X, means, covariance_type, var=None, factor=None, chol=None):
+    # X: [N, d], means: [K, d] -> log N(x_n | mu_k, Sigma_k): [N, K]
+    N, d = X.shape
+    diff = X.unsqueeze(1) - means.unsqueeze(0)  # [N, K, d]
+    if covariance_type == 'diag':
+        maha = (diff ** 2 / var.unsqueeze(0)).sum(dim=2)
+        logdet = torch.log(var).sum(dim=1)
+    elif covariance_type == 'lowrank':
+        # Woodbury identity + matrix determinant lemma, never forms the d x d matrix
+        a = diff / var.unsqueeze(0)  # [N, K, d]
+        inner = torch.eye(factor.size(2), device=X.device, dtype=X.dtype) + \
+            torch.einsum('kdr,kd,kds->krs', factor, 1.0 / var, factor)  # [K, r, r]
+        inner_chol = torch.linalg.cholesky(inner)
+        b = torch.einsum('nkd,kdr->knr', a, factor)  # [K, N, r]
+        c = torch.linalg.solve_triangular(inner_chol, b.transpose(1, 2), upper=False)  # [K, r, N]
+        maha = (diff * a).sum(dim=2) - (c ** 2).sum(dim=1).t()
+        logdet = torch.log(var).sum(dim=1) + 2 * torch.log(torch.diagonal(inner_chol, dim1=1, dim2=2)).sum(dim=1)
+    else:
+        y = torch.linalg.solve_triangular(chol, diff.permute(1, 2, 0), upper=False)  # [K, d, N]
+        maha = (y ** 2).sum(dim=1).t()
+        logdet = 2 * torch.log(torch.diagonal(chol, dim1=1, dim2=2)).sum(dim=1)
+    return -0.5 * (d * math.log(2 * math.pi) + logdet.unsqueeze(0) + maha)
+
+
+def _m_step(X, resp, covariance_type, reg_covar, rank):
+    N, d = X.shape
+    nk = resp.sum(dim=0) + 10 * torch.finfo(resp.dtype).eps  # [K]
+    means = resp.t() @ X / nk.unsqueeze(1)
+    weights = nk / N
+    var = factor = chol = None
+    if covariance_type == 'diag':
+        avg_X2 = resp.t() @ (X * X) / nk.unsqueeze(1)
+        var = (avg_X2 - means ** 2).clamp_min(0) + reg_covar
+    else:
+        # responsibility-weighted, centred data: [K, N, d]
+        wdiff = resp.t().sqrt().unsqueeze(2) * (X.unsqueeze(0) - means.unsqueeze(1))
+        if covariance_type == 'full':
+            cov = torch.bmm(wdiff.transpose(1, 2), wdiff) / nk.view(-1, 1, 1)
+            cov = cov + reg_covar * torch.eye(d, device=X.device, dtype=X.dtype)
+            chol = torch.linalg.cholesky(cov)
+        else:
+            # top-r principal directions of each component's weighted scatter (PPCA-style factor),
+            # the diagonal keeps the residual per-dimension variance
+            r = min(rank, d, N)
+            _, S, V = torch.svd_lowrank(wdiff, q=r, niter=2)  # S: [K, r], V: [K, d, r]
+            eig = S ** 2 / nk.unsqueeze(1)  # [K, r]
+            diag_total = (wdiff ** 2).sum(dim=1) / nk.unsqueeze(1)  # [K, d]
+            sigma2 = ((diag_total.sum(dim=1) - eig.sum(dim=1)) / max(d - r, 1)).clamp_min(0)  # [K]
+            factor = V * (eig - sigma2.unsqueeze(1)).clamp_min(0).sqrt().unsqueeze(1)  # [K, d, r]
+            var = (diag_total - (factor ** 2).sum(dim=2)).clamp_min(0) + reg_covar
+    return means, weights, var, factor, chol
+
+
+def fit_gmm(X, n_components, covariance_type='diag', rank=8, max_iter=100, tol=1e-3, reg_covar=1e-4,
+            means_init=None, pca_components=None, check_every=5, generator=None):
+    """
+    Fit a Gaussian mixture with EM on the device of X.
+
+    Args:
+    - X (torch.Tensor): [N, ...] features (flattened to [N, D])
+    - n_components (int): Number of Gaussian components K
+    - covariance_type (str): 'diag', 'lowrank' (rank-r + diagonal) or 'full'
+    - rank (int): factor rank for 'lowrank'
+    - means_init (torch.Tensor, optional): [K, D] initial means (in the original feature space)
+    - pca_components (int, optional): fit in a torch PCA subspace of this size
+
+    Returns:
+    - GMMParams with means mapped back to the original space and covariances in factored form
+    """
+    N = X.size(0)
+    X = X.reshape(N, -1)
+    basis = pca_mean = None
+    if pca_components:
+        pca_mean, basis, _ = pca_lowrank(X, pca_components)
+        X_fit = (X - pca_mean) @ basis.t()
+        if means_init is not None:
+            means_init = (means_init.to(X) - pca_mean) @ basis.t()
+    else:
+        X_fit = X
+
+    if means_init is None:
+        idx = torch.randperm(N, device=X.device, generator=generator)[:n_components]
+        means_init = X_fit[idx]
+    means_init = means_init.to(X_fit)
+    # initial hard assignment to the closest mean, as sklearn does for means_init
+    resp = F.one_hot(torch.cdist(X_fit, means_init).argmin(dim=1), n_components).to(X_fit.dtype)
+    means, weights, var, factor, chol = _m_step(X_fit, resp, covariance_type, reg_covar, rank)
+    means = means_init.clone()
+
+    lower_bound = torch.tensor(-float('inf'), device=X.device, dtype=X_fit.dtype)
+    converged = torch.zeros((), dtype=torch.bool, device=X.device)
+    for it in range(max_iter):
+        weighted = _estimate_log_gaussian_prob(X_fit, means, covariance_type, var, factor, chol) + \
+            torch.log(weights).unsqueeze(0)
+        log_norm = torch.logsumexp(weighted, dim=1)
+        resp = torch.exp(weighted - log_norm.unsqueeze(1))
+        means, weights, var, factor, chol = _m_step(X_fit, resp, covariance_type, reg_covar, rank)
+        new_bound = log_norm.mean()
+        converged = (new_bound - lower_bound).abs() < tol
+        lower_bound = new_bound
+        # host sync only every check_every iterations
+        if (it + 1) % check_every == 0 and bool(converged):
+            break
+
+    if basis is not None:
+        means = means @ basis + pca_mean
+    return GMMParams(means, weights, covariance_type, var, factor, chol, basis, pca_mean, lower_bound, converged)
+
+
+def covariance_matrix(params):
+    """Expand the factored covariances of a GMMParams to dense [K, D, D] matrices (original space)."""
+    if params.covariance_type == 'diag':
+        cov = torch.diag_embed(params.var)
+    elif params.covariance_type == 'lowrank':
+        cov = params.factor @ params.factor.transpose(1, 2) + torch.diag_embed(params.var)
+    else:
+        cov = params.chol @ params.chol.transpose(1, 2)
+    if params.basis is not None:
+        cov = params.basis.t().unsqueeze(0) @ cov @ params.basis.unsqueeze(0)
+    return cov
+
+
+def covariance_diagonal(params):
+    """Per-dimension variances [K, D] in the original space, without forming the D x D matrices."""
+    if params.covariance_type == 'diag':
+        diag = params.var
+    elif params.covariance_type == 'lowrank':
+        diag = params.var + (params.factor ** 2).sum(dim=2)
+    else:
+        diag = None
+    if params.basis is None:
+        return diag if diag is not None else (params.chol ** 2).sum(dim=2)
+    # diag(P^T C P) with C = L L^T  ->  ||L^T p_j||^2 for every original dimension j
+    if params.covariance_type == 'full':
+        LtP = params.chol.transpose(1, 2) @ params.basis.unsqueeze(0)  # [K, d, D]
+        return (LtP ** 2).sum(dim=1)
+    if params.covariance_type == 'lowrank':
+        FtP = params.factor.transpose(1, 2) @ params.basis.unsqueeze(0)  # [K, r, D]
+        return (FtP ** 2).sum(dim=1) + params.var @ (params.basis ** 2)
+    return params.var @ (params.basis ** 2)
+
+
+def fit_gmm_torch(features, labels, num_class, n_components, covariance_type='diag', pca_components=None,
+                  max_iter=100, tol=1e-3, reg_covar=1e-4, rank=8):
+    """
+    Fit one mixture per class on the GPU.
+
+    Returns:
+    - list of GMMParams (None for classes with fewer samples than n_components)
+    """
+    N = features.size(0)
+    features = features.reshape(N, -1)
+    order = torch.argsort(labels)
+    counts = torch.bincount(labels, minlength=num_class).tolist()
+    gmm_params = []
+    start = 0
+    for c in range(num_class):
+        idx = order[start:start + counts[c]]
+        start += counts[c]
+        if counts[c] < max(n_components, 2):
+            gmm_params.append(None)
+            continue
+        gmm_params.append(fit_gmm(features[idx], n_components, covariance_type=covariance_type, rank=rank,
+                                  max_iter=max_iter, tol=tol, reg_covar=reg_covar, pca_components=pca_components))
+    return gmm_params
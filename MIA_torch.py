@@ -3,8 +3,9 @@ import numpy as np
 import torch.nn as nn
 from torch.serialization import save
 import architectures_torch as architectures
-from utils import setup_logger, accuracy, AverageMeter, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
-from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, prune_top_n_percent_left, dropout_defense, prune_defense
+import defenses
+from utils import setup_logger, accuracy, AverageMeter, DeviceAverageMeter, AsyncCheckpointWriter, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
+from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, IRStoreWriter, FeatureCache, model_state_hash, loader_fingerprint, tensor_store_loader, load_ir_store
 from thop import profile
 import logging
 from torch.autograd import Variable
@@ -170,6 +171,10 @@ class MIA: # main class for every thing
             os.makedirs(tensorboard_path)
         self.writer = SummaryWriter(log_dir=tensorboard_path)
         self.save_activation_tensor = save_activation_tensor
+        # clean client features for the MIA decoder loops, see iter_feat_pairs
+        self.feature_cache = FeatureCache()
+        # RNG for the activation defences (noise / dropout), drawn on the device, reproducible from random_seed
+        self.defense_generator = defenses.make_generator("cuda" if torch.cuda.is_available() else "cpu", random_seed)
 
         # setup logger
         model_log_file = self.save_dir + '/MIA.log'
@@ -591,23 +596,16 @@ class MIA: # main class for every thing
 
         if "Gaussian" in self.regularization_option:
             sigma = self.regularization_strength
-            noise = sigma * torch.randn_like(z_private).cuda()
+            noise = defenses.gaussian_noise(z_private, sigma, generator=self.defense_generator)
             z_private += noise
         # Perform various activation defenses
         if self.local_DP:
-            if "laplace" in self.regularization_option:
-                noise = torch.from_numpy(
-                    np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=z_private.size())).cuda()
-                z_private = z_private + noise.detach().float()
-            else:  # apply gaussian noise
-                delta = 10e-5
-                sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                noise = sigma * torch.randn_like(z_private).cuda()
-                z_private = z_private + noise.detach().float()
+            z_private = z_private + defenses.local_dp_noise(z_private, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                            generator=self.defense_generator)
         if self.dropout_defense:
-            z_private = dropout_defense(z_private, self.dropout_ratio)
+            z_private = defenses.dropout_defense(z_private, self.dropout_ratio, generator=self.defense_generator)
         if self.topkprune:
-            z_private = prune_defense(z_private, self.topkprune_ratio)
+            z_private = defenses.prune_defense(z_private, self.topkprune_ratio)
         if self.gan_noise:
             epsilon = self.alpha2
             
@@ -761,22 +759,16 @@ class MIA: # main class for every thing
                     exit()
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(output).cuda()
+                    noise = defenses.gaussian_noise(output, sigma, generator=self.defense_generator)
                     output += noise
                 '''Optional, Test validation performance with local_DP/dropout (apply DP during query)'''
                 if self.local_DP:
-                    if "laplace" in self.regularization_option:
-                        noise = torch.from_numpy(
-                            np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=output.size())).cuda()
-                    else:  # apply gaussian noise
-                        delta = 10e-5
-                        sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                        noise = sigma * torch.randn_like(output).cuda()
-                    output += noise
+                    output = output + defenses.local_dp_noise(output, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                              generator=self.defense_generator)
                 if self.dropout_defense:
-                    output = dropout_defense(output, self.dropout_ratio)
+                    output = defenses.dropout_defense(output, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune:
-                    output = prune_defense(output, self.topkprune_ratio)
+                    output = defenses.prune_defense(output, self.topkprune_ratio)
             
             '''Optional, Test validation performance with gan_noise (apply gan_noise during query)'''
             if self.gan_noise:
@@ -1286,73 +1278,80 @@ class MIA: # main class for every thing
 
     # generate activation and image pair for training the attacker's inversion model
     def gen_ir(self, val_single_loader, local_model, img_folder="./tmp", intermed_reps_folder="./tmp", all_label=True,
-               select_label=0, attack_from_later_layer=-1, attack_option = "MIA"):
+               select_label=0, attack_from_later_layer=-1, attack_option = "MIA", ir_store = True):
         """
         Generate (Raw Input - Intermediate Representation) Pair for Training of the AutoEncoder
+
+        The client model runs at the loader's batch size. With ir_store=True the pairs (and labels) are written
+        into one contiguous memory-mapped store in intermed_reps_folder (see utils.IRStoreWriter), which
+        apply_transform / apply_transform_test load zero-copy; otherwise one .jpg + one .pt per sample.
         """
 
         # switch to evaluate mode
         local_model.eval()
+        img_folder = os.path.abspath(img_folder)
+        intermed_reps_folder = os.path.abspath(intermed_reps_folder)
+        if not os.path.isdir(intermed_reps_folder):
+            os.makedirs(intermed_reps_folder)
+        if not os.path.isdir(img_folder):
+            os.makedirs(img_folder)
+
+        hook_handle = None
+        activation_4 = {}
+        if attack_from_later_layer > -1 and (not self.confidence_score):
+            self.model.cloud.eval()
+
+            def get_activation_4(name):
+                def hook(model, input, output):
+                    activation_4[name] = output.detach()
+
+                return hook
+
+            # register the hook once (it used to be re-registered, and never removed, for every sample)
+            count = 0
+            for name, m in self.model.cloud.named_modules():
+                if attack_from_later_layer == count:
+                    hook_handle = m.register_forward_hook(get_activation_4("ACT-{}".format(name)))
+                    valid_key = "ACT-{}".format(name)
+                    break
+                count += 1
+
+        writer = IRStoreWriter(intermed_reps_folder, len(val_single_loader.dataset)) if ir_store else None
         file_id = 0
         for i, (input, target) in enumerate(val_single_loader):
-            # input = input.cuda(async=True)
-            input = input.cuda()
-            target = target.item()
             if not all_label:
-                if target != select_label:
+                keep = target == select_label
+                if not keep.any():
                     continue
-
-            img_folder = os.path.abspath(img_folder)
-            intermed_reps_folder = os.path.abspath(intermed_reps_folder)
-            if not os.path.isdir(intermed_reps_folder):
-                os.makedirs(intermed_reps_folder)
-            if not os.path.isdir(img_folder):
-                os.makedirs(img_folder)
+                input, target = input[keep], target[keep]
+            input = input.cuda()
 
             # compute output
             with torch.no_grad():
                 ir = local_model(input)
-            
-            if self.confidence_score:
-                self.model.cloud.eval()
-                ir = self.model.cloud(ir)
-                if "mobilenetv2" in self.arch:
-                    ir = F.avg_pool2d(ir, 4)
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-                elif self.arch == "resnet20" or self.arch == "resnet32":
-                    ir = F.avg_pool2d(ir, 8)
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-                else:
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-            
-            if attack_from_later_layer > -1 and (not self.confidence_score):
-                self.model.cloud.eval()
-
-                activation_4 = {}
 
-                def get_activation_4(name):
-                    def hook(model, input, output):
-                        activation_4[name] = output.detach()
-
-                    return hook
+                if self.confidence_score:
+                    self.model.cloud.eval()
+                    ir = self.model.cloud(ir)
+                    if "mobilenetv2" in self.arch:
+                        ir = F.avg_pool2d(ir, 4)
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
+                    elif self.arch == "resnet20" or self.arch == "resnet32":
+                        ir = F.avg_pool2d(ir, 8)
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
+                    else:
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
 
-                with torch.no_grad():
-                    activation_4 = {}
-                    count = 0
-                    for name, m in self.model.cloud.named_modules():
-                        if attack_from_later_layer == count:
-                            m.register_forward_hook(get_activation_4("ACT-{}".format(name)))
-                            valid_key = "ACT-{}".format(name)
-                            break
-                        count += 1
+                if attack_from_later_layer > -1 and (not self.confidence_score):
+                    activation_4.clear()
                     output = self.model.cloud(ir)
-                try:
-                    ir = activation_4[valid_key]
-                except:
-                    print("cannot attack from later layer, server-side model is empty or does not have enough layers")
+                    try:
+                        ir = activation_4[valid_key]
+                    except:
+                        print("cannot attack from later layer, server-side model is empty or does not have enough layers")
             ir = ir.float()
 
             if "truncate" in attack_option:
@@ -1361,15 +1360,22 @@ class MIA: # main class for every thing
                 except:
                     print("auto extract percentage fail. Use default percentage_left = 20")
                     percentage_left = 20
-                ir = prune_top_n_percent_left(ir, percentage_left)
+                ir = defenses.prune_top_n_percent_left(ir, percentage_left)
 
-            inp_img_path = "{}/{}.jpg".format(img_folder, file_id)
-            out_tensor_path = "{}/{}.pt".format(intermed_reps_folder, file_id)
-            
             input = denormalize(input, self.dataset)
-            save_image(input, inp_img_path)
-            torch.save(ir.cpu(), out_tensor_path)
-            file_id += 1
+            if ir_store:
+                # clamp as save_image did, but keep full precision (no JPEG round-trip)
+                writer.append(input.clamp(0, 1), ir, target)
+                file_id = writer.count
+            else:
+                for j in range(input.size(0)):
+                    save_image(input[j:j + 1], "{}/{}.jpg".format(img_folder, file_id))
+                    torch.save(ir[j:j + 1].cpu(), "{}/{}.pt".format(intermed_reps_folder, file_id))
+                    file_id += 1
+        if writer is not None:
+            writer.close()
+        if hook_handle is not None:
+            hook_handle.remove()
         print("Overall size of Training/Validation Datset for AE is {}: {}".format(int(file_id * 0.9),
                                                                                    int(file_id * 0.1)))
 
@@ -1382,6 +1388,31 @@ class MIA: # main class for every thing
         input = denormalize(input, self.dataset)
         return input,ir
 
+    def iter_feat_pairs(self, loader, local_model, feature_cache=True, model_key=None):
+        """
+        Yield (img, ir, target) batches for the decoder loops.
+        With feature_cache the frozen client model runs once per (checkpoint hash, split, cut layer) and later
+        epochs replay the cached clean features (shuffled if the loader shuffles); defence noise is added by the
+        caller on top, fresh every epoch.
+        model_key: model_state_hash(local_model), computed once by the caller (hashing copies every state_dict
+        tensor to the host); only computed here if not given.
+        """
+        if not feature_cache:
+            for input, target in loader:
+                img, ir = self.gen_inp_feat_pair(input, local_model)
+                yield img, ir, target
+            return
+        if model_key is None:
+            model_key = model_state_hash(local_model)
+        key = (model_key, loader_fingerprint(loader), self.cutting_layer)
+        dataset = self.feature_cache.get(key, loader, lambda input: self.gen_inp_feat_pair(input, local_model))
+        if isinstance(loader.sampler, torch.utils.data.RandomSampler):
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+        for img, ir, target in tensor_store_loader(dataset, loader.batch_size, sampler):
+            yield img, ir, target
+
 # pre-train a GAN with local data before SFL training
     def pre_GAN_train(self, num_epochs, select_client_list=[0]):
 
@@ -1419,19 +1450,19 @@ class MIA: # main class for every thing
                 rmtree(tensor_data_dir)
 
             if self.dataset == "cifar100":
-                val_loader, val_train_loader, val_test_loader= get_cifar100_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_loader, val_train_loader, val_test_loader= get_cifar100_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "cifar10":
-                val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "svhn":
-                val_single_loader, _, _ = get_SVHN_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_single_loader, _, _ = get_SVHN_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "mnist":
-                _, val_single_loader = get_mnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_mnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "fmnist":
-                _, val_single_loader = get_fmnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_fmnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "facescrub":
-                _, val_single_loader = get_facescrub_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_facescrub_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "tinyimagenet":
-                _, val_single_loader = get_tinyimagenet_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_tinyimagenet_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
 
             attack_path = self.save_dir + '/MIA_attack_{}to{}'.format(client_id, client_id)
             if not os.path.isdir(attack_path):
@@ -1512,21 +1543,21 @@ class MIA: # main class for every thing
             rmtree(tensor_data_dir)
 
         if self.dataset == "cifar100":
-            _, train_single_loader, train_single_loader_irg = get_cifar100_trainloader(batch_size=1, num_workers=4, shuffle=False)
+            _, train_single_loader, train_single_loader_irg = get_cifar100_trainloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "cifar10":
-            _, train_single_loader, train_single_loader_irg = get_cifar10_trainloader(batch_size=1, num_workers=4, shuffle=True)
-            # val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=1, num_workers=4, shuffle=True)
+            _, train_single_loader, train_single_loader_irg = get_cifar10_trainloader(batch_size=attack_batchsize, num_workers=4, shuffle=True)
+            # val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=True)
         elif self.dataset == "svhn":
-            val_single_loader, _, _ = get_SVHN_testloader(batch_size=1, num_workers=4, shuffle=False)
+            val_single_loader, _, _ = get_SVHN_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "mnist":
-            _, val_single_loader = get_mnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_mnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "fmnist":
-            _, val_single_loader = get_fmnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_fmnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "facescrub":
-            _, _,_,_,train_single_loader_irg = get_facescrub_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, _,_,_,train_single_loader_irg = get_facescrub_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             # facescrub_training_loader, facescrub_testing_loader,facescrub_training_loader_AT, facescrub_testing_loader_AT,facescrub_testing_loader_val
         elif self.dataset == "tinyimagenet":
-            _, val_single_loader = get_tinyimagenet_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_tinyimagenet_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
 
         attack_path = self.save_dir + '/{}_attack_{}to{}'.format(attack_option, collude_client, target_client)
         if not os.path.isdir(attack_path):
@@ -1549,16 +1580,14 @@ class MIA: # main class for every thing
                     attack_from_later_layer=attack_from_later_layer, attack_option = attack_option)
             print(image_data_dir,tensor_data_dir)
 
-            for filename in os.listdir(tensor_data_dir):
-                if ".pt" in filename:
-                    sampled_tensor = torch.load(tensor_data_dir + "/" + filename)
-                    input_nc = sampled_tensor.size()[1]
-                    try:
-                        input_dim = sampled_tensor.size()[2]
-                    except:
-                        print("Extract input dimension fialed, set to 0")
-                        input_dim = 0
-                    break
+            # activation shape from the IR store header, [N, C, H, W] (or [N, C] for confidence scores)
+            sampled_tensor = load_ir_store(tensor_data_dir, with_label=False).tensors[1]
+            input_nc = sampled_tensor.size()[1]
+            try:
+                input_dim = sampled_tensor.size()[2]
+            except:
+                print("Extract input dimension fialed, set to 0")
+                input_dim = 0
             if self.dataset == "cifar10":
                 _, train_single_loader, train_single_loader_irg = get_cifar10_trainloader(batch_size=attack_batchsize, num_workers=4, shuffle=True)
                 val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=True)
@@ -1779,11 +1808,17 @@ class MIA: # main class for every thing
 
     # This function means performing training of the attacker's inversion model, is used in MIA_attack function.
     def attack(self, num_epochs, local_model, decoder, optimizer,scheduler, trainloader, testloader, logger, path_dict, batch_size,
-               loss_type="MSE", pretrained_decoder=None, noise_aware=False):
+               loss_type="MSE", pretrained_decoder=None, noise_aware=False, feature_cache=True, recon_acc_freq=10):
+        """
+        Train the inversion decoder. Losses / accuracies are accumulated on the device and read once per epoch,
+        the reconstruction accuracy (re-inference of the reconstructions) only runs every recon_acc_freq epochs
+        and on the last one, and best checkpoints are written asynchronously.
+        """
         round_ = 0
         min_val_loss = 999.
         max_val_loss = 0.
         train_output_freq = 10
+        ckpt_writer = AsyncCheckpointWriter()
 
 
         # Optimize based on MSE distance
@@ -1801,37 +1836,30 @@ class MIA: # main class for every thing
         
         device = next(decoder.parameters()).device
         decoder.train()
+        # the client model is frozen during the attack: hash it once for the feature cache
+        model_key = model_state_hash(local_model) if feature_cache else None
 
         for epoch in range(round_ * num_epochs, (round_ + 1) * num_epochs):
-            train_losses = AverageMeter()
-            val_losses = AverageMeter()
+            train_losses = DeviceAverageMeter()
+            val_losses = DeviceAverageMeter()
             val_losses_white = AverageMeter()
-            for i, (input, target) in enumerate(trainloader):
-                input = input.cuda()
-                img, ir=self.gen_inp_feat_pair(input,local_model)
-                # img, ir = data
-                img, ir = img.type(torch.FloatTensor), ir.type(torch.FloatTensor)
-                img, ir = Variable(img).to(device), Variable(ir).to(device)
+            for i, (img, ir, target) in enumerate(self.iter_feat_pairs(trainloader, local_model, feature_cache, model_key)):
+                img, ir = img.to(device, non_blocking=True).float(), ir.to(device, non_blocking=True).float()
                 # print(img)
                 # Use local DP for training the AE.
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(ir).cuda()
+                    noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                     ir += noise
 
                 if self.local_DP and noise_aware:
                     with torch.no_grad():
-                        if "laplace" in self.regularization_option:
-                            ir += torch.from_numpy(
-                                np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=ir.size())).cuda()
-                        else:  # apply gaussian noise
-                            delta = 10e-5
-                            sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                            ir += sigma * torch.randn_like(ir).cuda()
+                        ir = ir + defenses.local_dp_noise(ir, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                          generator=self.defense_generator)
                 if self.dropout_defense and noise_aware:
-                    ir = dropout_defense(ir, self.dropout_ratio)
+                    ir = defenses.dropout_defense(ir, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune and noise_aware:
-                    ir = prune_defense(ir, self.topkprune_ratio)
+                    ir = defenses.prune_defense(ir, self.topkprune_ratio)
                 if pretrained_decoder is not None and "gan_adv_noise" in self.regularization_option and noise_aware:
                     epsilon = self.alpha2
                     
@@ -1870,7 +1898,7 @@ class MIA: # main class for every thing
                 train_loss.backward()
                 optimizer.step()
 
-                train_losses.update(train_loss.item(), ir.size(0))
+                train_losses.update(train_loss, ir.size(0))
                 # if i %50 ==0:
                 #     print('iter:',i,'loss:',train_loss.item())
             scheduler.step()
@@ -1878,42 +1906,41 @@ class MIA: # main class for every thing
             print(f"Epoch {epoch+1}, Current LR: {current_lr}")
             if (epoch + 1) % train_output_freq == 0:
                 save_images(img, output, epoch, path_dict["train_output_path"], offset=0, batch_size=batch_size)
-            top1 = AverageMeter()
-            for i, (input, target) in enumerate(testloader):
-                input = input.cuda()
-                img, ir=self.gen_inp_feat_pair(input,local_model)
+            top1 = DeviceAverageMeter()
+            check_acc = (epoch + 1) % recon_acc_freq == 0 or epoch + 1 == (round_ + 1) * num_epochs
+            best_val_loss = None
+            for i, (img, ir, target) in enumerate(self.iter_feat_pairs(testloader, local_model, feature_cache, model_key)):
                 # decoder.eval()
-                # img, ir = data
-                img, ir = img.type(torch.FloatTensor), ir.type(torch.FloatTensor)
-                img, ir = Variable(img).to(device), Variable(ir).to(device)
+                img, ir = img.to(device, non_blocking=True).float(), ir.to(device, non_blocking=True).float()
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(ir).cuda()
+                    noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                     ir += noise
-                output = decoder(ir)
+                with torch.no_grad():
+                    output = decoder(ir)
                 criterion_test = nn.MSELoss()
                 reconstruction_loss = criterion_test(output, img)
                 ####test_reconstruction acc 
-                rec_inputs = normalize(output)
-                pred = self.model.local_list[0](rec_inputs)
-                with torch.no_grad():
-                    pred = self.f_tail(pred)
-
-                    if "mobilenetv2" in self.arch:
-                        pred = F.avg_pool2d(pred, 4)
-                        pred = pred.view(pred.size(0), -1)
-                        pred = self.classifier(pred)
-                    elif self.arch == "resnet20" or self.arch == "resnet32":
-                        pred = F.avg_pool2d(pred, 8)
-                        pred = pred.view(pred.size(0), -1)
-                        pred = self.classifier(pred)
-                    else:
-                        pred = pred.view(pred.size(0), -1)
-                        pred = self.classifier(pred)
-                prec1 = accuracy(pred.data, target)[
-                0] 
-                top1.update(prec1.item(), input.size(0))
-                print('the pred acc is:',top1.avg)
+                if check_acc:
+                    with torch.no_grad():
+                        rec_inputs = self.normalize(output.clone())
+                        pred = self.model.local_list[0](rec_inputs)
+                        pred = self.f_tail(pred)
+
+                        if "mobilenetv2" in self.arch:
+                            pred = F.avg_pool2d(pred, 4)
+                            pred = pred.view(pred.size(0), -1)
+                            pred = self.classifier(pred)
+                        elif self.arch == "resnet20" or self.arch == "resnet32":
+                            pred = F.avg_pool2d(pred, 8)
+                            pred = pred.view(pred.size(0), -1)
+                            pred = self.classifier(pred)
+                        else:
+                            pred = pred.view(pred.size(0), -1)
+                            pred = self.classifier(pred)
+                    prec1 = accuracy(pred.data, target.to(pred.device, non_blocking=True))[
+                    0] 
+                    top1.update(prec1, img.size(0))
                 whitebox_con=0
                 # whitebox_con=
                 if whitebox_con==1:
@@ -1922,23 +1949,33 @@ class MIA: # main class for every thing
                     val_losses_white.update(val_loss_white.item(), ir.size(0))
                 val_loss = reconstruction_loss
 
-                if loss_type == "MSE" and val_loss < min_val_loss:
-                    min_val_loss = val_loss
-                    torch.save(decoder.state_dict(), path_dict["model_path"])
-                elif loss_type == "SSIM" and val_loss > max_val_loss:
-                    max_val_loss = val_loss
-                    torch.save(decoder.state_dict(), path_dict["model_path"])
-                elif loss_type == "PSNR" and val_loss > max_val_loss:
-                    max_val_loss = val_loss
-                    torch.save(decoder.state_dict(), path_dict["model_path"])
-                val_losses.update(val_loss.item(), ir.size(0))
+                # the decoder does not change during validation, so the best batch of the epoch decides
+                # whether this epoch's decoder is saved (same checkpoint as comparing batch by batch)
+                if best_val_loss is None:
+                    best_val_loss = val_loss.detach()
+                elif loss_type == "MSE":
+                    best_val_loss = torch.minimum(best_val_loss, val_loss.detach())
+                else:
+                    best_val_loss = torch.maximum(best_val_loss, val_loss.detach())
+                val_losses.update(val_loss, ir.size(0))
 
-                self.writer.add_scalar('decoder_loss/val', val_loss.item(), len(testloader) * epoch + i)
-                self.writer.add_scalar('decoder_loss/val_loss/reconstruction', reconstruction_loss.item(),
-                                       len(testloader) * epoch + i)
+            if check_acc:
+                print('the pred acc is:',top1.avg)
+            if best_val_loss is not None:
+                best_val_loss = best_val_loss.item()
+                if loss_type == "MSE" and best_val_loss < min_val_loss:
+                    min_val_loss = best_val_loss
+                    ckpt_writer.save(decoder.state_dict(), path_dict["model_path"])
+                elif loss_type in ["SSIM", "PSNR"] and best_val_loss > max_val_loss:
+                    max_val_loss = best_val_loss
+                    ckpt_writer.save(decoder.state_dict(), path_dict["model_path"])
+
+            self.writer.add_scalar('decoder_loss/val', val_losses.avg, epoch)
+            self.writer.add_scalar('decoder_loss/val_loss/reconstruction', val_losses.avg, epoch)
 
-            for name, param in decoder.named_parameters():
-                self.writer.add_histogram("decoder_params/{}".format(name), param.clone().cpu().data.numpy(), epoch)
+            if (epoch + 1) % train_output_freq == 0:
+                for name, param in decoder.named_parameters():
+                    self.writer.add_histogram("decoder_params/{}".format(name), param.clone().cpu().data.numpy(), epoch)
 
             # torch.save(decoder.state_dict(), path_dict["model_path"])
             if whitebox_con==1:
@@ -1951,6 +1988,7 @@ class MIA: # main class for every thing
                     "epoch [{}/{}], train_loss {train_losses.val:.4f} ({train_losses.avg:.4f}), val_loss {val_losses.val:.4f} ({val_losses.avg:.4f})".format(
                         epoch + 1,
                         num_epochs, train_losses=train_losses, val_losses=val_losses))                
+        ckpt_writer.join()
         if loss_type == "MSE":
             logger.debug("Best Validation Loss is {}".format(min_val_loss))
         elif loss_type == "SSIM":
@@ -2005,7 +2043,7 @@ class MIA: # main class for every thing
                 gen_ir= model(X_rec)
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(gen_ir).cuda()
+                    noise = defenses.gaussian_noise(gen_ir, sigma, generator=self.defense_generator)
                     gen_ir = gen_ir + noise
 
                 # loss = nn.MSELoss()(10*gen_ir.cuda(), 10*feature)
@@ -2051,7 +2089,7 @@ class MIA: # main class for every thing
 
     # This function means testing of the attacker's inversion model
     def test_attack(self, num_epochs, local_model,decoder, sp_testloader, logger, path_dict, batch_size, num_classes=10,
-                    select_label=0,sp_not=0):
+                    select_label=0,sp_not=0, feature_cache=True):
         device = next(decoder.parameters()).device
         # # print("Load the best Decoder Model...")
         # new_state_dict = torch.load(path_dict["model_path"])
@@ -2064,16 +2102,14 @@ class MIA: # main class for every thing
         ssim_loss = pytorch_ssim.SSIM()
 
         criterion = nn.MSELoss()
+        model_key = model_state_hash(local_model) if feature_cache else None
 
-        for i, (input, target) in enumerate(sp_testloader):
-            input = input.cuda()
-            img, ir=self.gen_inp_feat_pair(input,local_model)
+        for i, (img, ir, target) in enumerate(self.iter_feat_pairs(sp_testloader, local_model, feature_cache, model_key)):
             decoder.eval()
-            img, ir = img.type(torch.FloatTensor), ir.type(torch.FloatTensor)
-            img, ir = Variable(img).to(device), Variable(ir).to(device)
+            img, ir = img.to(device, non_blocking=True).float(), ir.to(device, non_blocking=True).float()
             if "Gaussian" in self.regularization_option:
                 sigma = self.regularization_strength
-                noise = sigma * torch.randn_like(ir).cuda()
+                noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                 ir += noise
             output_imgs = decoder(ir)
             reconstruction_loss = criterion(output_imgs, img)
@@ -2187,18 +2223,12 @@ class MIA: # main class for every thing
             #     # noise = 10000*sigma * torch.randn_like(save_activation).cuda()
             #     save_activation += noise
             if self.local_DP and not clean_option:  # local DP or additive noise
-                if "laplace" in self.regularization_option:
-                    save_activation += torch.from_numpy(
-                        np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=save_activation.size())).cuda()
-                    # the addtive work uses scale in (0.1 0.5 1.0) -> (1 2 10) regularization_strength (self.dp_epsilon)
-                else:  # apply gaussian noise
-                    delta = 10e-5
-                    sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                    save_activation += sigma * torch.randn_like(save_activation).cuda()
+                save_activation = save_activation + defenses.local_dp_noise(save_activation, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                                            generator=self.defense_generator)
             if self.dropout_defense and not clean_option:  # activation dropout defense
-                save_activation = dropout_defense(save_activation, self.dropout_ratio)
+                save_activation = defenses.dropout_defense(save_activation, self.dropout_ratio, generator=self.defense_generator)
             if self.topkprune and not clean_option:
-                save_activation = prune_defense(save_activation, self.topkprune_ratio)
+                save_activation = defenses.prune_defense(save_activation, self.topkprune_ratio)
             
             img = denormalize(img, self.dataset)
                 
@@ -2223,7 +2253,7 @@ class MIA: # main class for every thing
 
                 save_activation = save_activation - grad.detach() * epsilon
             if "truncate" in attack_option:
-                save_activation = prune_top_n_percent_left(save_activation)
+                save_activation = defenses.prune_top_n_percent_left(save_activation)
             
             save_activation = save_activation.float()
             
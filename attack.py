@@ -1,4 +1,4 @@
-import torch, os, time, random
+import torch, os, time
 from GMI import generator, discri
 import numpy as np
 import torch.nn as nn
@@ -11,6 +11,7 @@ from datasets_torch import get_cifar100_trainloader, get_cifar100_testloader, ge
     get_cifar10_testloader, get_mnist_bothloader, get_facescrub_bothloader, get_SVHN_trainloader, get_SVHN_testloader, get_fmnist_bothloader, get_tinyimagenet_bothloader,get_imagenet_bothloader
 from model_architectures.vgg import vgg11, vgg13, vgg11_bn, vgg13_bn,vgg11_bn_sgm
 from utils import setup_logger, accuracy, AverageMeter
+import defenses
 device = "cuda"
 
 import sys
@@ -108,11 +109,26 @@ def load_from_checkpoint(args,path,model):
     print(model)
     return model
 
+def eval_identity(args, E, fake):
+    if args.dataset == 'celeba':
+        return E(utils.low2high(fake))[-1]
+    return E(fake) #[-1]
+
+
 def inversion(args, G, D, T, E, imgs, iden, lr=2e-2, momentum=0.9, lamda=100, iter_times=1500,
-              clip_range=1, num_seeds=5, verbose=False):
+              clip_range=1, num_seeds=5, verbose=False, seed_batch=None):
+    """
+    Latent optimisation for all seeds at once.
+
+    The latents of seed_batch seeds (default: all) are stacked along the batch dimension, [seeds * bs, dim], and
+    optimised together; every seed draws its initial noise from its own generator (same stream as seeding the
+    global CUDA RNG with the seed). The loss is the sum of the per-seed losses, so each seed follows exactly the
+    trajectory it had when optimised alone. Accuracies and the best seed per identity are evaluated on the GPU and
+    the images are written once at the end.
+    """
     print(iden)
     # iden = iden.view(-1).long().cuda()
-    criterion = nn.CrossEntropyLoss().cuda()
+    criterion = nn.CrossEntropyLoss(reduction='none').cuda()
     bs = iden.shape[0]
     imgs=imgs.cuda()
     iden=iden.cuda()
@@ -121,44 +137,37 @@ def inversion(args, G, D, T, E, imgs, iden, lr=2e-2, momentum=0.9, lamda=100, it
     T.eval().cuda()
     E.eval().cuda()
 
-    flag = torch.zeros(bs)
+    with torch.no_grad():
+        model.eval()
+        encoder = model.local_list[0].cuda()
+        z_clean = encoder(imgs).view(imgs.size(0),-1)
+    sigma = args.regularization_strength
+    seed_batch = seed_batch or num_seeds
 
-    res = []
-    res5 = []
-    for random_seed in range(num_seeds):
+    fakes, eval_probs = [], []
+    for start in range(0, num_seeds, seed_batch):
         tf = time.time()
-
-        torch.manual_seed(random_seed)
-        torch.cuda.manual_seed(random_seed)
-        np.random.seed(random_seed)
-        random.seed(random_seed)
-
-        with torch.no_grad():
-            model.eval()
-            encoder = model.local_list[0].cuda()
-            z=encoder(imgs).view(imgs.size(0),-1)
-            sigma = args.regularization_strength
-            noise = sigma * torch.randn_like(z).cuda()
-            # noise = 10000*sigma * torch.randn_like(save_activation).cuda()
-            z += noise
+        seeds = range(start, min(start + seed_batch, num_seeds))
+        S = len(seeds)
+        noise = torch.stack([defenses.gaussian_noise(z_clean, sigma, generator=defenses.make_generator(z_clean.device, random_seed))
+                             for random_seed in seeds])
+        z = (z_clean.unsqueeze(0) + noise).view(S * bs, -1)
         z.requires_grad = True
-        # print(z.shape)
-        v = torch.zeros(bs, z.shape[-1]).cuda().float()
+        target = iden.repeat(S)
+        v = torch.zeros_like(z)
 
         for i in range(iter_times):
             fake = G(z)
-            # print(fake.shape)
             label = D(fake)
-            # print(label)
             out = T(fake) #[-1]
 
             if z.grad is not None:
                 z.grad.data.zero_()
 
-            Prior_Loss = - label.mean()
-            # print(out.shape)
-            Iden_Loss = criterion(out, iden)
-            Total_Loss = Prior_Loss + lamda * Iden_Loss
+            # [S] per-seed losses (means over the seed's bs samples)
+            Prior_Loss = - label.view(S, -1).mean(dim=1)
+            Iden_Loss = criterion(out, target).view(S, bs).mean(dim=1)
+            Total_Loss = (Prior_Loss + lamda * Iden_Loss).sum()
 
             Total_Loss.backward()
 
@@ -169,58 +178,48 @@ def inversion(args, G, D, T, E, imgs, iden, lr=2e-2, momentum=0.9, lamda=100, it
             z = torch.clamp(z.detach(), -clip_range, clip_range).float()
             z.requires_grad = True
 
-            Prior_Loss_val = Prior_Loss.item()
-            Iden_Loss_val = Iden_Loss.item()
-
             if verbose:
                 if (i + 1) % 500 == 0:
-                    fake_img = G(z.detach())
-
-                    if args.dataset == 'celeba':
-                        eval_prob = E(utils.low2high(fake_img))[-1]
-                    else:
-                        eval_prob = E(fake_img)[-1]
-
-                    eval_iden = torch.argmax(eval_prob, dim=1).view(-1)
-                    acc = iden.eq(eval_iden.long()).sum().item() * 100.0 / bs
+                    with torch.no_grad():
+                        eval_iden = torch.argmax(eval_identity(args, E, G(z)), dim=1).view(-1)
+                    acc = target.eq(eval_iden.long()).float().mean().item() * 100.0
                     print("Iteration:{}\tPrior Loss:{:.2f}\tIden Loss:{:.2f}\tAttack Acc:{:.2f}".format(i + 1,
-                                                                                                        Prior_Loss_val,
-                                                                                                        Iden_Loss_val,
+                                                                                                        Prior_Loss.mean().item(),
+                                                                                                        Iden_Loss.mean().item(),
                                                                                                         acc))
 
-        fake = G(z)
-        if args.dataset == 'celeba':
-            eval_prob = E(utils.low2high(fake))[-1]
-        else:
-            eval_prob = E(fake) #[-1]
-
-        eval_iden = torch.argmax(eval_prob, dim=1).view(-1)
-        cnt, cnt5 = 0, 0
-        for i in range(bs):
-            gt = iden[i].item()
-
-            sample = fake[i]
-            save_tensor_images(sample.detach(),
-                               os.path.join(args.save_img_dir,
-                                            "attack_iden_{:03d}|{}.png".format(gt + 1, random_seed + 1)))
-
-            if eval_iden[i].item() == gt:
-                cnt += 1
-                flag[i] = 1
-                best_img = G(z)[i]
-                save_tensor_images(best_img.detach(),
-                                   os.path.join(args.success_dir,
-                                                "attack_iden_{:03d}|{}.png".format(gt + 1, random_seed + 1)))
-
-            _, top5_idx = torch.topk(eval_prob[i], 5)
-            if gt in top5_idx:
-                cnt5 += 1
-
-        res.append(cnt * 100.0 / bs)
-        res5.append(cnt5 * 100.0 / bs)
-        torch.cuda.empty_cache()
+        with torch.no_grad():
+            fake = G(z)
+            eval_prob = eval_identity(args, E, fake)
+        fakes.append(fake.view(S, bs, *fake.shape[1:]))
+        eval_probs.append(eval_prob.view(S, bs, -1))
         interval = time.time() - tf
-        print("Time:{:.2f}\tAcc:{:.2f}\t".format(interval, cnt * 100.0 / bs))
+        print("Time:{:.2f}\tSeeds:{}-{}".format(interval, start + 1, start + S))
+
+    fake = torch.cat(fakes)  # [num_seeds, bs, C, H, W]
+    eval_prob = torch.cat(eval_probs)  # [num_seeds, bs, num_classes]
+    correct = torch.argmax(eval_prob, dim=2).eq(iden.unsqueeze(0))
+    correct5 = torch.topk(eval_prob, 5, dim=2).indices.eq(iden.view(1, bs, 1)).any(dim=2)
+    # best seed per identity: highest evaluation confidence in the target identity
+    confidence = eval_prob.softmax(dim=2).gather(2, iden.view(1, bs, 1).expand(num_seeds, bs, 1)).squeeze(2)
+    best_seed = confidence.argmax(dim=0)
+
+    # per-image min/max normalisation (what save_tensor_images(normalize=True) does), one transfer to the host
+    flat = fake.flatten(2)
+    low, high = flat.min(dim=2).values, flat.max(dim=2).values
+    fake = ((fake - low.view(num_seeds, bs, 1, 1, 1)) / (high - low).clamp_min(1e-5).view(num_seeds, bs, 1, 1, 1)).cpu()
+    res = (correct.float().mean(dim=1) * 100.0).tolist()
+    res5 = (correct5.float().mean(dim=1) * 100.0).tolist()
+    correct, best_seed, gts = correct.cpu(), best_seed.cpu(), iden.tolist()
+    for random_seed in range(num_seeds):
+        for i in range(bs):
+            name = "attack_iden_{:03d}|{}.png".format(gts[i] + 1, random_seed + 1)
+            save_tensor_images(fake[random_seed, i], os.path.join(args.save_img_dir, name), normalize=False)
+            if correct[random_seed, i]:
+                save_tensor_images(fake[random_seed, i], os.path.join(args.success_dir, name), normalize=False)
+    save_tensor_images(fake[best_seed, torch.arange(bs)],
+                       os.path.join(args.success_dir, "best_iden_{:03d}-{:03d}.png".format(gts[0] + 1, gts[-1] + 1)),
+                       nrow=bs, normalize=False)
 
     acc = statistics.mean(res)
     acc_5 = statistics.mean(res5)
@@ -239,6 +238,8 @@ if __name__ == '__main__':
     # parser.add_argument('--model_path', default='../BiDO/target_model')
     parser.add_argument('--verbose', action='store_true', help='')
     parser.add_argument('--iter', default=3000, type=int)
+    parser.add_argument('--num_seeds', default=100, type=int)
+    parser.add_argument('--seed_batch', default=0, type=int, help='seeds optimised together (0: all)')
 
     parser.add_argument('--dataset', default='cifar10', help='cifar10 | facescrub')
     parser.add_argument('--arch', default='vgg11_bn_sgm')
@@ -473,7 +474,8 @@ if __name__ == '__main__':
             iden = torch.from_numpy(np.arange(5))
             print(iden)
             acc, acc5, var, var5 = inversion(args, G, D, T, E,imgs, target, lr=0.01, lamda=100,
-                                                iter_times=args.iter, num_seeds=100, verbose=args.verbose)
+                                                iter_times=args.iter, num_seeds=args.num_seeds, verbose=args.verbose,
+                                                seed_batch=args.seed_batch)
             aver_acc += acc / K
             aver_acc5 += acc5 / K
             aver_var += var / K
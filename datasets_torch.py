@@ -14,6 +14,12 @@ from torch.utils.data import TensorDataset, sampler, DataLoader
 import urllib
 import tarfile
 import os
+import math
+import copy
+from collections import OrderedDict
+import json
+from PIL import Image
+from defenses import make_generator
 BUFFER_SIZE = 10000
 SIZE = 32
 
@@ -141,6 +147,404 @@ def noniid_alllabel(dataset, num_users, noniid_ratio = 0.2, num_class = 10):
 
     return dict_users_labeled
 
+# ============================================================================
+# Dataset registry
+# Every raw split (cifar10 / cifar100 / svhn, train / test) is decoded once per process. A DatasetHandle is a
+# shallow copy of the raw torchvision dataset with its own transform (the image arrays are shared), and
+# DatasetHandle.view() returns DataLoaders over index subsets of it. Views are cached: asking again for the same
+# (batch_size, shuffle, subset, num_workers) returns the same loader, whose worker pool is persistent. Each handle
+# keeps at most MAX_CACHED_VIEWS views (least recently used dropped first); close() / clear_views() shut the
+# worker pools down.
+# ============================================================================
+
+MAX_CACHED_VIEWS = 8
+
+_raw_splits = {}
+_dataset_handles = {}
+
+
+def _release_loader(loader):
+    # shut down the persistent workers of a DataLoader (rebuilt on the next iter() if it is used again)
+    iterator = getattr(loader, "_iterator", None)
+    if iterator is not None and hasattr(iterator, "_shutdown_workers"):
+        iterator._shutdown_workers()
+    loader._iterator = None
+
+
+def raw_split(name, train=True):
+    """Untransformed torchvision dataset of a split, loaded once per process."""
+    key = (name, train)
+    if key not in _raw_splits:
+        if name == "cifar10":
+            _raw_splits[key] = torchvision.datasets.CIFAR10(root='./data', train=train, download=True)
+        elif name == "cifar100":
+            _raw_splits[key] = torchvision.datasets.CIFAR100(root='./data', train=train, download=True)
+        elif name == "svhn":
+            _raw_splits[key] = torchvision.datasets.SVHN(root='./data', split='train' if train else 'test', download=True)
+        else:
+            raise ValueError("dataset {} is not in the registry".format(name))
+    return _raw_splits[key]
+
+
+class DatasetHandle(object):
+    """
+    One split with one transform (dataset: the torchvision dataset object, shared arrays). view() builds
+    DataLoaders over it; equal views are built once and shared.
+    """
+    def __init__(self, dataset, max_views=None):
+        self.dataset = dataset
+        self.max_views = MAX_CACHED_VIEWS if max_views is None else max_views
+        self._views = OrderedDict()
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def view(self, batch_size=16, shuffle=True, subset=None, num_workers=2):
+        """
+        DataLoader over the whole split (subset=None) or torch.utils.data.Subset(dataset, subset).
+
+        The same view is returned for equal arguments, so callers must not iterate one view from two places at
+        once (iter() on a loader with persistent workers resets the running iterator). A view dropped from the
+        cache (more than max_views) keeps working; its workers exit once the caller releases it.
+        """
+        if subset is None:
+            subset_key = None
+        elif isinstance(subset, range):
+            subset_key = ("range", subset.start, subset.stop, subset.step)
+        else:
+            subset = [int(i) for i in subset]
+            subset_key = tuple(subset)
+        key = (batch_size, shuffle, subset_key, num_workers)
+        if key not in self._views:
+            dataset = self.dataset if subset is None else torch.utils.data.Subset(self.dataset, list(subset))
+            self._views[key] = DataLoader(dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                                          persistent_workers=num_workers > 0)
+            while len(self._views) > self.max_views:
+                self._views.popitem(last=False)
+        self._views.move_to_end(key)
+        return self._views[key]
+
+    def close(self):
+        """Shut down the worker pools of all cached views and empty the cache."""
+        for loader in self._views.values():
+            _release_loader(loader)
+        self._views.clear()
+
+
+def _transform_key(transform):
+    # repr() identifies the torchvision transforms by their parameters, so the Compose objects rebuilt by every
+    # loader factory share a key; a Lambda prints as "Lambda()" whatever it does, so those are keyed by identity
+    # (the handle keeps the transform alive, the id is not reused)
+    parts = transform.transforms if isinstance(transform, transforms.Compose) else [transform]
+    if any(isinstance(t, transforms.Lambda) for t in parts):
+        return ("id", id(transform))
+    return repr(transform)
+
+
+def dataset_handle(name, train=True, transform=None):
+    """
+    DatasetHandle of split (name, train) with transform. Handles are keyed on repr(transform), so the
+    transforms.Compose objects rebuilt by every loader factory map to the same handle; transforms containing a
+    transforms.Lambda are keyed on the object itself.
+    """
+    key = (name, train, _transform_key(transform))
+    if key not in _dataset_handles:
+        dataset = copy.copy(raw_split(name, train))
+        dataset.transform = transform
+        _dataset_handles[key] = DatasetHandle(dataset)
+    return _dataset_handles[key]
+
+
+def clear_views():
+    """Release the cached views (and their worker processes) of every dataset handle, e.g. between attack stages."""
+    for handle in _dataset_handles.values():
+        handle.close()
+
+
+# ============================================================================
+# Tensor-resident training loaders (CIFAR-10 / CIFAR-100 / SVHN)
+# The whole uint8 dataset lives on the GPU (or in pinned host memory) and the training augmentation
+# (RandomCrop + RandomHorizontalFlip + RandomRotation + ToTensor + Normalize) runs as batched tensor ops with a
+# seeded generator, instead of per-sample PIL transforms in DataLoader workers.
+# ============================================================================
+
+_resident_cache = {}
+
+
+def load_resident_dataset(name, train=True, resident="gpu"):
+    """
+    uint8 images [N, C, H, W] and int64 labels [N] of cifar10 / cifar100 / svhn, moved to the GPU (resident="gpu")
+    or pinned host memory (resident="pinned"). Cached, so all loaders of a run share one copy.
+    """
+    key = (name, train, resident)
+    if key in _resident_cache:
+        return _resident_cache[key]
+    raw = raw_split(name, train)
+    if name == "svhn":
+        data, labels = torch.from_numpy(raw.data).contiguous(), torch.from_numpy(raw.labels)
+    else:
+        data, labels = torch.from_numpy(raw.data).permute(0, 3, 1, 2).contiguous(), torch.tensor(raw.targets)
+    labels = labels.long()
+    if resident == "gpu":
+        data, labels = data.cuda(), labels.cuda()
+    elif resident == "pinned":
+        if torch.cuda.is_available():
+            data, labels = data.pin_memory(), labels.pin_memory()
+    else:
+        raise ValueError("resident must be 'gpu' or 'pinned', got {}".format(resident))
+    _resident_cache[key] = (data, labels)
+    return data, labels
+
+
+class TensorAugmentation(object):
+    """
+    Batched equivalent of RandomCrop(H, padding) + RandomHorizontalFlip() + RandomRotation(degrees) + ToTensor()
+    + Normalize(mean, std) on uint8 images [B, C, H, W].
+
+    Crop offset, flip and rotation of every sample are folded into one affine grid and sampled once with nearest
+    interpolation and zero fill, as the PIL transforms do. train=False only converts and normalises.
+    """
+    def __init__(self, mean, std, padding=4, degrees=15, flip=True, train=True):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.padding = padding
+        self.degrees = degrees
+        self.flip = flip
+        self.train = train
+
+    def __call__(self, images, generator=None):
+        x = images.float().div_(255)
+        if self.train:
+            B, _, H, W = x.shape
+            device = x.device
+            # integer crop offsets in [-padding, padding], as shifts in normalised coordinates
+            shift = torch.randint(-self.padding, self.padding + 1, (B, 2), device=device, generator=generator).float()
+            shift = shift * torch.tensor([2. / W, 2. / H], device=device)
+            sign = torch.ones(B, device=device)
+            if self.flip:
+                sign = torch.where(torch.rand(B, device=device, generator=generator) < 0.5, -sign, sign)
+            angle = (torch.rand(B, device=device, generator=generator) * 2 - 1) * math.radians(self.degrees)
+            cos, sin = torch.cos(angle), torch.sin(angle)
+            # output -> input coordinates: flip(rotate^-1(p)) + shift
+            theta = torch.stack([torch.stack([sign * cos, sign * sin, shift[:, 0]], dim=1),
+                                 torch.stack([-sin, cos, shift[:, 1]], dim=1)], dim=1)
+            grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+            x = F.grid_sample(x, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        return (x - self.mean.to(x.device)) / self.std.to(x.device)
+
+
+class TensorLoader(object):
+    """
+    DataLoader replacement over tensor-resident uint8 data: iterating yields (images, labels) batches on device,
+    already augmented and normalised. indices selects the samples of this loader (Subset / client split); the
+    data tensors themselves are shared between loaders.
+
+    With data in pinned host memory each batch is gathered into one of two pinned staging buffers and copied
+    asynchronously; with data on the GPU nothing crosses the bus.
+    """
+    def __init__(self, data, labels, indices=None, batch_size=16, shuffle=True, augmentation=None, seed=None,
+                 device="cuda"):
+        self.data = data
+        self.labels = labels
+        self.indices = torch.arange(len(labels)) if indices is None else torch.as_tensor(indices, dtype=torch.long)
+        self.indices = self.indices.to(data.device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augmentation = augmentation
+        self.device = torch.device(device)
+        self.generator = make_generator(self.device, seed)
+        self.index_generator = make_generator(data.device, seed)
+        self._staging = None
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def _fetch(self, idx, slot):
+        if self.data.device == self.device:
+            return self.data.index_select(0, idx), self.labels.index_select(0, idx)
+        if self.device.type != "cuda" or not self.data.is_pinned():
+            return self.data.index_select(0, idx).to(self.device), self.labels.index_select(0, idx).to(self.device)
+        if self._staging is None:
+            self._staging = [(torch.empty((self.batch_size,) + tuple(self.data.shape[1:]), dtype=self.data.dtype).pin_memory(),
+                              torch.empty(self.batch_size, dtype=self.labels.dtype).pin_memory(),
+                              torch.cuda.Event()) for _ in range(2)]
+        image_buf, label_buf, copied = self._staging[slot]
+        copied.synchronize()  # the previous copy out of this buffer has finished
+        n = len(idx)
+        torch.index_select(self.data, 0, idx, out=image_buf[:n])
+        torch.index_select(self.labels, 0, idx, out=label_buf[:n])
+        images = image_buf[:n].to(self.device, non_blocking=True)
+        labels = label_buf[:n].to(self.device, non_blocking=True)
+        copied.record()
+        return images, labels
+
+    def __iter__(self):
+        n = len(self.indices)
+        if self.shuffle:
+            order = self.indices[torch.randperm(n, device=self.indices.device, generator=self.index_generator)]
+        else:
+            order = self.indices
+        for step, start in enumerate(range(0, n, self.batch_size)):
+            images, labels = self._fetch(order[start:start + self.batch_size], step % 2)
+            if self.augmentation is not None:
+                images = self.augmentation(images, self.generator)
+            else:
+                images = images.float().div_(255)
+            yield images, labels
+
+
+def get_resident_client_loaders(name, mean, std, batch_size=16, shuffle=True, num_client=1, collude_use_public=False,
+                                indices=None, noniid_ratio=1.0, resident="gpu"):
+    """
+    Tensor-resident counterpart of the client dataloader list of get_cifar10/cifar100/SVHN_trainloader: same
+    client splits (contiguous Subset chunks, noniid_alllabel partitions, collude_use_public), every client a
+    TensorLoader with its own generator, seeded from the global torch seed.
+    """
+    data, labels = load_resident_dataset(name, train=True, resident=resident)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    augmentation = TensorAugmentation(mean, std)
+    indices = torch.arange(len(labels)) if indices is None else torch.as_tensor(indices, dtype=torch.long)
+
+    def client_loader(split_data, split_labels, split_indices):
+        seed = int(torch.randint(2 ** 31 - 1, (1,)).item())
+        return TensorLoader(split_data, split_labels, split_indices, batch_size=batch_size, shuffle=shuffle,
+                            augmentation=augmentation, seed=seed, device=device)
+
+    if num_client == 1:
+        return [client_loader(data, labels, indices)]
+    client_loaders = []
+    if not collude_use_public:
+        if noniid_ratio < 1.0:
+            # noniid_alllabel only reads dataset[i][1]
+            subset_labels = labels.index_select(0, indices.to(labels.device)).cpu()
+            subset_list = noniid_alllabel(TensorDataset(torch.arange(len(indices)), subset_labels), num_client, noniid_ratio, 100)
+        chunk = len(indices) // num_client
+        for i in range(num_client):
+            if noniid_ratio == 1.0:
+                client_indices = indices[i * chunk:(i + 1) * chunk]
+            else:
+                client_indices = indices[torch.as_tensor(sorted(subset_list[i]), dtype=torch.long)]
+            client_loaders.append(client_loader(data, labels, client_indices))
+    else:
+        # 1+ (n-1) * collude, the single client gets all training data
+        client_loaders.append(client_loader(data, labels, indices))
+        test_data, test_labels = load_resident_dataset(name, train=False, resident=resident)
+        for i in range(num_client - 1):
+            client_loaders.append(client_loader(test_data, test_labels, None))
+    return client_loaders
+
+
+# ============================================================================
+# Packed ImageFolder cache (FaceScrub / TinyImageNet / ImageNet)
+# pack_image_folder decodes an ImageFolder tree once (optionally resized to the model input size) into one
+# memory-mappable uint8 array [N, H, W, 3] plus labels; PackedImageFolder serves it by slicing the memmap, so
+# no directory walk and no JPEG/PNG decode happens per epoch.
+# ============================================================================
+
+def packed_prefix(root, size=None, cache_dir=None):
+    """Path prefix of the pack of root: <cache_dir or root_packed>/<H>x<W> (or native)."""
+    if cache_dir is None:
+        cache_dir = os.path.normpath(root) + "_packed"
+    return os.path.join(cache_dir, "native" if size is None else "{}x{}".format(size[0], size[1]))
+
+
+def pack_image_folder(root, size=None, cache_dir=None, num_threads=8):
+    """
+    Convert the ImageFolder tree root into a pack (one-time; returns at once if the pack exists).
+
+    Files written (prefix = packed_prefix(root, size, cache_dir)):
+    - prefix_images.npy: uint8 [N, H, W, 3], samples in ImageFolder order (sorted by class)
+    - prefix_labels.npy: int64 [N]
+    - prefix_meta.json: classes, class_to_idx, class_offsets (first sample of each class), size
+
+    size: (H, W) to resize to (PIL bilinear, like transforms.Resize); None keeps the stored size, which then has
+    to be the same for all images (as after prepare_facescrub.py / for TinyImageNet).
+    """
+    prefix = packed_prefix(root, size, cache_dir)
+    if os.path.isfile(prefix + "_meta.json"):
+        return prefix
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    folder = datasets.ImageFolder(root)
+    if size is None:
+        W, H = folder.loader(folder.samples[0][0]).size
+    else:
+        H, W = size
+
+    def decode(sample):
+        img = folder.loader(sample[0])
+        if img.size != (W, H):
+            if size is None:
+                raise ValueError("{} is {}x{}, expected {}x{}; pass size to resize".format(
+                    sample[0], img.size[1], img.size[0], H, W))
+            img = img.resize((W, H), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8)
+
+    # written under temporary names and renamed at the end, an interrupted conversion is never picked up
+    images = np.lib.format.open_memmap(prefix + "_images.tmp.npy", mode="w+", dtype=np.uint8,
+                                       shape=(len(folder.samples), H, W, 3))
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(num_threads) as pool:
+        for i, image in enumerate(tqdm.tqdm(pool.map(decode, folder.samples), total=len(folder.samples),
+                                            desc="packing " + root)):
+            images[i] = image
+    images.flush()
+    del images
+    labels = np.asarray(folder.targets, dtype=np.int64)
+    np.save(prefix + "_labels.npy", labels)
+    os.replace(prefix + "_images.tmp.npy", prefix + "_images.npy")
+    meta = {"classes": folder.classes, "class_to_idx": folder.class_to_idx, "size": [H, W],
+            "class_offsets": np.searchsorted(labels, np.arange(len(folder.classes))).tolist()}
+    with open(prefix + "_meta.json", "w") as f:
+        json.dump(meta, f)
+    return prefix
+
+
+class PackedImageFolder(torch.utils.data.Dataset):
+    """
+    ImageFolder replacement over a pack written by pack_image_folder (same samples, order, classes, targets).
+    Images are memmap slices; they are handed to transform as PIL images so the ImageFolder transforms apply
+    unchanged (transform=None returns the uint8 HWC array view).
+    """
+    def __init__(self, prefix, transform=None, target_transform=None):
+        self.prefix = prefix
+        self.transform = transform
+        self.target_transform = target_transform
+        with open(prefix + "_meta.json") as f:
+            meta = json.load(f)
+        self.classes = meta["classes"]
+        self.class_to_idx = meta["class_to_idx"]
+        self.class_offsets = meta["class_offsets"]
+        self.labels = np.load(prefix + "_labels.npy")
+        self.targets = self.labels.tolist()
+        self.images = np.load(prefix + "_images.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        img = self.images[index]
+        target = self.targets[index]
+        if self.transform is not None:
+            img = self.transform(Image.fromarray(img))
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+
+def image_folder(root, transform=None, packed=None, size=None):
+    """
+    datasets.ImageFolder(root, transform), or its PackedImageFolder.
+    - packed=None: use the pack of root if it exists, else read the files
+    - packed=True: build the pack on first use
+    - packed=False: always read the files
+    """
+    if packed is None:
+        packed = os.path.isfile(packed_prefix(root, size) + "_meta.json")
+    if packed:
+        return PackedImageFolder(pack_image_folder(root, size=size), transform=transform)
+    return datasets.ImageFolder(root, transform=transform)
+
+
 def load_fmnist():
     xpriv = datasets.FashionMNIST(root='./data', train=True, download=True)
 
@@ -259,7 +663,7 @@ def get_fmnist_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client
 
     return fmnist_training_loader, fmnist_testing_loader
 
-def get_facescrub_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False):
+def get_facescrub_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, packed = None):
     """ return training dataloader
     Args:
         mean: mean of cifar10 training dataset
@@ -268,6 +672,7 @@ def get_facescrub_bothloader(batch_size=16, num_workers=2, shuffle=True, num_cli
         batch_size: dataloader batchsize
         num_workers: dataloader num_works
         shuffle: whether to shuffle
+        packed: None (use the packed cache if present), True (build it on first use) or False (read image files)
     Returns: train_data_loader:torch dataloader object
     """
     transform_train = transforms.Compose([
@@ -286,10 +691,10 @@ def get_facescrub_bothloader(batch_size=16, num_workers=2, shuffle=True, num_cli
         os.system("git clone https://github.com/theothings/facescrub-dataset.git")
         import subprocess
         subprocess.call("python prepare_facescrub.py", shell=True)
-    facescrub_training = datasets.ImageFolder('facescrub-dataset/48x48/train', transform=transform_train)
+    facescrub_training = image_folder('facescrub-dataset/48x48/train', transform=transform_train, packed=packed)
 
-    facescrub_testing = datasets.ImageFolder('facescrub-dataset/48x48/validate', transform=transform_test)
-    facescrub_training_AT = datasets.ImageFolder('facescrub-dataset/48x48/train', transform=transform_test)
+    facescrub_testing = image_folder('facescrub-dataset/48x48/validate', transform=transform_test, packed=packed)
+    facescrub_training_AT = image_folder('facescrub-dataset/48x48/train', transform=transform_test, packed=packed)
     if num_client == 1:
         facescrub_training_loader = [torch.utils.data.DataLoader(facescrub_training,  batch_size=batch_size, shuffle=shuffle,
                 num_workers=num_workers)]
@@ -318,7 +723,7 @@ def get_facescrub_bothloader(batch_size=16, num_workers=2, shuffle=True, num_cli
 
     return facescrub_training_loader, facescrub_testing_loader,facescrub_training_loader_AT, facescrub_testing_loader_AT,facescrub_testing_loader_val
 
-def get_tinyimagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False):
+def get_tinyimagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, packed = None):
     """ return training dataloader
     Args:
         mean: mean of cifar10 training dataset
@@ -327,6 +732,7 @@ def get_tinyimagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_
         batch_size: dataloader batchsize
         num_workers: dataloader num_works
         shuffle: whether to shuffle
+        packed: None (use the packed cache if present), True (build it on first use) or False (read image files)
     Returns: train_data_loader:torch dataloader object
     """
     transform_train = transforms.Compose([
@@ -346,9 +752,9 @@ def get_tinyimagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_
     if not os.path.isdir("./tiny-imagenet-200/train"):
         import subprocess
         subprocess.call("python prepare_tinyimagenet.py", shell=True)
-    tinyimagenet_training = datasets.ImageFolder('tiny-imagenet-200/train', transform=transform_train)
-    tinyimagenet_testing = datasets.ImageFolder('tiny-imagenet-200/val/images', transform=transform_test)
-    tinyimagenet_training_AT = datasets.ImageFolder('tiny-imagenet-200/train', transform=transform_test)
+    tinyimagenet_training = image_folder('tiny-imagenet-200/train', transform=transform_train, packed=packed)
+    tinyimagenet_testing = image_folder('tiny-imagenet-200/val/images', transform=transform_test, packed=packed)
+    tinyimagenet_training_AT = image_folder('tiny-imagenet-200/train', transform=transform_test, packed=packed)
 
     if num_client == 1:
         tinyimagenet_training_loader = [torch.utils.data.DataLoader(tinyimagenet_training,  batch_size=batch_size, shuffle=shuffle,
@@ -378,7 +784,7 @@ def get_tinyimagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_
     return tinyimagenet_training_loader, tinyimagenet_testing_loader,tinyimagenet_training_loader_AT, tinyimagenet_testing_loader_AT,tinyimagenet_testing_loader_val
 
 
-def get_imagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False):
+def get_imagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, packed = None):
     """ return training dataloader
     Args:
         mean: mean of cifar10 training dataset
@@ -387,6 +793,7 @@ def get_imagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_clie
         batch_size: dataloader batchsize
         num_workers: dataloader num_works
         shuffle: whether to shuffle
+        packed: None (use the packed cache if present), True (build it on first use) or False (read image files)
     Returns: train_data_loader:torch dataloader object
     """
     transform_train = transforms.Compose([
@@ -406,9 +813,9 @@ def get_imagenet_bothloader(batch_size=16, num_workers=2, shuffle=True, num_clie
     if not os.path.isdir("../ImageNet/train"):
         import subprocess
         subprocess.call("python prepare_tinyimagenet.py", shell=True)
-    tinyimagenet_training = datasets.ImageFolder('../ImageNet/train', transform=transform_train)
-    tinyimagenet_testing = datasets.ImageFolder('tiny-imagenet-200/val/images', transform=transform_test)
-    tinyimagenet_training_AT = datasets.ImageFolder('tiny-imagenet-200/train', transform=transform_test)
+    tinyimagenet_training = image_folder('../ImageNet/train', transform=transform_train, packed=packed, size=(224, 224))
+    tinyimagenet_testing = image_folder('tiny-imagenet-200/val/images', transform=transform_test, packed=packed, size=(224, 224))
+    tinyimagenet_training_AT = image_folder('tiny-imagenet-200/train', transform=transform_test, packed=packed, size=(224, 224))
 
     if num_client == 1:
         tinyimagenet_training_loader = [torch.utils.data.DataLoader(tinyimagenet_training,  batch_size=batch_size, shuffle=shuffle,
@@ -516,7 +923,7 @@ def get_purchase_trainloader():
     print('Data loading finished')
     return shadow_train_loader, shadow_test_loader, target_train_loader, target_test_loader
 
-def get_cifar10_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, data_portion = 1.0, noniid_ratio = 1.0):
+def get_cifar10_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, data_portion = 1.0, noniid_ratio = 1.0, resident = None):
     """ return training dataloader
     Args:
         mean: mean of cifar10 training dataset
@@ -525,6 +932,7 @@ def get_cifar10_trainloader(batch_size=16, num_workers=2, shuffle=True, num_clie
         batch_size: dataloader batchsize
         num_workers: dataloader num_works
         shuffle: whether to shuffle
+        resident: None (torchvision DataLoader), "gpu" or "pinned" (tensor-resident TensorLoader per client)
     Returns: train_data_loader:torch dataloader object
     """
 
@@ -541,13 +949,17 @@ def get_cifar10_trainloader(batch_size=16, num_workers=2, shuffle=True, num_clie
         transforms.Normalize(CIFAR10_TRAIN_MEAN, CIFAR10_TRAIN_STD)
     ])
     #cifar00_training = CIFAR10Train(path, transform=transform_train)
-    cifar10_training = torchvision.datasets.CIFAR10(root='./data', train=True, download=True, transform=transform_train)
+    cifar10_training = dataset_handle("cifar10", True, transform_train).dataset
 
     indices = torch.randperm(len(cifar10_training))[:int(len(cifar10_training)* data_portion)]
 
     cifar10_training = torch.utils.data.Subset(cifar10_training, indices)
 
-    if num_client == 1:
+    if resident is not None:
+        cifar10_training_loader = get_resident_client_loaders("cifar10", CIFAR10_TRAIN_MEAN, CIFAR10_TRAIN_STD, batch_size=batch_size,
+                                                            shuffle=shuffle, num_client=num_client, collude_use_public=collude_use_public,
+                                                            indices=indices, noniid_ratio=noniid_ratio, resident=resident)
+    elif num_client == 1:
         cifar10_training_loader = [DataLoader(
             cifar10_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)]
     elif num_client > 1:
@@ -586,21 +998,17 @@ def get_cifar10_trainloader(batch_size=16, num_workers=2, shuffle=True, num_clie
             subset_training_loader = DataLoader(
                 cifar10_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
             cifar10_training_loader.append(subset_training_loader)
-            cifar10_test = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=transform_train)
+            cifar10_test = dataset_handle("cifar10", False, transform_train).dataset
             for i in range(num_client-1):
                 subset_training_loader = DataLoader(
                     cifar10_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
                 
                 cifar10_training_loader.append(subset_training_loader)
-    cifar10_training2 = torchvision.datasets.CIFAR10(root='./data', train=True, download=True, transform=transform_test)
+    cifar10_training2 = dataset_handle("cifar10", True, transform_test)
 
-    cifar10_training_mem = torch.utils.data.Subset(cifar10_training2, list(range(0, 50000)))
-    xmem_training_loader = DataLoader(
-        cifar10_training_mem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    xmem_training_loader = cifar10_training2.view(batch_size, shuffle, subset=range(0, 50000), num_workers=num_workers)
 
-    cifar10_testing_mem = torch.utils.data.Subset(cifar10_training2, list(range(5000, 5032)))
-    xmem_testing_loader = DataLoader(
-        cifar10_testing_mem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    xmem_testing_loader = cifar10_training2.view(batch_size, shuffle, subset=range(5000, 5032), num_workers=num_workers)
 
 
     return cifar10_training_loader, xmem_training_loader, xmem_testing_loader
@@ -634,23 +1042,18 @@ def get_cifar10_testloader(batch_size=16, num_workers=2, shuffle=True, extra_cls
         transforms.ToTensor(),
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
     ])
-    cifar10_test = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=transform_test)
-    cifar10_test_loader = DataLoader(
-        cifar10_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    cifar10_test = dataset_handle("cifar10", False, transform_test)
+    cifar10_test_loader = cifar10_test.view(batch_size, shuffle, num_workers=num_workers)
     
-    cifar10_test2 = torchvision.datasets.CIFAR10(root='./data', train=False, download=True, transform=transform_test)
-    cifar10_training_nomem = torch.utils.data.Subset(cifar10_test2, list(range(0, len(cifar10_test2)-len(cifar10_test2)//10)))
-    nomem_training_loader = DataLoader(
-        cifar10_training_nomem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    cifar10_test2 = dataset_handle("cifar10", False, transform_test)
+    nomem_training_loader = cifar10_test2.view(batch_size, shuffle, subset=range(0, len(cifar10_test2)-len(cifar10_test2)//10), num_workers=num_workers)
 
-    cifar10_testing_nomem = torch.utils.data.Subset(cifar10_test2, list(range(len(cifar10_test2)-len(cifar10_test2)//10, len(cifar10_test2))))
-    nomem_testing_loader = DataLoader(
-        cifar10_testing_nomem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    nomem_testing_loader = cifar10_test2.view(batch_size, shuffle, subset=range(len(cifar10_test2)-len(cifar10_test2)//10, len(cifar10_test2)), num_workers=num_workers)
 
 
     if extra_cls_removed_dataset:
 
-        cifar10_training = torchvision.datasets.CIFAR10(root='./data', train=True, download=True, transform=transform_exlabel)
+        cifar10_training = dataset_handle("cifar10", True, transform_exlabel).dataset
         cifar10_cls_rm_loader, cifar10_cls_ex_loader = remove_class_loader(cifar10_training, cls_to_remove, batch_size, num_workers)
         return cifar10_test_loader, cifar10_cls_rm_loader, cifar10_cls_ex_loader
     return cifar10_test_loader, nomem_training_loader, nomem_testing_loader
@@ -658,7 +1061,7 @@ def get_cifar10_testloader(batch_size=16, num_workers=2, shuffle=True, extra_cls
 
 
 
-def get_cifar100_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, data_portion = 1.0, noniid_ratio = 1.0):
+def get_cifar100_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, data_portion = 1.0, noniid_ratio = 1.0, resident = None):
     """ return training dataloader
     Args:
         mean: mean of cifar100 training dataset
@@ -667,6 +1070,7 @@ def get_cifar100_trainloader(batch_size=16, num_workers=2, shuffle=True, num_cli
         batch_size: dataloader batchsize
         num_workers: dataloader num_works
         shuffle: whether to shuffle
+        resident: None (torchvision DataLoader), "gpu" or "pinned" (tensor-resident TensorLoader per client)
     Returns: train_data_loader:torch dataloader object
     """
 
@@ -683,13 +1087,17 @@ def get_cifar100_trainloader(batch_size=16, num_workers=2, shuffle=True, num_cli
         transforms.Normalize(CIFAR100_TRAIN_MEAN, CIFAR100_TRAIN_STD)
     ])
     
-    cifar100_training = torchvision.datasets.CIFAR100(root='./data', train=True, download=True, transform=transform_train)
+    cifar100_training = dataset_handle("cifar100", True, transform_train).dataset
     
     indices = torch.randperm(len(cifar100_training))[:int(len(cifar100_training)* data_portion)]
 
     cifar100_training = torch.utils.data.Subset(cifar100_training, indices)
     
-    if num_client == 1:
+    if resident is not None:
+        cifar100_training_loader = get_resident_client_loaders("cifar100", CIFAR100_TRAIN_MEAN, CIFAR100_TRAIN_STD, batch_size=batch_size,
+                                                            shuffle=shuffle, num_client=num_client, collude_use_public=collude_use_public,
+                                                            indices=indices, noniid_ratio=noniid_ratio, resident=resident)
+    elif num_client == 1:
         cifar100_training_loader = [DataLoader(
             cifar100_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)]
     
@@ -730,22 +1138,18 @@ def get_cifar100_trainloader(batch_size=16, num_workers=2, shuffle=True, num_cli
             subset_training_loader = DataLoader(
                 cifar100_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
             cifar100_training_loader.append(subset_training_loader)
-            cifar100_test = torchvision.datasets.CIFAR100(root='./data', train=False, download=True, transform=transform_train)
+            cifar100_test = dataset_handle("cifar100", False, transform_train).dataset
             for i in range(num_client-1):
                 subset_training_loader = DataLoader(
                     cifar100_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
                 
                 cifar100_training_loader.append(subset_training_loader)
 
-    cifar100_training2 = torchvision.datasets.CIFAR100(root='./data', train=True, download=True, transform=transform_test)
+    cifar100_training2 = dataset_handle("cifar100", True, transform_test)
 
-    cifar100_training_mem = torch.utils.data.Subset(cifar100_training2, list(range(0, 50000)))
-    xmem_training_loader = DataLoader(
-        cifar100_training_mem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    xmem_training_loader = cifar100_training2.view(batch_size, shuffle, subset=range(0, 50000), num_workers=num_workers)
 
-    cifar100_testing_mem = torch.utils.data.Subset(cifar100_training2, list(range(5000, 5032)))
-    xmem_testing_loader = DataLoader(
-        cifar100_testing_mem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    xmem_testing_loader = cifar100_training2.view(batch_size, shuffle, subset=range(5000, 5032), num_workers=num_workers)
 
 
     return cifar100_training_loader, xmem_training_loader, xmem_testing_loader
@@ -782,20 +1186,15 @@ def get_cifar100_testloader(batch_size=16, num_workers=2, shuffle=True, extra_cl
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
     ])
     #cifar100_test = CIFAR100Test(path, transform=transform_test)
-    cifar100_test = torchvision.datasets.CIFAR100(root='./data', train=False, download=True, transform=transform_test)
-    cifar100_test_loader = DataLoader(
-        cifar100_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    cifar100_test = dataset_handle("cifar100", False, transform_test)
+    cifar100_test_loader = cifar100_test.view(batch_size, shuffle, num_workers=num_workers)
 
-    cifar100_test2 = torchvision.datasets.CIFAR100(root='./data', train=False, download=True, transform=transform_test)
-    cifar100_training_nomem = torch.utils.data.Subset(cifar100_test2, list(range(0, len(cifar100_test2)-len(cifar100_test2)//10)))
-    nomem_training_loader = DataLoader(
-        cifar100_training_nomem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    cifar100_test2 = dataset_handle("cifar100", False, transform_test)
+    nomem_training_loader = cifar100_test2.view(batch_size, shuffle, subset=range(0, len(cifar100_test2)-len(cifar100_test2)//10), num_workers=num_workers)
 
-    cifar100_testing_nomem = torch.utils.data.Subset(cifar100_test2, list(range(len(cifar100_test2)-len(cifar100_test2)//10, len(cifar100_test2))))
-    nomem_testing_loader = DataLoader(
-        cifar100_testing_nomem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    nomem_testing_loader = cifar100_test2.view(batch_size, shuffle, subset=range(len(cifar100_test2)-len(cifar100_test2)//10, len(cifar100_test2)), num_workers=num_workers)
     if extra_cls_removed_dataset:
-        cifar100_training = torchvision.datasets.CIFAR100(root='./data', train=True, download=True, transform=transform_exlabel)
+        cifar100_training = dataset_handle("cifar100", True, transform_exlabel).dataset
         cifar100_cls_rm_loader, cifar100_cls_ex_loader = remove_class_loader(cifar100_training, cls_to_remove, batch_size, num_workers)
         return cifar100_test_loader, cifar100_cls_rm_loader, cifar100_cls_ex_loader
     return cifar100_test_loader, nomem_training_loader, nomem_testing_loader
@@ -803,7 +1202,7 @@ def get_cifar100_testloader(batch_size=16, num_workers=2, shuffle=True, extra_cl
 
 
 
-def get_SVHN_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False):
+def get_SVHN_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client = 1, collude_use_public = False, resident = None):
     """ return training dataloader
     Args:
         mean: mean of SVHN training dataset
@@ -812,6 +1211,7 @@ def get_SVHN_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client
         batch_size: dataloader batchsize
         num_workers: dataloader num_works
         shuffle: whether to shuffle
+        resident: None (torchvision DataLoader), "gpu" or "pinned" (tensor-resident TensorLoader per client)
     Returns: train_data_loader:torch dataloader object
     """
 
@@ -823,17 +1223,18 @@ def get_SVHN_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client
         transforms.Normalize(SVHN_TRAIN_MEAN, SVHN_TRAIN_STD)
     ])
     #cifar00_training = SVHNTrain(path, transform=transform_train)
-    SVHN_training = torchvision.datasets.SVHN(root='./data', split='train', download=True, transform=transform_train)
-    if num_client == 1:
-        SVHN_training_loader = [DataLoader(
-            SVHN_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)]
+    SVHN_training = dataset_handle("svhn", True, transform_train)
+    if resident is not None:
+        SVHN_training_loader = get_resident_client_loaders("svhn", SVHN_TRAIN_MEAN, SVHN_TRAIN_STD, batch_size=batch_size,
+                                                           shuffle=shuffle, num_client=num_client, collude_use_public=collude_use_public,
+                                                           resident=resident)
+    elif num_client == 1:
+        SVHN_training_loader = [SVHN_training.view(batch_size, shuffle, num_workers=num_workers)]
     elif num_client > 1:
         SVHN_training_loader = []
         if not collude_use_public:
             for i in range(num_client):
-                SVHN_training_subset = torch.utils.data.Subset(SVHN_training, list(range(i * (len(SVHN_training)//num_client), (i+1) * (len(SVHN_training)//num_client))))
-                subset_training_loader = DataLoader(
-                    SVHN_training_subset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+                subset_training_loader = SVHN_training.view(batch_size, shuffle, subset=range(i * (len(SVHN_training)//num_client), (i+1) * (len(SVHN_training)//num_client)), num_workers=num_workers)
                 SVHN_training_loader.append(subset_training_loader)
         else:
             '''1 + collude + (n-2) vanilla clients, all training data is shared by n-1 clients'''
@@ -852,24 +1253,19 @@ def get_SVHN_trainloader(batch_size=16, num_workers=2, shuffle=True, num_client
             # SVHN_training_loader[1] = temp
 
             '''1+ (n-1) * collude, the single client gets all training data'''
-            subset_training_loader = DataLoader(
-                SVHN_training, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+            subset_training_loader = SVHN_training.view(batch_size, shuffle, num_workers=num_workers)
             SVHN_training_loader.append(subset_training_loader)
-            SVHN_test = torchvision.datasets.SVHN(root='./data', split='test', download=True, transform=transform_train)
+            SVHN_test = dataset_handle("svhn", False, transform_train).dataset
             for i in range(num_client-1):
                 subset_training_loader = DataLoader(
                     SVHN_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
                 
                 SVHN_training_loader.append(subset_training_loader)
-    SVHN_training2 = torchvision.datasets.SVHN(root='./data', split='train', download=True, transform=transform_train)
+    SVHN_training2 = dataset_handle("svhn", True, transform_train)
 
-    SVHN_training_mem = torch.utils.data.Subset(SVHN_training2, list(range(0, 5000)))
-    xmem_training_loader = DataLoader(
-        SVHN_training_mem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    xmem_training_loader = SVHN_training2.view(batch_size, shuffle, subset=range(0, 5000), num_workers=num_workers)
 
-    SVHN_testing_mem = torch.utils.data.Subset(SVHN_training2, list(range(5000, 10000)))
-    xmem_testing_loader = DataLoader(
-        SVHN_testing_mem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    xmem_testing_loader = SVHN_training2.view(batch_size, shuffle, subset=range(5000, 10000), num_workers=num_workers)
 
 
     return SVHN_training_loader, xmem_training_loader, xmem_testing_loader
@@ -902,24 +1298,19 @@ def get_SVHN_testloader(batch_size=16, num_workers=2, shuffle=True, extra_cls_re
         transforms.ToTensor(),
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
     ])
-    SVHN_test = torchvision.datasets.SVHN(root='./data', split='test', download=True, transform=transform_test)
+    SVHN_test = dataset_handle("svhn", False, transform_test)
     print(len(SVHN_test))
-    SVHN_test_loader = DataLoader(
-        SVHN_test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    SVHN_test_loader = SVHN_test.view(batch_size, shuffle, num_workers=num_workers)
     
-    SVHN_test2 = torchvision.datasets.SVHN(root='./data', split='test', download=True, transform=transform_train)
-    SVHN_training_nomem = torch.utils.data.Subset(SVHN_test2, list(range(0, len(SVHN_test2)//2)))
-    nomem_training_loader = DataLoader(
-        SVHN_training_nomem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    SVHN_test2 = dataset_handle("svhn", False, transform_train)
+    nomem_training_loader = SVHN_test2.view(batch_size, shuffle, subset=range(0, len(SVHN_test2)//2), num_workers=num_workers)
 
-    SVHN_testing_nomem = torch.utils.data.Subset(SVHN_test2, list(range(len(SVHN_test2)//2, len(SVHN_test2))))
-    nomem_testing_loader = DataLoader(
-        SVHN_testing_nomem, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    nomem_testing_loader = SVHN_test2.view(batch_size, shuffle, subset=range(len(SVHN_test2)//2, len(SVHN_test2)), num_workers=num_workers)
 
 
     if extra_cls_removed_dataset:
 
-        SVHN_training = torchvision.datasets.SVHN(root='./data', split='train', download=True, transform=transform_exlabel)
+        SVHN_training = dataset_handle("svhn", True, transform_exlabel).dataset
         SVHN_cls_rm_loader, SVHN_cls_ex_loader = remove_class_loader(SVHN_training, cls_to_remove, batch_size, num_workers)
         return SVHN_test_loader, SVHN_cls_rm_loader, SVHN_cls_ex_loader
     return SVHN_test_loader, nomem_training_loader, nomem_testing_loader
@@ -0,0 +1,90 @@
+import math
+
+import torch
+
+# ============================================================================
+# Device-side activation defences (noise / dropout / top-k pruning)
+# Every primitive draws its randomness on the device of the input from an explicit torch.Generator,
+# so nothing is sampled on the host and copied over per batch, and runs are reproducible from a seed.
+# ============================================================================
+
+def make_generator(device, seed=None):
+    """torch.Generator on device (seeded if seed is given, otherwise from the default seed)."""
+    generator = torch.Generator(device=torch.device(device))
+    if seed is not None:
+        generator.manual_seed(seed)
+    return generator
+
+
+def dp_gaussian_sigma(epsilon, delta=10e-5):
+    """Gaussian-mechanism noise scale sqrt(2 ln(1.25 / delta)) / epsilon."""
+    return math.sqrt(2 * math.log(1.25 / delta)) / epsilon
+
+
+def gaussian_noise(tensor, sigma, generator=None):
+    """sigma * N(0, 1) noise with the shape, dtype and device of tensor."""
+    noise = torch.randn(tensor.shape, device=tensor.device, dtype=tensor.dtype, generator=generator)
+    return noise.mul_(sigma)
+
+
+def laplace_noise(tensor, scale, generator=None):
+    """Laplace(0, scale) noise with the shape, dtype and device of tensor (inverse-CDF sampling)."""
+    u = torch.rand(tensor.shape, device=tensor.device, dtype=tensor.dtype, generator=generator) - 0.5
+    # -scale * sign(u) * log(1 - 2|u|); clamp keeps log finite when u hits -0.5 exactly
+    return u.sign() * torch.log1p((-2 * u.abs()).clamp_min(-1 + torch.finfo(tensor.dtype).eps)) * (-scale)
+
+
+def local_dp_noise(tensor, epsilon, laplace=True, delta=10e-5, generator=None):
+    """Local DP noise: Laplace(1 / epsilon), or the Gaussian mechanism with dp_gaussian_sigma(epsilon, delta)."""
+    if laplace:
+        return laplace_noise(tensor, 1 / epsilon, generator=generator)
+    return gaussian_noise(tensor, dp_gaussian_sigma(epsilon, delta), generator=generator)
+
+
+def dropout_mask(tensor, ratio, generator=None):
+    """Boolean mask, True with probability ratio (elements to drop)."""
+    return torch.rand(tensor.shape, device=tensor.device, generator=generator) < ratio
+
+
+def dropout_defense(tensor, ratio=0.5, generator=None):
+    """Zero each element with probability ratio (no rescaling, unlike nn.Dropout)."""
+    return tensor.masked_fill(dropout_mask(tensor, ratio, generator=generator), 0)
+
+
+def prune_defense(tensor, ratio=0.5):
+    """
+    Per-sample pruning: zero the ratio fraction of smallest elements of every sample.
+
+    The per-sample threshold is the kthvalue of the flattened sample, so no index tensor is built; elements
+    tied with the threshold are zeroed as well.
+    """
+    flat = tensor.reshape(tensor.size(0), -1)
+    k = int(flat.size(1) * ratio)
+    if k <= 0:
+        return tensor
+    threshold = flat.kthvalue(k, dim=1, keepdim=True).values
+    return flat.masked_fill(flat <= threshold, 0.0).view(tensor.shape)
+
+
+def prune_top_n_percent_left(tensor, n=20):
+    """Keep the n percent largest elements of every sample, zero the rest."""
+    return prune_defense(tensor, (100 - n) / 100.)
+
+
+def test_defenses(seed=0): # reproducibility and statistics check on the CPU generator
+    x = torch.randn(64, 8, 4, 4)
+    a = laplace_noise(x, 0.5, generator=make_generator("cpu", seed))
+    b = laplace_noise(x, 0.5, generator=make_generator("cpu", seed))
+    laplace_ok = torch.equal(a, b) and abs(a.abs().mean().item() - 0.5) < 0.02
+    gauss = gaussian_noise(x, 2.0, generator=make_generator("cpu", seed))
+    gauss_ok = abs(gauss.std().item() - 2.0) < 0.05
+    dropped = dropout_defense(x, 0.3, generator=make_generator("cpu", seed))
+    dropout_ok = abs((dropped == 0).float().mean().item() - 0.3) < 0.02
+    pruned = prune_defense(x, 0.25)
+    prune_ok = bool(((pruned.reshape(64, -1) == 0).sum(dim=1) == 32).all())
+    # per-sample pruning equals the original global topk on single-sample batches
+    ref = x[:1].flatten().clone()
+    _, index = ref.topk(k=int(ref.numel() * 0.8), dim=0, largest=False)
+    ref[index] = 0.0
+    left_ok = torch.equal(prune_top_n_percent_left(x[:1], 20).flatten(), ref)
+    return laplace_ok and gauss_ok and dropout_ok and prune_ok and left_ok
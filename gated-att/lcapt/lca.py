@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from contextlib import nullcontext
 from copy import deepcopy
 import os
 from typing import Any, Callable, Iterable, Literal, Optional, Union
@@ -12,7 +13,6 @@ import torch.nn.functional as F
 
 from .activation import hard_threshold, soft_threshold
 from .metric import (
-    compute_frac_active,
     compute_l1_sparsity,
     compute_l2_error,
     compute_times_active_by_feature,
@@ -31,6 +31,37 @@ from .util import (
 Parameter = torch.nn.parameter.Parameter
 Tensor = torch.Tensor
 
+TRACK_KEYS = ("L1", "L2", "TotalEnergy", "FractionActive", "Tau")
+
+
+def _state_update(
+    states: Tensor, input_drive: Tensor, inhib: Tensor, tau_inv: float
+) -> Tensor:
+    """One LCA membrane potential update (Euler step)"""
+    return states + tau_inv * (input_drive - states - inhib)
+
+
+_compiled_state_update = None
+
+
+def fused_state_update(
+    states: Tensor, input_drive: Tensor, inhib: Tensor, tau_inv: float
+) -> Tensor:
+    """_state_update compiled into one elementwise kernel (torch.compile),
+    falls back to eager if compilation fails"""
+    global _compiled_state_update
+    if _compiled_state_update is None:
+        _compiled_state_update = (
+            torch.compile(_state_update, dynamic=True)
+            if hasattr(torch, "compile")
+            else _state_update
+        )
+    try:
+        return _compiled_state_update(states, input_drive, inhib, tau_inv)
+    except Exception:
+        _compiled_state_update = _state_update
+        return _state_update(states, input_drive, inhib, tau_inv)
+
 
 class _LCAConvBase(torch.nn.Module):
     def __init__(
@@ -73,8 +104,19 @@ class _LCAConvBase(torch.nn.Module):
             {},
         ),
         no_time_pad: bool = False,
+        early_stop_tol: Optional[float] = None,
+        check_every: int = 10,
+        compile_step: bool = False,
+        amp_dtype: Optional[Literal["float16", "bfloat16"]] = None,
     ) -> None:
+        if amp_dtype is not None:
+            assert amp_dtype in ("float16", "bfloat16")
+        assert check_every >= 1
+        self.amp_dtype = amp_dtype
+        self.check_every = check_every
+        self.compile_step = compile_step
         self.d_update_clip = d_update_clip
+        self.early_stop_tol = early_stop_tol
         self.eta = eta
         self.in_neurons = in_neurons
         self.input_unit_var = input_unit_var
@@ -251,16 +293,26 @@ class _LCAConvBase(torch.nn.Module):
         update = torch.tensordot(acts, error, dims=([0, 2, 3, 4], [0, 2, 3, 4]))
         return reshape_func(update)
 
-    def _create_trackers(self) -> dict[str, np.ndarray]:
-        """Create placeholders to store different metrics"""
-        float_tracker = np.zeros([self.lca_iters], dtype=np.float32)
-        return {
-            "L1": float_tracker.copy(),
-            "L2": float_tracker.copy(),
-            "TotalEnergy": float_tracker.copy(),
-            "FractionActive": float_tracker.copy(),
-            "Tau": float_tracker.copy(),
-        }
+    def _autocast(self, inputs: Tensor):
+        """Autocast context for the lateral competition conv (amp_dtype)"""
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(
+            device_type=inputs.device.type, dtype=getattr(torch, self.amp_dtype)
+        )
+
+    def _converged(self, new_states: Tensor, states: Tensor) -> bool:
+        """Whether every sample is near a fixed point: ||du/dt|| / ||u|| below
+        early_stop_tol, with du/dt = tau * (state change). One host sync."""
+        with torch.no_grad():
+            delta = (new_states - states).float().flatten(1).norm(dim=1) * self.tau
+            scale = new_states.float().flatten(1).norm(dim=1).clamp_min(1e-12)
+            return bool((delta / scale).max() < self.early_stop_tol)
+
+    def _create_trackers(self, device: torch.device) -> Tensor:
+        """Create placeholders to store different metrics: one row per entry
+        of TRACK_KEYS, kept on the device until the end of the LCA loop"""
+        return torch.zeros(len(TRACK_KEYS), self.lca_iters, device=device)
 
     def encode(
         self,
@@ -268,23 +320,41 @@ class _LCAConvBase(torch.nn.Module):
         drive_scaling: Optional[Tensor] = None,
         initial_states: Optional[Tensor] = None,
     ) -> tuple[list[Tensor], ...]:
-        """Computes sparse code given data x and dictionary D"""
+        """Computes sparse code given data x and dictionary D
+
+        With early_stop_tol set, the loop ends once the relative rate of
+        change of the states of every sample drops below it; this is checked (one host sync) every
+        check_every iterations. Metrics are tracked on the device and copied
+        to the host once after the loop.
+        """
         input_drive = self.compute_input_drive(inputs, self.weights)
         states = self._init_states(input_drive, initial_states)
         connectivity = self.compute_lateral_connectivity(self.weights)
         return_vars = tuple([[] for _ in range(len(self.return_vars))])
         input_drive = self._scale_input_drive(input_drive, drive_scaling)
+        update = fused_state_update if self.compile_step else _state_update
+        if self.track_metrics:
+            tracks = self._create_trackers(inputs.device)
 
         for lca_iter in range(1, self.lca_iters + 1):
             acts = self.transfer(states)
-            inhib = self.lateral_competition(acts, connectivity)
-            states = states + (1 / self.tau) * (input_drive - states - inhib)
-
-            if self.track_metrics or lca_iter == self.lca_iters or self.return_all_ts:
+            with self._autocast(inputs):
+                inhib = self.lateral_competition(acts, connectivity)
+            new_states = update(states, input_drive, inhib, 1 / self.tau)
+            last_iter = lca_iter == self.lca_iters
+            if (
+                self.early_stop_tol is not None
+                and not last_iter
+                and lca_iter % self.check_every == 0
+            ):
+                last_iter = self._converged(new_states, states)
+            states = new_states
+
+            if self.track_metrics or last_iter or self.return_all_ts:
                 recon = self.compute_recon(acts, self.weights)
                 recon_error = self.compute_recon_error(inputs, recon)
 
-                if self.return_all_ts or lca_iter == self.lca_iters:
+                if self.return_all_ts or last_iter:
                     for var_idx, var_name in enumerate(self.return_vars):
                         if var_name == "inputs":
                             return_vars[var_idx].append(inputs)
@@ -306,12 +376,13 @@ class _LCAConvBase(torch.nn.Module):
                             )
 
                 if self.track_metrics:
-                    if lca_iter == 1:
-                        tracks = self._create_trackers()
                     tracks = self._update_tracks(
                         tracks, lca_iter, acts, inputs, recon, self.tau
                     )
 
+            if last_iter:
+                break
+
         if self.track_metrics:
             self._write_tracks(tracks, lca_iter, inputs.device.index)
 
@@ -434,21 +505,27 @@ class _LCAConvBase(torch.nn.Module):
 
     def _update_tracks(
         self,
-        tracks: dict[str, np.ndarray],
+        tracks: Tensor,
         lca_iter: int,
         acts: Tensor,
         inputs: Tensor,
         recons: Tensor,
         tau: Union[int, float],
-    ) -> dict[str, np.ndarray]:
-        """Update dictionary that stores the tracked metrics"""
-        l2_rec_err = compute_l2_error(inputs, recons).item()
-        l1_sparsity = compute_l1_sparsity(acts, self.lambda_).item()
-        tracks["L2"][lca_iter - 1] = l2_rec_err
-        tracks["L1"][lca_iter - 1] = l1_sparsity
-        tracks["TotalEnergy"][lca_iter - 1] = l2_rec_err + l1_sparsity
-        tracks["FractionActive"][lca_iter - 1] = compute_frac_active(acts)
-        tracks["Tau"][lca_iter - 1] = tau
+    ) -> Tensor:
+        """Update the device tensor that stores the tracked metrics (no host
+        sync)"""
+        with torch.no_grad():
+            l2_rec_err = compute_l2_error(inputs, recons)
+            l1_sparsity = compute_l1_sparsity(acts, self.lambda_)
+            tracks[:, lca_iter - 1] = torch.stack(
+                [
+                    l1_sparsity,
+                    l2_rec_err,
+                    l2_rec_err + l1_sparsity,
+                    (acts != 0.0).float().mean(),
+                    torch.full_like(l1_sparsity, float(tau)),
+                ]
+            ).float()
         return tracks
 
     def _write_params(self, arg_dict: dict[str, Any]) -> None:
@@ -463,11 +540,11 @@ class _LCAConvBase(torch.nn.Module):
             yaml.dump(arg_dict, yamlf, sort_keys=True)
 
     def _write_tracks(
-        self, tracker: dict[str, np.ndarray], ts_cutoff: int, dev: Union[int, None]
+        self, tracks: Tensor, ts_cutoff: int, dev: Union[int, None]
     ) -> None:
         """Write out objective values to file"""
-        for k, v in tracker.items():
-            tracker[k] = v[:ts_cutoff]
+        tracks = tracks[:, :ts_cutoff].cpu().numpy()
+        tracker = {k: tracks[idx] for idx, k in enumerate(TRACK_KEYS)}
 
         obj_df = pd.DataFrame(tracker)
         obj_df["LCAIter"] = np.arange(1, len(obj_df) + 1, dtype=np.int32)
@@ -537,6 +614,17 @@ class LCAConv1D(_LCAConvBase):
         weight_init (tuple(callable, dict), optional): Initialization to use
             for the dictionary weights and a dictionary of keyword arguments
             for that initialization. Default: truncated normal, default args
+        early_stop_tol (float, optional): Stop the LCA loop early once the
+            relative rate of change of the states, ||du/dt|| / ||u||, falls
+            below this value for every sample. None runs all lca_iters
+            iterations. Default: None
+        check_every (int, optional): Check for convergence every check_every
+            iterations (each check is one host sync). Default: 10
+        compile_step (bool, optional): Run the state update as one kernel
+            compiled with torch.compile. Default: False
+        amp_dtype ('float16' | 'bfloat16', optional): Compute the lateral
+            competition under autocast with this dtype, the states stay in
+            the input dtype. Default: None
 
     Shape:
         Input: (N, in_neurons, L)
@@ -584,6 +672,10 @@ class LCAConv1D(_LCAConvBase):
             torch.nn.init.trunc_normal_,
             {},
         ),
+        early_stop_tol: Optional[float] = None,
+        check_every: int = 10,
+        compile_step: bool = False,
+        amp_dtype: Optional[Literal["float16", "bfloat16"]] = None,
     ) -> None:
         super(LCAConv1D, self).__init__(
             out_neurons,
@@ -609,6 +701,10 @@ class LCAConv1D(_LCAConvBase):
             req_grad,
             weight_init,
             False,
+            early_stop_tol,
+            check_every,
+            compile_step,
+            amp_dtype,
         )
 
     def _init_weight_tensor(self) -> None:
@@ -708,6 +804,17 @@ class LCAConv2D(_LCAConvBase):
         weight_init (tuple(callable, dict), optional): Initialization to use
             for the dictionary weights and a dictionary of keyword arguments
             for that initialization. Default: truncated normal, default args
+        early_stop_tol (float, optional): Stop the LCA loop early once the
+            relative rate of change of the states, ||du/dt|| / ||u||, falls
+            below this value for every sample. None runs all lca_iters
+            iterations. Default: None
+        check_every (int, optional): Check for convergence every check_every
+            iterations (each check is one host sync). Default: 10
+        compile_step (bool, optional): Run the state update as one kernel
+            compiled with torch.compile. Default: False
+        amp_dtype ('float16' | 'bfloat16', optional): Compute the lateral
+            competition under autocast with this dtype, the states stay in
+            the input dtype. Default: None
 
     Shape:
         Input: (N, in_neurons, H, W)
@@ -755,6 +862,10 @@ class LCAConv2D(_LCAConvBase):
             torch.nn.init.trunc_normal_,
             {},
         ),
+        early_stop_tol: Optional[float] = None,
+        check_every: int = 10,
+        compile_step: bool = False,
+        amp_dtype: Optional[Literal["float16", "bfloat16"]] = None,
     ) -> None:
         super(LCAConv2D, self).__init__(
             out_neurons,
@@ -780,6 +891,10 @@ class LCAConv2D(_LCAConvBase):
             req_grad,
             weight_init,
             True,
+            early_stop_tol,
+            check_every,
+            compile_step,
+            amp_dtype,
         )
 
     def _init_weight_tensor(self) -> None:
@@ -884,6 +999,17 @@ class LCAConv3D(_LCAConvBase):
             in dimension D regardless of the value of the pad argument.
             Allows for control over padding in the depth dimension that is
             independent of that in the spatial dimensions.
+        early_stop_tol (float, optional): Stop the LCA loop early once the
+            relative rate of change of the states, ||du/dt|| / ||u||, falls
+            below this value for every sample. None runs all lca_iters
+            iterations. Default: None
+        check_every (int, optional): Check for convergence every check_every
+            iterations (each check is one host sync). Default: 10
+        compile_step (bool, optional): Run the state update as one kernel
+            compiled with torch.compile. Default: False
+        amp_dtype ('float16' | 'bfloat16', optional): Compute the lateral
+            competition under autocast with this dtype, the states stay in
+            the input dtype. Default: None
 
     Shape:
         Input: (N, in_neurons, D, H, W)
@@ -933,6 +1059,10 @@ class LCAConv3D(_LCAConvBase):
             {},
         ),
         no_time_pad: bool = False,
+        early_stop_tol: Optional[float] = None,
+        check_every: int = 10,
+        compile_step: bool = False,
+        amp_dtype: Optional[Literal["float16", "bfloat16"]] = None,
     ) -> None:
         super(LCAConv3D, self).__init__(
             out_neurons,
@@ -958,6 +1088,10 @@ class LCAConv3D(_LCAConvBase):
             req_grad,
             weight_init,
             no_time_pad,
+            early_stop_tol,
+            check_every,
+            compile_step,
+            amp_dtype,
         )
 
     def _init_weight_tensor(self) -> None:
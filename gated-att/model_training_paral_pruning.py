@@ -44,16 +44,25 @@ class GatedAttentionPooling(nn.Module):
         self.attention_U = nn.Linear(feature_dim, hidden_dim)
         self.attention_w = nn.Linear(hidden_dim, 1)
 
-    def forward(self, features: torch.Tensor) -> torch.Tensor:
+    def scores(self, features: torch.Tensor) -> torch.Tensor:
         """
         Args:
             features: [M, D]
         Returns:
-            attention_weights: [M, 1] softmax-normalized across M
+            attention logits: [M, 1] (row-wise, before the softmax)
         """
         V = torch.tanh(self.attention_V(features))
         U = torch.sigmoid(self.attention_U(features))
-        logits = self.attention_w(V * U)  # [M, 1]
+        return self.attention_w(V * U)
+
+    def forward(self, features: torch.Tensor) -> torch.Tensor:
+        """
+        Args:
+            features: [M, D]
+        Returns:
+            attention_weights: [M, 1] softmax-normalized across M
+        """
+        logits = self.scores(features)  # [M, 1]
         weights = torch.softmax(logits, dim=0)
         return weights
 
@@ -67,12 +76,15 @@ class GatedAttentionCEM(nn.Module):
 
     def __init__(self, feature_dim: int, hidden_dim: int = 128,
                  var_threshold: float = 0.1, reg_strength: float = 0.0,
-                 eps: float = 1e-6):
+                 eps: float = 1e-6, batched: bool = True):
         super().__init__()
         self.feature_dim = feature_dim
         self.var_threshold = var_threshold
         self.reg_strength = reg_strength
         self.eps = eps
+        # batched=True: segment softmax / segment reductions over the whole batch;
+        # False: per-class Python loop (reference implementation)
+        self.batched = batched
         self.pool = GatedAttentionPooling(feature_dim, hidden_dim)
         self.ln = nn.LayerNorm(feature_dim)
 
@@ -86,6 +98,71 @@ class GatedAttentionCEM(nn.Module):
             rob_loss: scalar tensor
             intra_mse: scalar tensor
         """
+        if self.batched:
+            return self.forward_batched(features, labels, unique_labels)
+        return self.forward_per_class(features, labels, unique_labels)
+
+    def forward_batched(self, features: torch.Tensor, labels: torch.Tensor, unique_labels: torch.Tensor):
+        """
+        Same losses as forward_per_class without the Python loop over classes: LayerNorm and the gated scores
+        are row-wise, so they run once on the full batch; the per-class softmax is a segment softmax
+        (scatter_reduce amax + index_add), and the weighted means / variances are index_add reductions.
+        """
+        device = features.device
+        dtype = features.dtype
+        B, D = features.shape
+        C = unique_labels.numel()
+
+        gamma = 1e-6
+        logvar_threshold = torch.tensor(
+            max(self.var_threshold * (self.reg_strength ** 2), 1e-8) + gamma,
+            device=device,
+            dtype=dtype,
+        )
+
+        # sample -> class index; samples whose label is not in unique_labels go to an extra segment C
+        onehot = labels.unsqueeze(1) == unique_labels.to(labels.device).unsqueeze(0)  # [B, C]
+        onehot = torch.cat([onehot, ~onehot.any(dim=1, keepdim=True)], dim=1)  # [B, C+1]
+        cls_idx = onehot.long().argmax(dim=1)  # [B]
+        counts = onehot.sum(dim=0)[:C]  # [C]
+
+        feats = self.ln(features)
+        logits = self.pool.scores(feats).squeeze(-1)  # [B]
+
+        # segment softmax over the samples of each class
+        seg_max = logits.new_full((C + 1,), -float('inf')).scatter_reduce(
+            0, cls_idx, logits.detach(), reduce='amax', include_self=True)
+        exp_logits = torch.exp(logits - seg_max[cls_idx])
+        denom = logits.new_zeros(C + 1).index_add(0, cls_idx, exp_logits)
+        att_weights = exp_logits / denom[cls_idx]  # [B]
+
+        # Weighted statistics
+        weighted_mean = feats.new_zeros(C + 1, D).index_add(0, cls_idx, att_weights.unsqueeze(-1) * feats)
+        diffs = feats - weighted_mean[cls_idx]
+        sq_diffs = diffs * diffs
+        var = feats.new_zeros(C + 1, D).index_add(0, cls_idx, att_weights.unsqueeze(-1) * sq_diffs)[:C]
+        var = torch.clamp(var, min=self.eps)
+
+        logvar = torch.log(var + gamma)
+        ce_sur = F.relu(logvar - torch.log(logvar_threshold))
+        logvar_c = ce_sur.mean(dim=1)  # [C]
+
+        # == F.mse_loss(class_feats, weighted_mean.expand_as(class_feats)) per class
+        mse_c = feats.new_zeros(C + 1).index_add(0, cls_idx, sq_diffs.mean(dim=1))[:C] / counts.clamp_min(1).to(dtype)
+
+        # classes with a single sample are skipped (no weight, no loss)
+        weight = counts.to(dtype) / float(B) * (counts > 1).to(dtype)
+        total_weight = weight.sum()
+        total_logvar = (logvar_c * weight).sum()
+        total_mse = (mse_c * weight).sum()
+
+        has_weight = total_weight > 0
+        safe_weight = torch.where(has_weight, total_weight, torch.ones_like(total_weight))
+        rob_loss = torch.where(has_weight, total_logvar / safe_weight, torch.zeros_like(total_logvar))
+        intra_mse = torch.where(has_weight, total_mse / safe_weight, torch.zeros_like(total_mse))
+        return rob_loss, intra_mse
+
+    def forward_per_class(self, features: torch.Tensor, labels: torch.Tensor, unique_labels: torch.Tensor):
         device = features.device
         dtype = features.dtype
         total_weight = torch.zeros((), device=device, dtype=dtype)
@@ -0,0 +1,210 @@
+import torch
+import torch.nn.functional as F
+
+# ============================================================================
+# Vectorised GPU k-means
+# All routines work on G independent groups packed as [G, M, D] with a token mask [G, M]
+# (G = 1 for a single class, G = num_class when every class is clustered at once).
+# Cluster k of group g is addressed by the flat index g * K + k (class-offset trick), so centroid
+# updates, counts, variances and covariances are single index_add / bmm calls with no Python loop
+# over clusters or classes.
+# ============================================================================
+
+def pack_by_group(X, group, num_groups):
+    """
+    Pack rows of X into a zero-padded [G, M_max, D] tensor.
+
+    Args:
+    - X (torch.Tensor): [N, ...] features, flattened to [N, D]
+    - group (torch.Tensor): [N] group (class) index in [0, num_groups)
+    - num_groups (int): G
+
+    Returns:
+    - packed [G, M_max, D], mask [G, M_max] (bool), pos [N] (row of each sample inside its group)
+    """
+    N = X.size(0)
+    X_flat = X.reshape(N, -1)
+    group = group.long()
+    onehot = F.one_hot(group, num_groups)  # [N, G]
+    pos = (onehot.cumsum(dim=0) - 1).gather(1, group.unsqueeze(1)).squeeze(1)
+    M_max = max(int(onehot.sum(dim=0).max()), 1) if N > 0 else 1
+    packed = X_flat.new_zeros(num_groups, M_max, X_flat.size(1))
+    mask = torch.zeros(num_groups, M_max, dtype=torch.bool, device=X.device)
+    packed[group, pos] = X_flat
+    mask[group, pos] = True
+    return packed, mask, pos
+
+
+def _as_groups(X, mask):
+    if X.dim() == 2:
+        X = X.unsqueeze(0)
+        if mask is not None:
+            mask = mask.unsqueeze(0)
+    if mask is None:
+        mask = torch.ones(X.shape[:2], dtype=torch.bool, device=X.device)
+    return X, mask
+
+
+def kmeans_plusplus_init(X, num_clusters, mask=None, generator=None):
+    """
+    KMeans++ initialization, batched over groups (one multinomial draw per group and per centroid).
+
+    Args:
+    - X (torch.Tensor): [N, D] or [G, M, D]
+    - num_clusters (int): Number of clusters K
+    - mask (torch.Tensor, optional): [G, M] valid rows
+
+    Returns:
+    - centroids (torch.Tensor): [K, D] for 2-D input, otherwise [G, K, D]
+    """
+    squeeze = X.dim() == 2
+    X, mask = _as_groups(X, mask)
+    G, M, D = X.shape
+    valid = mask.to(X.dtype)
+    centroids = X.new_empty(G, num_clusters, D)
+    batch_idx = torch.arange(G, device=X.device)
+
+    first = torch.multinomial(valid + 1e-12 * (valid.sum(dim=1, keepdim=True) == 0), 1, generator=generator).squeeze(1)
+    centroids[:, 0] = X[batch_idx, first]
+    # running min distance to the chosen centroids: only the newest centroid is compared each round
+    min_dist = torch.cdist(X, centroids[:, :1]).squeeze(2)
+    for i in range(1, num_clusters):
+        probs = min_dist * valid
+        # degenerate groups (all points on the centroids) fall back to uniform sampling
+        probs = torch.where(probs.sum(dim=1, keepdim=True) > 0, probs, valid + 1e-12)
+        idx = torch.multinomial(probs, 1, generator=generator).squeeze(1)
+        centroids[:, i] = X[batch_idx, idx]
+        min_dist = torch.minimum(min_dist, torch.cdist(X, centroids[:, i:i + 1]).squeeze(2))
+
+    return centroids.squeeze(0) if squeeze else centroids
+
+
+def random_init(X, num_clusters, mask=None, generator=None):
+    """Pick num_clusters distinct valid rows per group uniformly at random. Returns [K, D] or [G, K, D]."""
+    squeeze = X.dim() == 2
+    X, mask = _as_groups(X, mask)
+    G, M, D = X.shape
+    scores = torch.rand(G, M, device=X.device, generator=generator)
+    scores = scores.masked_fill(~mask, -1.0)
+    k = min(num_clusters, M)
+    idx = scores.topk(k, dim=1).indices  # [G, k]
+    centroids = X.gather(1, idx.unsqueeze(-1).expand(G, k, D))
+    if k < num_clusters:
+        centroids = torch.cat([centroids, centroids[:, -1:].expand(G, num_clusters - k, D)], dim=1)
+    return centroids.squeeze(0) if squeeze else centroids
+
+
+def _segment_means(X, assign, mask, num_clusters, fallback):
+    # class-offset flat cluster index: group g, cluster k -> g * K + k
+    G, M, D = X.shape
+    flat_idx = (assign + torch.arange(G, device=X.device).unsqueeze(1) * num_clusters).view(-1)
+    valid = mask.to(X.dtype).view(-1)
+    counts = X.new_zeros(G * num_clusters).index_add_(0, flat_idx, valid)
+    sums = X.new_zeros(G * num_clusters, D).index_add_(0, flat_idx, X.reshape(G * M, D) * valid.unsqueeze(1))
+    counts = counts.view(G, num_clusters)
+    means = sums.view(G, num_clusters, D) / counts.clamp_min(1).unsqueeze(-1)
+    # empty clusters keep their previous centroid
+    means = torch.where(counts.unsqueeze(-1) > 0, means, fallback)
+    return means, counts
+
+
+def kmeans(X, num_clusters, centroids=None, mask=None, num_iterations=10, tol=1e-4, check_every=5,
+           init="kmeans++", generator=None):
+    """
+    Lloyd's k-means on [N, D] or packed [G, M, D] data.
+
+    Convergence (assignments unchanged, or squared centroid shift <= tol) is evaluated on the device every
+    iteration but only read back to the host every check_every iterations; once converged the Lloyd update
+    is a fixed point, so the extra iterations do not change the result.
+
+    Returns:
+    - centroids [K, D] / [G, K, D], assignments [N] / [G, M]
+    """
+    squeeze = X.dim() == 2
+    X, mask = _as_groups(X, mask)
+    if centroids is None:
+        if init == "kmeans++":
+            centroids = kmeans_plusplus_init(X, num_clusters, mask=mask, generator=generator)
+        else:
+            centroids = random_init(X, num_clusters, mask=mask, generator=generator)
+    elif centroids.dim() == 2:
+        centroids = centroids.unsqueeze(0)
+    centroids = centroids.to(X.dtype).clone()
+
+    assign = torch.full(mask.shape, -1, dtype=torch.long, device=X.device)
+    for it in range(num_iterations):
+        new_assign = torch.cdist(X, centroids).argmin(dim=2)  # [G, M]
+        new_centroids, _ = _segment_means(X, new_assign, mask, num_clusters, centroids)
+        same_assign = ((new_assign == assign) | ~mask).all()
+        shift = ((new_centroids - centroids) ** 2).sum()
+        converged = same_assign | (shift <= tol)
+        assign, centroids = new_assign, new_centroids
+        if (it + 1) % check_every == 0 and bool(converged):
+            break
+
+    assign = assign.masked_fill(~mask, -1)
+    if squeeze:
+        return centroids.squeeze(0), assign.squeeze(0)
+    return centroids, assign
+
+
+def cluster_statistics(X, assign, centroids, mask=None, covariance=False):
+    """
+    Per-cluster counts, weights, mean squared deviation from the centroid and (optionally) unbiased
+    covariances, computed in one pass over the data.
+
+    Args:
+    - X: [N, D] or [G, M, D]; assign: [N] / [G, M] (-1 for padding); centroids: [K, D] / [G, K, D]
+
+    Returns:
+    - counts [.., K], weights [.., K] (count / group size), variances [.., K],
+      covariances [.., K, D, D] or None
+    """
+    squeeze = X.dim() == 2
+    X, mask = _as_groups(X, mask)
+    if squeeze:
+        assign = assign.unsqueeze(0)
+        centroids = centroids.unsqueeze(0)
+    G, M, D = X.shape
+    K = centroids.size(1)
+    safe_assign = assign.clamp_min(0)
+    means, counts = _segment_means(X, safe_assign, mask, K, centroids)
+
+    valid = mask.to(X.dtype)
+    flat_idx = (safe_assign + torch.arange(G, device=X.device).unsqueeze(1) * K).view(-1)
+    sq_dev = ((X - centroids.gather(1, safe_assign.unsqueeze(-1).expand(G, M, D))) ** 2).mean(dim=2)
+    sq_sum = X.new_zeros(G * K).index_add_(0, flat_idx, (sq_dev * valid).view(-1)).view(G, K)
+    variances = sq_sum / counts.clamp_min(1)
+    weights = counts / valid.sum(dim=1, keepdim=True).clamp_min(1)
+
+    covariances = None
+    if covariance:
+        # cov_k = Xc^T diag(1[assign == k]) Xc / (n_k - 1), one bmm over the groups per cluster;
+        # the masked copy of Xc is the only temporary, so memory stays at the size of X
+        Xc = X - means.gather(1, safe_assign.unsqueeze(-1).expand(G, M, D))
+        covariances = X.new_empty(G, K, D, D)
+        for k in range(K):
+            Xk = Xc * ((safe_assign == k).to(X.dtype) * valid).unsqueeze(-1)
+            covariances[:, k] = torch.bmm(Xk.transpose(1, 2), Xk)
+        covariances = covariances / (counts - 1).clamp_min(1).view(G, K, 1, 1)
+
+    if squeeze:
+        counts, weights, variances = counts.squeeze(0), weights.squeeze(0), variances.squeeze(0)
+        covariances = covariances.squeeze(0) if covariances is not None else None
+    return counts, weights, variances, covariances
+
+
+def kmeans_by_class(X, labels, num_classes, num_clusters, centroids=None, num_iterations=10, tol=1e-4,
+                    check_every=5, init="kmeans++", generator=None):
+    """
+    Cluster every class at once: features are packed per class and one batched Lloyd iteration updates all
+    num_classes * num_clusters centroids.
+
+    Returns:
+    - centroids [C, K, D], per-sample assignments [N] (cluster index within the sample's class), counts [C, K]
+    """
+    packed, mask, pos = pack_by_group(X, labels, num_classes)
+    centroids, assign = kmeans(packed, num_clusters, centroids=centroids, mask=mask, num_iterations=num_iterations,
+                               tol=tol, check_every=check_every, init=init, generator=generator)
+    _, counts = _segment_means(packed, assign.clamp_min(0), mask, num_clusters, centroids)
+    return centroids, assign[labels.long(), pos], counts
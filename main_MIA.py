@@ -43,6 +43,7 @@ parser.add_argument('--gan_loss_type', default="SSIM", type=str, help='loss type
 parser.add_argument('--bottleneck_option', default="None", type=str, help='set bottleneck option')
 parser.add_argument('--optimize_computation', default=1, type=int, help='set interval N to optimize_computation')
 parser.add_argument('--decoder_sync', action='store_true', default=False, help='if True, we sync decoder')
+parser.add_argument('--cem_double_backward', action='store_true', default=False, help='if True, mix CEM gradients with the legacy two-pass backward')
 
 #training dataset setting ()
 parser.add_argument('--load_from_checkpoint', action='store_true', default=False, help='if True, we load_from_checkpoint')
@@ -50,6 +51,7 @@ parser.add_argument('--load_from_checkpoint_server', action='store_true', defaul
 parser.add_argument('--transfer_source_task', default="cifar100", type=str, help='the name of the transfer_source_task, option: cifar10, cifar100')
 parser.add_argument('--finetune_freeze_bn', action='store_true', default=False, help='if True, we finetune_freeze_bn')
 parser.add_argument('--save_more_checkpoints', action='store_true', default=False, help='if True, we save_more_checkpoints')
+parser.add_argument('--data_resident', default=None, choices=['gpu', 'pinned'], help='keep cifar10/cifar100/svhn training data on the GPU or in pinned memory, augment on device')
 parser.add_argument('--initialize_different', action='store_true', default=False, help='if True, we initialze differently for different client')
 
 
@@ -73,7 +75,8 @@ mi = model_training_paral_pruning.MIA_train(args.arch, cutting_layer, batch_size
                  optimize_computation = args.optimize_computation, decoder_sync = args.decoder_sync, 
                  finetune_freeze_bn = args.finetune_freeze_bn, gan_loss_type=args.gan_loss_type, ssim_threshold = args.ssim_threshold,var_threshold = args.var_threshold,
                  source_task = args.transfer_source_task, load_from_checkpoint_server = args.load_from_checkpoint_server, save_more_checkpoints = args.save_more_checkpoints,
-                 dataset_portion = args.dataset_portion, noniid = args.noniid, client_sample_ratio = args.client_sample_ratio)
+                 dataset_portion = args.dataset_portion, noniid = args.noniid, client_sample_ratio = args.client_sample_ratio,
+                 cem_single_backward = not args.cem_double_backward, data_resident = args.data_resident)
 mi.logger.debug(str(args))
 
 log_frequency = 500
@@ -0,0 +1,152 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def lca_step(b, u, inhibition, alpha: float, lmbda: float):
+    # u <- soft_threshold(u + (b - inhibition - alpha * u));
+    # soft_threshold(v) = sign(v) * relu(|v| - lmbda) = v - clamp(v, -lmbda, lmbda)
+    v = b - inhibition + (1.0 - alpha) * u
+    return v - torch.clamp(v, -lmbda, lmbda)
+
+
+_compiled_lca_step = None
+
+
+def fused_lca_step(b, u, inhibition, alpha: float, lmbda: float):
+    """lca_step compiled into one elementwise kernel (torch.compile); falls back to eager if compilation fails."""
+    global _compiled_lca_step
+    if _compiled_lca_step is None:
+        _compiled_lca_step = torch.compile(lca_step, dynamic=True) if hasattr(torch, "compile") else lca_step
+    try:
+        return _compiled_lca_step(b, u, inhibition, alpha, lmbda)
+    except Exception:
+        _compiled_lca_step = lca_step
+        return lca_step(b, u, inhibition, alpha, lmbda)
+
+
+class LCALayer(nn.Module):
+    """
+    Locally competitive algorithm layer: sparse code u of the flattened input on the dictionary W
+    (num_neurons x input_dim), returns the reconstruction u W reshaped to the input shape.
+
+    - The first iteration starts from u = 0 and needs no inhibition term, so num_iterations=1 never touches W W^T.
+    - Later iterations use whichever is cheaper: the Gram matrix W W^T (cached across calls while W is unchanged
+      and no gradient is needed) or the factored product (u W) W^T.
+    - sparse_threshold: outside autograd, if the fraction of non-zero codes is below it, inhibition and
+      reconstruction only use the active neurons (columns of u with any non-zero entry).
+    - compile_step: run the update + soft-threshold of the later iterations as one compiled kernel.
+    """
+    def __init__(self, input_shape, num_neurons, alpha=0.2, lmbda=0.01, num_iterations=2, sparse_threshold=None,
+                 compile_step=False):
+        super(LCALayer, self).__init__()
+        self.num_neurons = num_neurons
+        self.alpha = alpha
+        self.lmbda = lmbda
+        self.num_iterations = num_iterations
+        self.sparse_threshold = sparse_threshold
+        self.compile_step = compile_step
+
+        input_dim = input_shape[0] * input_shape[1] * input_shape[2]  # 3 * 32 * 32 = 3072
+        self.W = nn.Parameter(torch.randn(num_neurons, input_dim))
+
+        self.W.data = F.normalize(self.W.data, p=2, dim=1)
+        self._gram = None
+        self._gram_key = None
+
+    def gram(self):
+        """W W^T; cached (keyed on the parameter version) when no graph has to be recorded."""
+        if torch.is_grad_enabled() and self.W.requires_grad:
+            return torch.matmul(self.W, self.W.t())
+        key = (self.W._version, self.W.data_ptr(), self.W.device, self.W.dtype)
+        if self._gram_key != key:
+            with torch.no_grad():
+                self._gram = torch.matmul(self.W, self.W.t())
+            self._gram_key = key
+        return self._gram
+
+    def _use_gram(self, batch_size, input_dim):
+        # flops: Gram N*N*D (free if cached) + B*N*N  vs  factored 2*B*N*D, for the remaining iterations
+        n, iters = self.num_neurons, self.num_iterations - 1
+        cached = self._gram is not None and self._gram_key is not None and not torch.is_grad_enabled()
+        gram_cost = (0 if cached else n * n * input_dim) + iters * batch_size * n * n
+        return gram_cost <= iters * 2 * batch_size * n * input_dim
+
+    def _active(self, u):
+        # indices of active neurons if the code is sparse enough, else None (dense path)
+        if self.sparse_threshold is None or torch.is_grad_enabled():
+            return None
+        active = (u != 0).any(dim=0)
+        if active.float().mean().item() >= self.sparse_threshold:
+            return None
+        return torch.nonzero(active).squeeze(1)
+
+    def forward(self, x):
+        batch_size = x.size(0)
+        input_dim = x.size(1) * x.size(2) * x.size(3)
+        c,h,w=x.size(1) , x.size(2) , x.size(3)
+        x = x.reshape(batch_size, input_dim)
+
+        b = F.linear(x, self.W)
+        # first iteration from u = 0: u = soft_threshold(b)
+        u = b - torch.clamp(b, -self.lmbda, self.lmbda)
+
+        if self.num_iterations > 1:
+            WWT = self.gram() if self._use_gram(batch_size, input_dim) else None
+            for _ in range(self.num_iterations - 1):
+                idx = self._active(u)
+                if idx is not None:
+                    u_act = u.index_select(1, idx)
+                    if WWT is not None:
+                        inhibition = torch.matmul(u_act, WWT.index_select(0, idx))
+                    else:
+                        inhibition = torch.matmul(torch.matmul(u_act, self.W.index_select(0, idx)), self.W.t())
+                elif WWT is not None:
+                    inhibition = torch.matmul(u, WWT)
+                else:
+                    inhibition = torch.matmul(torch.matmul(u, self.W), self.W.t())
+                step = fused_lca_step if self.compile_step else lca_step
+                u = step(b, u, inhibition, self.alpha, self.lmbda)
+
+        # 将 sparse code 重构回 input_dim（3072）
+        idx = self._active(u)
+        if idx is not None:
+            reconstruction = torch.matmul(u.index_select(1, idx), self.W.index_select(0, idx))
+        else:
+            reconstruction = F.linear(u, self.W.t())  # (batch_size, 3072)
+
+        # 将重构后的输入 reshape 为 (batch_size, 3, 32, 32)
+        reconstruction = reconstruction.view(batch_size, c, h, w)
+        return reconstruction
+
+    def soft_threshold(self, u, lmbda):
+        return torch.sign(u) * F.relu(torch.abs(u) - lmbda)
+
+
+def test_lca_layer(seed=0): # parity with the original dense loop: factored / Gram (cached) / sparse paths
+    torch.manual_seed(seed)
+    layer = LCALayer(input_shape=(8, 4, 4), num_neurons=128, alpha=0.05, lmbda=0.05, num_iterations=3).double()
+
+    def reference(x):
+        xf = x.reshape(x.size(0), -1)
+        u = torch.zeros(x.size(0), layer.num_neurons, dtype=x.dtype)
+        b = F.linear(xf, layer.W)
+        WWT = torch.matmul(layer.W, layer.W.t())
+        for _ in range(layer.num_iterations):
+            u = layer.soft_threshold(u + b - torch.matmul(u, WWT) - layer.alpha * u, layer.lmbda)
+        return F.linear(u, layer.W.t()).view(x.shape)
+
+    ok = True
+    for batch_size in [4, 64]:  # small batches take the factored path, large ones the Gram path
+        layer.sparse_threshold = None
+        x = torch.randn(batch_size, 8, 4, 4, dtype=torch.float64, requires_grad=True)
+        ref = reference(x)
+        out = layer(x)
+        g_ref = torch.autograd.grad(ref.square().sum(), [x, layer.W])
+        g_out = torch.autograd.grad(out.square().sum(), [x, layer.W])
+        ok = ok and torch.allclose(ref, out) and all(torch.allclose(a, b) for a, b in zip(g_ref, g_out))
+        with torch.no_grad():
+            ok = ok and torch.allclose(layer(x), ref) and torch.allclose(layer(x), ref)  # Gram cached on 2nd call
+            layer.sparse_threshold = 1.01
+            ok = ok and torch.allclose(layer(x), ref)
+    return ok
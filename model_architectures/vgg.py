@@ -9,6 +9,7 @@ import torch.nn as nn
 from torch.nn.functional import sigmoid
 import torch.nn.functional as F
 from thop import profile
+from model_architectures.lca_layer import LCALayer
 __all__ = [
     'VGG', 'vgg11', 'vgg11_bn','vgg11_bn_sgm', 'vgg13', 'vgg13_bn', 'vgg16', 'vgg16_bn',
     'vgg19_bn', 'vgg19',
@@ -24,45 +25,7 @@ def init_weights(m):
         if m.bias is not None: 
             m.bias.data.zero_()
 
-class LCALayer(nn.Module):
-    def __init__(self, input_shape, num_neurons, alpha=0.2, lmbda=0.01, num_iterations=2):
-        super(LCALayer, self).__init__()
-        self.num_neurons = num_neurons
-        self.alpha = alpha
-        self.lmbda = lmbda
-        self.num_iterations = num_iterations
-
-        input_dim = input_shape[0] * input_shape[1] * input_shape[2]  # 3 * 32 * 32 = 3072
-        self.W = nn.Parameter(torch.randn(num_neurons, input_dim))
-
-        self.W.data = F.normalize(self.W.data, p=2, dim=1)
-
-    def forward(self, x):
-        batch_size = x.size(0)
-        input_dim = x.size(1) * x.size(2) * x.size(3)
-        c,h,w=x.size(1) , x.size(2) , x.size(3)
-        x = x.view(batch_size, input_dim)
-
-        u = torch.zeros(batch_size, self.num_neurons, device=x.device)
-        b = F.linear(x, self.W)
-
-        WWT = torch.matmul(self.W, self.W.t())
-
-        for _ in range(self.num_iterations):
-            inhibition = torch.matmul(u, WWT)
-            du = b - inhibition - self.alpha * u
-            u = u + du
-            u = self.soft_threshold(u, self.lmbda)
-
-        # 将 sparse code 重构回 input_dim（3072）
-        reconstruction = F.linear(u, self.W.t())  # (batch_size, 3072)
-
-        # 将重构后的输入 reshape 为 (batch_size, 3, 32, 32)
-        reconstruction = reconstruction.view(batch_size, c, h, w)
-        return reconstruction
-
-    def soft_threshold(self, u, lmbda):
-        return torch.sign(u) * F.relu(torch.abs(u) - lmbda)
+# LCALayer (Gram cache, fused soft-threshold step, sparse path) lives in lca_layer.py
 
 
 class VGG(nn.Module):
@@ -3,8 +3,10 @@ import numpy as np
 import torch.nn as nn
 from torch.serialization import save
 import architectures_torch as architectures
-from utils import setup_logger, accuracy, AverageMeter, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
-from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, prune_top_n_percent_left, dropout_defense, prune_defense
+import defenses
+from plot_worker import PlotWorker
+from utils import setup_logger, accuracy, AverageMeter, ClassFeatureStats, FeatureRingBuffer, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
+from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, IRStoreWriter, load_ir_store, scale_grad
 from thop import profile
 import logging
 from torch.autograd import Variable
@@ -17,13 +19,11 @@ import torch.nn.functional as F
 import torchvision
 import matplotlib
 matplotlib.use('Agg')  # 使用无显示后端，避免Qt错误
-import matplotlib.pyplot as plt
 from torchvision.utils import save_image
 from datetime import datetime
 import os
 import time
 from shutil import rmtree
-from sklearn.manifold import TSNE
 from datasets_torch import get_cifar100_trainloader, get_cifar100_testloader, get_cifar10_trainloader, \
     get_cifar10_testloader, get_mnist_bothloader, get_facescrub_bothloader, get_SVHN_trainloader, get_SVHN_testloader, get_fmnist_bothloader, get_tinyimagenet_bothloader
 from torch.optim.lr_scheduler import CosineAnnealingLR
@@ -81,8 +81,9 @@ class SlotAttention(nn.Module):
 
         self.scale = self.slot_dim ** -0.5
 
-    def forward(self, inputs: torch.Tensor, return_attn_logits: bool = False):
+    def forward(self, inputs: torch.Tensor, return_attn_logits: bool = False, mask: torch.Tensor = None):
         # inputs: [B, N, D]
+        # mask:   [B, N] (bool, optional) True for real tokens, False for padding
         B, N, D = inputs.shape
         assert D == self.feature_dim
 
@@ -110,7 +111,12 @@ class SlotAttention(nn.Module):
             attn = F.softmax(attn_logits, dim=-1)  # softmax over slots
             # Weighted-normalized aggregation across tokens (add epsilon then renormalize over tokens)
             attn = attn + self.eps
-            attn = attn / (attn.sum(dim=1, keepdim=True))
+            if mask is not None:
+                # padded tokens take no part in the aggregation; clamp keeps all-padding rows finite
+                attn = attn * mask.unsqueeze(-1).to(attn.dtype)
+                attn = attn / attn.sum(dim=1, keepdim=True).clamp_min(self.eps)
+            else:
+                attn = attn / (attn.sum(dim=1, keepdim=True))
 
             # Weighted mean: updates [B, S, D]
             updates = torch.einsum('bns,bnd->bsd', attn, v)
@@ -227,18 +233,28 @@ class CrossAttention(nn.Module):
 # ----------------------------
 class SlotCrossAttentionCEM(nn.Module):
     def __init__(self, feature_dim=128, num_slots=8, num_heads=4, num_iterations=3,
-                 eps_var=1e-4, var_threshold=0.1, reg_strength=0.0):
+                 eps_var=1e-4, var_threshold=0.1, reg_strength=0.0, batched=True):
         super().__init__()
         self.num_slots = num_slots
         self.feature_dim = feature_dim
         self.eps_var = eps_var
         self.var_threshold = var_threshold
         self.reg_strength = reg_strength
+        # batched=True: 所有类打包成 [C, M_max, D] 一次性计算；False: 逐类 Python 循环（参考实现）
+        self.batched = batched
 
         self.slot_attention = SlotAttention(feature_dim, num_slots, num_iterations)
         self.cross_attention = CrossAttention(feature_dim, num_heads=num_heads)
         self.slots_proj = None  # optional projection if slot_dim != feature_dim
 
+    def _project_slots(self, slots_out, device):
+        # project to feature_dim if needed
+        if slots_out.shape[-1] != self.feature_dim:
+            if self.slots_proj is None:
+                self.slots_proj = nn.Linear(slots_out.shape[-1], self.feature_dim).to(device)
+            return self.slots_proj(slots_out)
+        return slots_out
+
     def forward(self, features, labels, unique_labels):
         """
         features: [B, D]
@@ -248,6 +264,68 @@ class SlotCrossAttentionCEM(nn.Module):
           rob_loss: 类内 log-variance 的类平均（条件熵 surrogate）
           intra_mse: 类内 MSE 的类平均（用于监控/辅助）
         """
+        if self.batched:
+            return self.forward_batched(features, labels, unique_labels)
+        return self.forward_per_class(features, labels, unique_labels)
+
+    def forward_batched(self, features, labels, unique_labels):
+        """
+        无 Python 类循环的版本：把所有类打包成 padded [C, M_max, D] + token mask，
+        slot/cross attention 各只跑一次，类内统计用 index_add 分段归约。
+        与 forward_per_class 数值一致（slot 初始化噪声相同的前提下）。
+        """
+        device, dtype = features.device, features.dtype
+        B_total, D = features.shape
+        C = unique_labels.numel()
+
+        gamma = 1e-3
+        logvar_threshold = torch.tensor(self.var_threshold * (self.reg_strength ** 2) + gamma,
+                                        device=device, dtype=dtype)
+
+        # 1) 样本 -> 类下标；不在 unique_labels 中的样本归入额外的第 C 行，最后丢弃
+        onehot = labels.unsqueeze(1) == unique_labels.to(labels.device).unsqueeze(0) # [B, C]
+        onehot = torch.cat([onehot, ~onehot.any(dim=1, keepdim=True)], dim=1).long() # [B, C+1]
+        cls_idx = onehot.argmax(dim=1) # [B]
+        pos = (onehot.cumsum(dim=0) - 1).gather(1, cls_idx.unsqueeze(1)).squeeze(1) # 类内序号 [B]
+        counts = onehot.sum(dim=0) # [C+1]
+        M_max = int(counts.max()) # 每步唯一一次 host 同步
+
+        # 2) 打包 tokens -> 共享 slots（每类一组）
+        tokens = features.new_zeros(C + 1, M_max, D)
+        token_mask = torch.zeros(C + 1, M_max, dtype=torch.bool, device=device)
+        tokens[cls_idx, pos] = features
+        token_mask[cls_idx, pos] = True
+        slots_out = self.slot_attention(tokens[:C], mask=token_mask[:C]) # [C, S, D_slot]
+        slots = self._project_slots(slots_out, device)
+        slots = torch.cat([slots, slots.new_zeros(1, *slots.shape[1:])], dim=0) # [C+1, S, D]
+
+        # 3) 并行 cross-attn：每个样本查询自己类的 slots
+        enhanced = self.cross_attention(features, slots[cls_idx]) # [B, D]
+
+        # 4) 分段类内统计（两遍法，与 Tensor.var(unbiased=False) 一致）
+        counts_f = counts.to(dtype).clamp_min(1).unsqueeze(1) # [C+1, 1]
+        mean_c = features.new_zeros(C + 1, D).index_add_(0, cls_idx, enhanced) / counts_f
+        sq_dev = (enhanced - mean_c[cls_idx]) ** 2
+        var_c = features.new_zeros(C + 1, D).index_add_(0, cls_idx, sq_dev) / counts_f
+        var_c, counts = var_c[:C], counts[:C]
+
+        mse_c = var_c.mean(dim=1) # == F.mse_loss(enhanced_c, mean_c)
+        logvar = torch.log(var_c + self.eps_var + gamma)
+        logvar_c = F.relu(logvar - torch.log(logvar_threshold)).mean(dim=1)
+
+        w = counts.to(dtype) / float(B_total)
+        multi = (counts > 1).to(dtype) # 单样本类只计权重，不计损失
+        total_logvar = (logvar_c * w * multi).sum()
+        total_mse = (mse_c * w * multi).sum()
+        total_weight = w.sum()
+
+        has_weight = total_weight > 0
+        safe_weight = torch.where(has_weight, total_weight, torch.ones_like(total_weight))
+        rob_loss = torch.where(has_weight, total_logvar / safe_weight, torch.zeros_like(total_logvar))
+        intra_mse = torch.where(has_weight, total_mse / safe_weight, torch.zeros_like(total_mse))
+        return rob_loss, intra_mse
+
+    def forward_per_class(self, features, labels, unique_labels):
         device, dtype = features.device, features.dtype
         total_logvar = torch.zeros((), device=device, dtype=dtype)
         total_mse = torch.zeros((), device=device, dtype=dtype)
@@ -270,13 +348,7 @@ class SlotCrossAttentionCEM(nn.Module):
             tokens = class_feats.unsqueeze(0) # [1, M, D]
             slots_out = self.slot_attention(tokens) # [1, S, D_slot]
             slots_out = slots_out.squeeze(0) # [S, D_slot]
-            # project to feature_dim if needed
-            if slots_out.shape[-1] != self.feature_dim:
-                if self.slots_proj is None:
-                    self.slots_proj = nn.Linear(slots_out.shape[-1], self.feature_dim).to(features.device)
-                slots = self.slots_proj(slots_out)
-            else:
-                slots = slots_out
+            slots = self._project_slots(slots_out, features.device)
 
             # 2) 并行 cross-attn：Q=[M,D], KV=[S,D]（共享）
             enhanced = self.cross_attention(class_feats, slots) # [M, D]
@@ -368,6 +440,33 @@ def test_denorm(): # test function for denorm
     recovered_image = denormalize(images, "cifar100")
     return torch.isclose(orig_image, recovered_image)
 
+def test_cem_grad_mixing(grad_scale=2.5, seed=0): # parity test: single-backward CEM mixing vs. two-pass mixing
+    def make_grads(single_backward):
+        torch.manual_seed(seed)
+        f = nn.Sequential(nn.Conv2d(3, 4, 3, padding=1), nn.BatchNorm2d(4), nn.ReLU())
+        head = nn.Sequential(nn.Flatten(), nn.Linear(4 * 8 * 8, 10))
+        cem = SlotCrossAttentionCEM(feature_dim=4 * 8 * 8, num_heads=4, var_threshold=0.1, reg_strength=0.5)
+        x = torch.randn(32, 3, 8, 8)
+        y = torch.randint(0, 10, (32,))
+        z = f(x)
+        z_cem = scale_grad(z, grad_scale) if single_backward else z
+        rob_loss, _ = cem(z_cem.view(z.size(0), -1), y, torch.unique(y))
+        total_loss = F.cross_entropy(head(z), y)
+        if single_backward:
+            (total_loss + rob_loss).backward()
+        else:
+            rob_loss.backward(retain_graph=True)
+            encoder_gradients = {name: param.grad.clone() for name, param in f.named_parameters()}
+            f.zero_grad()
+            total_loss.backward()
+            for name, param in f.named_parameters():
+                param.grad += grad_scale * encoder_gradients[name]
+        modules = [f, head, cem]
+        return [p.grad.clone() for m in modules for p in m.parameters() if p.grad is not None]
+    grads_single, grads_two_pass = make_grads(True), make_grads(False)
+    return len(grads_single) == len(grads_two_pass) and all(
+        torch.allclose(g1, g2, rtol=1e-4, atol=1e-6) for g1, g2 in zip(grads_single, grads_two_pass))
+
 def save_images(input_imgs, output_imgs, epoch, path, offset=0, batch_size=64): # saved image from tensor to jpg
     """
     """
@@ -398,9 +497,12 @@ class MIA_train: # main class for every thing
                  load_from_checkpoint = False, bottleneck_option="None", measure_option=False,
                  optimize_computation=1, decoder_sync = False, bhtsne_option = False, gan_loss_type = "SSIM", attack_confidence_score = False,
                  ssim_threshold = 0.0, var_threshold = 0.1, finetune_freeze_bn = False, load_from_checkpoint_server = False, source_task = "cifar100", 
-                 save_activation_tensor = False, save_more_checkpoints = False, dataset_portion = 1.0, noniid = 1.0):
+                 save_activation_tensor = False, save_more_checkpoints = False, dataset_portion = 1.0, noniid = 1.0,
+                 cem_single_backward = True, feature_sweep_freq = 1):
         torch.manual_seed(random_seed)
         np.random.seed(random_seed)
+        # RNG for the activation defences (noise / dropout), drawn on the device, reproducible from random_seed
+        self.defense_generator = defenses.make_generator("cuda" if torch.cuda.is_available() else "cpu", random_seed)
         self.arch = arch
         self.bhtsne = bhtsne_option
         self.batch_size = batch_size
@@ -419,6 +521,16 @@ class MIA_train: # main class for every thing
        # self.dataset_portion = dataset_portion
        # self.noniid_ratio = noniid
         self.save_more_checkpoints = save_more_checkpoints
+        # t-SNE / curve plots are rendered in a background process
+        self.plot_worker = PlotWorker()
+        # True: mix the CEM gradient into the encoder with one backward pass (grad hook on z_private)
+        # False: legacy two-pass mixing (rob_loss.backward(retain_graph=True) + manual grad add)
+        self.cem_single_backward = cem_single_backward
+        # epoch-level feature statistics: K -> eval-mode feature sweep over the client data every K epochs
+        # (1 = every epoch, the original behaviour); 0 -> capture the z_private of the training steps instead
+        # (no extra forward pass, but train-mode features taken while the weights are being updated)
+        self.feature_sweep_freq = feature_sweep_freq
+        self.feature_ring = FeatureRingBuffer(capacity=10000)
 
         # setup save folder
         if save_dir is None:
@@ -972,6 +1084,15 @@ class MIA_train: # main class for every thing
         intra_class_mse = intra_mse
         return loss, intra_class_mse
 
+    def cem_grad_scale(self):
+        # factor applied to the encoder gradient of rob_loss, LR-dependent unless fine-tuning from a checkpoint
+        if self.load_from_checkpoint:
+            return self.lambd
+        lr = self.train_scheduler.get_last_lr()[0]
+        if lr < 0.00041:
+            return self.lambd
+        return self.lambd * (0.001 / lr)
+
     '''Main training function, the communication between client/server is implicit to keep a fast training speed'''
     def train_target_step(self, x_private, label_private, adding_noise,random_ini_centers,centroids_list,client_id=0):
         # 确保每个 step 开始即清空上一步的梯度，避免梯度累积导致更新异常
@@ -991,7 +1112,13 @@ class MIA_train: # main class for every thing
         unique_labels = torch.unique(label_private)
 
         if not random_ini_centers and self.lambd>0:
-            rob_loss,intra_class_mse = self.compute_class_means(z_private, label_private, unique_labels, centroids_list)
+            if self.cem_single_backward:
+                # the CEM branch sees a view whose gradient is pre-scaled, so one backward pass yields
+                # grad(total_loss) + cem_grad_scale * grad(rob_loss) on the encoder
+                z_cem = scale_grad(z_private, self.cem_grad_scale())
+            else:
+                z_cem = z_private
+            rob_loss,intra_class_mse = self.compute_class_means(z_cem, label_private, unique_labels, centroids_list)
         else:
             rob_loss,intra_class_mse=torch.tensor(0.0),torch.tensor(0.0)
         # assert 1==0, print(x_private.shape,label_private.shape,unique_values)
@@ -1004,25 +1131,18 @@ class MIA_train: # main class for every thing
                     sigma = self.regularization_strength
             else:
                 sigma = self.regularization_strength
-            noise = sigma * torch.randn_like(z_private).cuda()
+            noise = defenses.gaussian_noise(z_private, sigma, generator=self.defense_generator)
             z_private_n =z_private + noise
         else:
             z_private_n=z_private
         # Perform various activation defenses, default no defense (apply on z_private_n which flows to server)
         if self.local_DP:
-            if "laplace" in self.AT_regularization_option:
-                noise = torch.from_numpy(
-                    np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=z_private_n.size())).cuda()
-                z_private_n = z_private_n + noise.detach().float()
-            else:  # apply gaussian noise
-                delta = 10e-5
-                sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                noise = sigma * torch.randn_like(z_private_n).cuda()
-                z_private_n = z_private_n + noise.detach().float()
+            z_private_n = z_private_n + defenses.local_dp_noise(z_private_n, self.dp_epsilon, laplace="laplace" in self.AT_regularization_option,
+                                                                generator=self.defense_generator)
         if self.dropout_defense:
-            z_private_n = dropout_defense(z_private_n, self.dropout_ratio)
+            z_private_n = defenses.dropout_defense(z_private_n, self.dropout_ratio, generator=self.defense_generator)
         if self.topkprune:
-            z_private_n = prune_defense(z_private_n, self.topkprune_ratio)
+            z_private_n = defenses.prune_defense(z_private_n, self.topkprune_ratio)
         if self.gan_noise:
             epsilon = self.alpha2
             
@@ -1107,15 +1227,19 @@ class MIA_train: # main class for every thing
             
         # print(total_loss, f_loss)
        
-        if not random_ini_centers and self.lambd>0:
+        mix_two_pass = not random_ini_centers and self.lambd>0 and not self.cem_single_backward
+        if mix_two_pass:
             # print(rob_loss)
             rob_loss.backward(retain_graph=True)
             encoder_gradients = {name: param.grad.clone() for name, param in self.f.named_parameters()}
             # optimizer.zero_grad()
             self.optimizer_zero_grad()
 
-        total_loss.backward()
-        if not random_ini_centers and self.lambd>0:
+        if not random_ini_centers and self.lambd>0 and self.cem_single_backward:
+            (total_loss + rob_loss).backward()
+        else:
+            total_loss.backward()
+        if mix_two_pass:
             for name, param in self.f.named_parameters():
                 if self.load_from_checkpoint:
                     param.grad += self.lambd*encoder_gradients[name]
@@ -1200,22 +1324,16 @@ class MIA_train: # main class for every thing
                     exit()
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(output).cuda()
+                    noise = defenses.gaussian_noise(output, sigma, generator=self.defense_generator)
                     output += noise
                 '''Optional, Test validation performance with local_DP/dropout (apply DP during query)'''
                 if self.local_DP:
-                    if "laplace" in self.AT_regularization_option:
-                        noise = torch.from_numpy(
-                            np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=output.size())).cuda()
-                    else:  # apply gaussian noise
-                        delta = 10e-5
-                        sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                        noise = sigma * torch.randn_like(output).cuda()
-                    output += noise
+                    output = output + defenses.local_dp_noise(output, self.dp_epsilon, laplace="laplace" in self.AT_regularization_option,
+                                                              generator=self.defense_generator)
                 if self.dropout_defense:
-                    output = dropout_defense(output, self.dropout_ratio)
+                    output = defenses.dropout_defense(output, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune:
-                    output = prune_defense(output, self.topkprune_ratio)
+                    output = defenses.prune_defense(output, self.topkprune_ratio)
             
             '''Optional, Test validation performance with gan_noise (apply gan_noise during query)'''
             if self.gan_noise:
@@ -1542,8 +1660,14 @@ class MIA_train: # main class for every thing
 
                 self.logger.debug("Train in {} style".format(self.scheme))
                 # print("adding noise:",adding_noise)
-                Z_all = []
-                label_all = [] 
+                # streaming per-class statistics + bounded reservoir sample instead of materialising Z_all
+                feature_sweep = self.feature_sweep_freq > 0 and epoch % self.feature_sweep_freq == 0
+                if feature_sweep:
+                    epoch_stats = ClassFeatureStats(self.num_class, reservoir_size=10000, seed=epoch)
+                else:
+                    # features captured from the training steps, sample = last 10000 training features (on device)
+                    epoch_stats = ClassFeatureStats(self.num_class, reservoir_size=0)
+                    self.feature_ring.reset()
                 if epoch ==1:
                     random_ini_centers = True
                 else: 
@@ -1588,6 +1712,9 @@ class MIA_train: # main class for every thing
                             train_loss_list.append(torch.tensor(train_loss))
                             f_loss_list.append(torch.tensor(f_loss))
                             self.optimizer_step()
+                            if not feature_sweep:
+                                epoch_stats.update(z_private, labels)
+                                self.feature_ring.push(z_private, labels)
                             
                             # Logging
                             # LOG[batch, client_id] = train_loss
@@ -1617,7 +1744,7 @@ class MIA_train: # main class for every thing
 
                     feature_infer_stime= time.time()
                     print(f"train_one_ep_time:{feature_infer_stime-model_train_stime} s")
-                    for batch in range(self.num_batches):
+                    for batch in range(self.num_batches if feature_sweep else 0):
                         with torch.no_grad():
                             for client_id in range(self.num_client):
                                 # try:
@@ -1629,13 +1756,14 @@ class MIA_train: # main class for every thing
                                 x_private = images.cuda()
                                 label_private = labels.cuda()
                                 z_private = self.f(x_private)
-                                Z_all.append(z_private.cpu())
-                                label_all.append(labels.cpu()) 
+                                epoch_stats.update(z_private, label_private)
                     feature_infer_etime= time.time()
                     print(f"feature_infer_one_ep_time:{feature_infer_etime - feature_infer_stime} s")
                 # Attention-CEM epoch metric (no GMM/KMeans): compute avg log-variance per class using attention_cem
-                Z_all = torch.cat(Z_all, dim=0).cuda()
-                label_all = torch.cat(label_all, dim=0).cuda()
+                # on the reservoir sample; the exact per-class log-variance comes from the streaming statistics
+                Z_all, label_all = epoch_stats.sample() if feature_sweep else self.feature_ring.get()
+                Z_all = Z_all.cuda()
+                label_all = label_all.cuda()
                 N = Z_all.size(0)
                 features_flat = Z_all.view(N, -1)
                 if not hasattr(self, 'attention_cem'):
@@ -1653,6 +1781,8 @@ class MIA_train: # main class for every thing
                 feature_clst_etime= time.time()
                 print(f"feature_attcem_one_ep_time:{feature_clst_etime-feature_infer_etime} s")
                 self.logger.debug('Attention-CEM epoch metric (avg logvar): {rob:.3f}'.format(rob=rob_loss_epoch))
+                self.logger.debug('Class-conditional epoch metric (streaming avg logvar): {rob:.3f}'.format(
+                    rob=epoch_stats.logvar_metric(self.var_threshold, self.regularization_strength)))
                 if (epoch-1)%40 ==0:
                     Z_visual=Z_all[0:10000].detach().cpu()
                     label_visual=label_all[0:10000].detach().cpu()
@@ -1662,21 +1792,11 @@ class MIA_train: # main class for every thing
                     Z_visual = Z_visual[mask]
                     label_visual = label_visual[mask]
 
-                    tsne = TSNE(n_components=2, perplexity=30, learning_rate=200, max_iter=1000, random_state=42)
-                    reduced_features = tsne.fit_transform(Z_visual)
+                    # embedding + figure in the background plot worker, training does not wait for it
                     visual_dir = self.save_dir + '/visualize'
-                    os.makedirs(visual_dir, exist_ok=True)
-                    plt.figure(figsize=(10, 8))
-                    scatter = plt.scatter(reduced_features[:, 0], reduced_features[:, 1], c=label_visual.cpu(), cmap='viridis')
-                    plt.colorbar(scatter)
-                    plt.xlabel('t-SNE Component 1')
-                    plt.ylabel('t-SNE Component 2')
-                    plt.title('t-SNE of attention-CEM features (flattened)')
                     file_name=visual_dir+'/'+str(epoch)+'.png'
-                    # 保存图像到 visual 文件夹
-                    plt.savefig(file_name)
-                    print(file_name)
-                del Z_all,label_all
+                    self.plot_worker.submit_tsne(Z_visual, label_visual, file_name, 't-SNE of attention-CEM features (flattened)')
+                del Z_all,label_all,epoch_stats
 
                 
 
@@ -1717,6 +1837,7 @@ class MIA_train: # main class for every thing
                 # Save Model regularly
                 if epoch % 50 == 0 or epoch == self.n_epochs or epoch in epoch_save_list:  # save model
                     self.save_model(epoch)
+            self.plot_worker.close()
 
         if not self.call_resume:
             self.logger.debug("Best Average Validation Accuracy is {}".format(best_avg_accu))
@@ -1751,73 +1872,80 @@ class MIA_train: # main class for every thing
 
 
     def gen_ir(self, val_single_loader, local_model, img_folder="./tmp", intermed_reps_folder="./tmp", all_label=True,
-               select_label=0, attack_from_later_layer=-1, attack_option = "MIA"):
+               select_label=0, attack_from_later_layer=-1, attack_option = "MIA", ir_store = True):
         """
         Generate (Raw Input - Intermediate Representation) Pair for Training of the AutoEncoder
+
+        The client model runs at the loader's batch size. With ir_store=True the pairs (and labels) are written
+        into one contiguous memory-mapped store in intermed_reps_folder (see utils.IRStoreWriter), which
+        apply_transform / apply_transform_test load zero-copy; otherwise one .jpg + one .pt per sample.
         """
 
         # switch to evaluate mode
         local_model.eval()
+        img_folder = os.path.abspath(img_folder)
+        intermed_reps_folder = os.path.abspath(intermed_reps_folder)
+        if not os.path.isdir(intermed_reps_folder):
+            os.makedirs(intermed_reps_folder)
+        if not os.path.isdir(img_folder):
+            os.makedirs(img_folder)
+
+        hook_handle = None
+        activation_4 = {}
+        if attack_from_later_layer > -1 and (not self.confidence_score):
+            self.model.cloud.eval()
+
+            def get_activation_4(name):
+                def hook(model, input, output):
+                    activation_4[name] = output.detach()
+
+                return hook
+
+            # register the hook once (it used to be re-registered, and never removed, for every sample)
+            count = 0
+            for name, m in self.model.cloud.named_modules():
+                if attack_from_later_layer == count:
+                    hook_handle = m.register_forward_hook(get_activation_4("ACT-{}".format(name)))
+                    valid_key = "ACT-{}".format(name)
+                    break
+                count += 1
+
+        writer = IRStoreWriter(intermed_reps_folder, len(val_single_loader.dataset)) if ir_store else None
         file_id = 0
         for i, (input, target) in enumerate(val_single_loader):
-            # input = input.cuda(async=True)
-            input = input.cuda()
-            target = target.item()
             if not all_label:
-                if target != select_label:
+                keep = target == select_label
+                if not keep.any():
                     continue
-
-            img_folder = os.path.abspath(img_folder)
-            intermed_reps_folder = os.path.abspath(intermed_reps_folder)
-            if not os.path.isdir(intermed_reps_folder):
-                os.makedirs(intermed_reps_folder)
-            if not os.path.isdir(img_folder):
-                os.makedirs(img_folder)
+                input, target = input[keep], target[keep]
+            input = input.cuda()
 
             # compute output
             with torch.no_grad():
                 ir = local_model(input)
-            
-            if self.confidence_score:
-                self.model.cloud.eval()
-                ir = self.model.cloud(ir)
-                if "mobilenetv2" in self.arch:
-                    ir = F.avg_pool2d(ir, 4)
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-                elif self.arch == "resnet20" or self.arch == "resnet32":
-                    ir = F.avg_pool2d(ir, 8)
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-                else:
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-            
-            if attack_from_later_layer > -1 and (not self.confidence_score):
-                self.model.cloud.eval()
-
-                activation_4 = {}
-
-                def get_activation_4(name):
-                    def hook(model, input, output):
-                        activation_4[name] = output.detach()
 
-                    return hook
+                if self.confidence_score:
+                    self.model.cloud.eval()
+                    ir = self.model.cloud(ir)
+                    if "mobilenetv2" in self.arch:
+                        ir = F.avg_pool2d(ir, 4)
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
+                    elif self.arch == "resnet20" or self.arch == "resnet32":
+                        ir = F.avg_pool2d(ir, 8)
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
+                    else:
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
 
-                with torch.no_grad():
-                    activation_4 = {}
-                    count = 0
-                    for name, m in self.model.cloud.named_modules():
-                        if attack_from_later_layer == count:
-                            m.register_forward_hook(get_activation_4("ACT-{}".format(name)))
-                            valid_key = "ACT-{}".format(name)
-                            break
-                        count += 1
+                if attack_from_later_layer > -1 and (not self.confidence_score):
+                    activation_4.clear()
                     output = self.model.cloud(ir)
-                try:
-                    ir = activation_4[valid_key]
-                except:
-                    print("cannot attack from later layer, server-side model is empty or does not have enough layers")
+                    try:
+                        ir = activation_4[valid_key]
+                    except:
+                        print("cannot attack from later layer, server-side model is empty or does not have enough layers")
             ir = ir.float()
 
             if "truncate" in attack_option:
@@ -1826,15 +1954,26 @@ class MIA_train: # main class for every thing
                 except:
                     print("auto extract percentage fail. Use default percentage_left = 20")
                     percentage_left = 20
-                ir = prune_top_n_percent_left(ir, percentage_left)
+                # per-sample pruning, same as prune_top_n_percent_left on each single-sample batch
+                ir_flat = ir.reshape(ir.size(0), -1)
+                num_ele = int(ir_flat.size(1) * (100 - percentage_left) / 100.)
+                _, index = ir_flat.topk(k = num_ele, dim = 1, largest = False)
+                ir = ir_flat.scatter(1, index, 0.0).view(ir.size())
 
-            inp_img_path = "{}/{}.jpg".format(img_folder, file_id)
-            out_tensor_path = "{}/{}.pt".format(intermed_reps_folder, file_id)
-            
             input = denormalize(input, self.dataset)
-            save_image(input, inp_img_path)
-            torch.save(ir.cpu(), out_tensor_path)
-            file_id += 1
+            if ir_store:
+                # clamp as save_image did, but keep full precision (no JPEG round-trip)
+                writer.append(input.clamp(0, 1), ir, target)
+                file_id = writer.count
+            else:
+                for j in range(input.size(0)):
+                    save_image(input[j:j + 1], "{}/{}.jpg".format(img_folder, file_id))
+                    torch.save(ir[j:j + 1].cpu(), "{}/{}.pt".format(intermed_reps_folder, file_id))
+                    file_id += 1
+        if writer is not None:
+            writer.close()
+        if hook_handle is not None:
+            hook_handle.remove()
         print("Overall size of Training/Validation Datset for AE is {}: {}".format(int(file_id * 0.9),
                                                                                    int(file_id * 0.1)))
 
@@ -1875,19 +2014,19 @@ class MIA_train: # main class for every thing
                 rmtree(tensor_data_dir)
 
             if self.dataset == "cifar100":
-                val_single_loader, _, _ = get_cifar100_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_single_loader, _, _ = get_cifar100_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "cifar10":
-                val_single_loader, _, _ = get_cifar10_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_single_loader, _, _ = get_cifar10_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "svhn":
-                val_single_loader, _, _ = get_SVHN_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_single_loader, _, _ = get_SVHN_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "mnist":
-                _, val_single_loader = get_mnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_mnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "fmnist":
-                _, val_single_loader = get_fmnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_fmnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "facescrub":
-                _, val_single_loader = get_facescrub_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_facescrub_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "tinyimagenet":
-                _, val_single_loader = get_tinyimagenet_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_tinyimagenet_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
 
             attack_path = self.save_dir + '/MIA_attack_{}to{}'.format(client_id, client_id)
             if not os.path.isdir(attack_path):
@@ -1955,19 +2094,19 @@ class MIA_train: # main class for every thing
             rmtree(tensor_data_dir)
 
         if self.dataset == "cifar100":
-            val_single_loader, _, _ = get_cifar100_testloader(batch_size=1, num_workers=4, shuffle=False)
+            val_single_loader, _, _ = get_cifar100_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "cifar10":
-            _, val_single_loader, _ = get_cifar10_trainloader(batch_size=1, num_workers=4, shuffle=True)
+            _, val_single_loader, _ = get_cifar10_trainloader(batch_size=attack_batchsize, num_workers=4, shuffle=True)
         elif self.dataset == "svhn":
-            val_single_loader, _, _ = get_SVHN_testloader(batch_size=1, num_workers=4, shuffle=False)
+            val_single_loader, _, _ = get_SVHN_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "mnist":
-            _, val_single_loader = get_mnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_mnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "fmnist":
-            _, val_single_loader = get_fmnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_fmnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "facescrub":
-            _, val_single_loader = get_facescrub_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_facescrub_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
         elif self.dataset == "tinyimagenet":
-            _, val_single_loader = get_tinyimagenet_bothloader(batch_size=1, num_workers=4, shuffle=False)
+            _, val_single_loader = get_tinyimagenet_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
 
         attack_path = self.save_dir + '/{}_attack_{}to{}'.format(attack_option, collude_client, target_client)
         if not os.path.isdir(attack_path):
@@ -1989,16 +2128,14 @@ class MIA_train: # main class for every thing
             self.gen_ir(val_single_loader, self.model.local_list[collude_client], image_data_dir, tensor_data_dir,
                     attack_from_later_layer=attack_from_later_layer, attack_option = attack_option)
             print(image_data_dir,tensor_data_dir)
-            for filename in os.listdir(tensor_data_dir):
-                if ".pt" in filename:
-                    sampled_tensor = torch.load(tensor_data_dir + "/" + filename)
-                    input_nc = sampled_tensor.size()[1]
-                    try:
-                        input_dim = sampled_tensor.size()[2]
-                    except:
-                        print("Extract input dimension fialed, set to 0")
-                        input_dim = 0
-                    break
+            # activation shape from the IR store header, [N, C, H, W] (or [N, C] for confidence scores)
+            sampled_tensor = load_ir_store(tensor_data_dir, with_label=False).tensors[1]
+            input_nc = sampled_tensor.size()[1]
+            try:
+                input_dim = sampled_tensor.size()[2]
+            except:
+                print("Extract input dimension fialed, set to 0")
+                input_dim = 0
 
             if self.gan_AE_type == "custom":
                 decoder = architectures.custom_AE(input_nc=input_nc, output_nc=3, input_dim=input_dim, output_dim=32,
@@ -2256,22 +2393,17 @@ class MIA_train: # main class for every thing
                 # Use local DP for training the AE.
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(ir).cuda()
+                    noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                     ir += noise
 
                 if self.local_DP and noise_aware:
                     with torch.no_grad():
-                        if "laplace" in self.regularization_option:
-                            ir += torch.from_numpy(
-                                np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=ir.size())).cuda()
-                        else:  # apply gaussian noise
-                            delta = 10e-5
-                            sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                            ir += sigma * torch.randn_like(ir).cuda()
+                        ir = ir + defenses.local_dp_noise(ir, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                          generator=self.defense_generator)
                 if self.dropout_defense and noise_aware:
-                    ir = dropout_defense(ir, self.dropout_ratio)
+                    ir = defenses.dropout_defense(ir, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune and noise_aware:
-                    ir = prune_defense(ir, self.topkprune_ratio)
+                    ir = defenses.prune_defense(ir, self.topkprune_ratio)
                 if pretrained_decoder is not None and "gan_adv_noise" in self.regularization_option and noise_aware:
                     epsilon = self.alpha2
                     
@@ -2326,7 +2458,7 @@ class MIA_train: # main class for every thing
                 img, ir = Variable(img).to(device), Variable(ir).to(device)
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(ir).cuda()
+                    noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                     ir += noise
                 output = decoder(ir)
                 criterion_test = nn.MSELoss()
@@ -2388,7 +2520,7 @@ class MIA_train: # main class for every thing
             img, ir = Variable(img).to(device), Variable(ir).to(device)
             if "Gaussian" in self.regularization_option:
                 sigma = self.regularization_strength
-                noise = sigma * torch.randn_like(ir).cuda()
+                noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                 ir += noise
             output_imgs = decoder(ir)
             reconstruction_loss = criterion(output_imgs, img)
@@ -2501,18 +2633,13 @@ class MIA_train: # main class for every thing
             #     # noise = 10000*sigma * torch.randn_like(save_activation).cuda()
             #     save_activation += noise
             if self.local_DP and not clean_option:  # local DP or additive noise
-                if "laplace" in self.regularization_option:
-                    save_activation += torch.from_numpy(
-                        np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=save_activation.size())).cuda()
-                    # the addtive work uses scale in (0.1 0.5 1.0) -> (1 2 10) regularization_strength (self.dp_epsilon)
-                else:  # apply gaussian noise
-                    delta = 10e-5
-                    sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                    save_activation += sigma * torch.randn_like(save_activation).cuda()
+                # the addtive work uses scale in (0.1 0.5 1.0) -> (1 2 10) regularization_strength (self.dp_epsilon)
+                save_activation = save_activation + defenses.local_dp_noise(save_activation, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                                            generator=self.defense_generator)
             if self.dropout_defense and not clean_option:  # activation dropout defense
-                save_activation = dropout_defense(save_activation, self.dropout_ratio)
+                save_activation = defenses.dropout_defense(save_activation, self.dropout_ratio, generator=self.defense_generator)
             if self.topkprune and not clean_option:
-                save_activation = prune_defense(save_activation, self.topkprune_ratio)
+                save_activation = defenses.prune_defense(save_activation, self.topkprune_ratio)
             
             img = denormalize(img, self.dataset)
                 
@@ -2537,7 +2664,7 @@ class MIA_train: # main class for every thing
 
                 save_activation = save_activation - grad.detach() * epsilon
             if "truncate" in attack_option:
-                save_activation = prune_top_n_percent_left(save_activation)
+                save_activation = defenses.prune_top_n_percent_left(save_activation)
             
             save_activation = save_activation.float()
             
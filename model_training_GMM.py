@@ -5,8 +5,11 @@ import numpy as np
 import torch.nn as nn
 from torch.serialization import save
 import architectures_torch as architectures
+import defenses
+import kmeans_torch
+from plot_worker import PlotWorker
 from utils import setup_logger, accuracy, AverageMeter, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
-from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, prune_top_n_percent_left, dropout_defense, prune_defense
+from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss
 from thop import profile
 import logging
 from torch.autograd import Variable
@@ -17,14 +20,11 @@ import pytorch_ssim
 from torch.utils.tensorboard import SummaryWriter
 import torch.nn.functional as F
 import torchvision
-import matplotlib.pyplot as plt
 from torchvision.utils import save_image
 from datetime import datetime
 import os
 import time
 from shutil import rmtree
-from GMM import fit_gmm_torch
-from sklearn.manifold import TSNE
 from datasets_torch import get_cifar100_trainloader, get_cifar100_testloader, get_cifar10_trainloader, \
     get_cifar10_testloader, get_mnist_bothloader, get_facescrub_bothloader, get_SVHN_trainloader, get_SVHN_testloader, get_fmnist_bothloader, get_tinyimagenet_bothloader
 
@@ -118,6 +118,8 @@ class MIA_train: # main class for every thing
                  save_activation_tensor = False, save_more_checkpoints = False, dataset_portion = 1.0, noniid = 1.0):
         torch.manual_seed(random_seed)
         np.random.seed(random_seed)
+        # RNG for the activation defences (noise / dropout), drawn on the device, reproducible from random_seed
+        self.defense_generator = defenses.make_generator("cuda" if torch.cuda.is_available() else "cpu", random_seed)
         self.arch = arch
         self.bhtsne = bhtsne_option
         self.batch_size = batch_size
@@ -136,6 +138,8 @@ class MIA_train: # main class for every thing
        # self.dataset_portion = dataset_portion
        # self.noniid_ratio = noniid
         self.save_more_checkpoints = save_more_checkpoints
+        # t-SNE / curve plots are rendered in a background process
+        self.plot_worker = PlotWorker()
 
         # setup save folder
         if save_dir is None:
@@ -658,25 +662,18 @@ class MIA_train: # main class for every thing
                     sigma = self.regularization_strength
             else:
                 sigma = self.regularization_strength
-            noise = sigma * torch.randn_like(z_private).cuda()
+            noise = defenses.gaussian_noise(z_private, sigma, generator=self.defense_generator)
             z_private_n =z_private + noise
         else:
             z_private_n=z_private
         # Perform various activation defenses, default no defense
         if self.local_DP:
-            if "laplace" in self.regularization_option:
-                noise = torch.from_numpy(
-                    np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=z_private.size())).cuda()
-                z_private = z_private + noise.detach().float()
-            else:  # apply gaussian noise
-                delta = 10e-5
-                sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                noise = sigma * torch.randn_like(z_private).cuda()
-                z_private = z_private + noise.detach().float()
+            z_private = z_private + defenses.local_dp_noise(z_private, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                            generator=self.defense_generator)
         if self.dropout_defense:
-            z_private = dropout_defense(z_private, self.dropout_ratio)
+            z_private = defenses.dropout_defense(z_private, self.dropout_ratio, generator=self.defense_generator)
         if self.topkprune:
-            z_private = prune_defense(z_private, self.topkprune_ratio)
+            z_private = defenses.prune_defense(z_private, self.topkprune_ratio)
         if self.gan_noise:
             epsilon = self.alpha2
             
@@ -845,22 +842,16 @@ class MIA_train: # main class for every thing
                     exit()
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(output).cuda()
+                    noise = defenses.gaussian_noise(output, sigma, generator=self.defense_generator)
                     output += noise
                 '''Optional, Test validation performance with local_DP/dropout (apply DP during query)'''
                 if self.local_DP:
-                    if "laplace" in self.regularization_option:
-                        noise = torch.from_numpy(
-                            np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=output.size())).cuda()
-                    else:  # apply gaussian noise
-                        delta = 10e-5
-                        sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                        noise = sigma * torch.randn_like(output).cuda()
-                    output += noise
+                    output = output + defenses.local_dp_noise(output, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                              generator=self.defense_generator)
                 if self.dropout_defense:
-                    output = dropout_defense(output, self.dropout_ratio)
+                    output = defenses.dropout_defense(output, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune:
-                    output = prune_defense(output, self.topkprune_ratio)
+                    output = defenses.prune_defense(output, self.topkprune_ratio)
             
             '''Optional, Test validation performance with gan_noise (apply gan_noise during query)'''
             if self.gan_noise:
@@ -1272,18 +1263,18 @@ class MIA_train: # main class for every thing
                 label_all = torch.cat(label_all, dim=0).cuda()
                 # print(Z_all.shape,label_all.shape)
                 num_clusters=10
-                gmm_params = fit_gmm_torch(Z_all, label_all, self.num_class, num_clusters)
+                # cluster every class in one batched k-means (class-offset packing);
+                # classes with too few samples keep their previous centroids
+                if random_ini_centers:
+                    print('randomized selected centroids')
+                class_centroids, _, _ = kmeans_torch.kmeans_by_class(Z_all.detach(), label_all, self.num_class, num_clusters,
+                                                                     num_iterations=60, tol=1e-4, init="random")
+                class_counts = torch.bincount(label_all, minlength=self.num_class).tolist()
                 for class_label in range(self.num_class):
-                    
-                    centroids=centroids_list[class_label].detach().clone()
-                    class_features = Z_all[label_all == class_label].detach().clone()
-                    # print(class_label,len(class_features),len(label_all[label_all == class_label]))
-                    if class_features.size(0) > num_clusters:
-                        # print(class_features.size(0))
-                        centroids, average_variance=self.kmeans_cuda(class_features, num_clusters,centroids,random_ini_centers, num_iterations=60, tol=1e-4)  # 
-                        centroids_list[class_label] = centroids.clone()
+                    if class_counts[class_label] > num_clusters:
+                        centroids_list[class_label] = class_centroids[class_label].clone()
                     print(abs(centroids_list[class_label]).mean())
-                    del class_features,centroids,average_variance
+                del class_centroids
 
                 if (epoch-1)%20 ==0:
                     Z_visual=Z_all[0:10000].detach().cpu()
@@ -1294,20 +1285,10 @@ class MIA_train: # main class for every thing
                     Z_visual = Z_visual[mask]
                     label_visual = label_visual[mask]
 
-                    tsne = TSNE(n_components=2, perplexity=30, learning_rate=200, max_iter=1000, random_state=42)
-                    reduced_features = tsne.fit_transform(Z_visual)
+                    # embedding + figure in the background plot worker, training does not wait for it
                     visual_dir = self.save_dir + '/visualize'
-                    os.makedirs(visual_dir, exist_ok=True)
-                    plt.figure(figsize=(10, 8))
-                    scatter = plt.scatter(reduced_features[:, 0], reduced_features[:, 1], c=label_visual.cpu(), cmap='viridis')
-                    plt.colorbar(scatter)
-                    plt.xlabel('t-SNE Component 1')
-                    plt.ylabel('t-SNE Component 2')
-                    plt.title('t-SNE of n*8*8*8 features')
                     file_name=visual_dir+'/'+str(epoch)+'.png'
-                    # 保存图像到 visual 文件夹
-                    plt.savefig(file_name)
-                    print(file_name)
+                    self.plot_worker.submit_tsne(Z_visual, label_visual, file_name, 't-SNE of n*8*8*8 features')
                 del Z_all,label_all
                 # torch.cuda.empty_cache()
                 # label_all = [] 
@@ -1350,6 +1331,7 @@ class MIA_train: # main class for every thing
                 # Save Model regularly
                 if epoch % 50 == 0 or epoch == self.n_epochs or epoch in epoch_save_list:  # save model
                     self.save_model(epoch)
+            self.plot_worker.close()
 
         if not self.call_resume:
             self.logger.debug("Best Average Validation Accuracy is {}".format(best_avg_accu))
@@ -3,8 +3,10 @@ import numpy as np
 import torch.nn as nn
 from torch.serialization import save
 import architectures_torch as architectures
-from utils import setup_logger, accuracy, AverageMeter, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
-from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, prune_top_n_percent_left, dropout_defense, prune_defense
+import defenses
+from plot_worker import PlotWorker
+from utils import setup_logger, accuracy, AverageMeter, DeviceAverageMeter, AsyncCheckpointWriter, WarmUpLR, apply_transform_test, apply_transform, TV, l2loss, dist_corr, get_PSNR
+from utils import freeze_model_bn, average_weights, DistanceCorrelationLoss, spurious_loss, IRStoreWriter, FeatureCache, model_state_hash, loader_fingerprint, tensor_store_loader, scale_grad
 from thop import profile
 import logging
 from torch.autograd import Variable
@@ -16,7 +18,6 @@ import pytorch_ssim
 from torch.utils.tensorboard import SummaryWriter
 import torch.nn.functional as F
 import torchvision
-import matplotlib.pyplot as plt
 from torchvision.utils import save_image
 from datetime import datetime
 import os
@@ -24,7 +25,6 @@ import time
 from ptflops import get_model_complexity_info
 from shutil import rmtree
 from torchsummary import summary
-from sklearn.manifold import TSNE
 import torch_pruning as tp
 from datasets_torch import get_cifar100_trainloader, get_cifar100_testloader, get_cifar10_trainloader, \
     get_cifar10_testloader, get_mnist_bothloader, get_facescrub_bothloader, get_SVHN_trainloader, get_SVHN_testloader, get_fmnist_bothloader, get_tinyimagenet_bothloader,get_imagenet_bothloader,get_celeba_trainloader,get_celeba_testloader
@@ -421,7 +421,8 @@ class MIA_train: # main class for every thing
                  load_from_checkpoint = False, bottleneck_option="None", measure_option=False,
                  optimize_computation=1, decoder_sync = False, bhtsne_option = False, gan_loss_type = "SSIM", attack_confidence_score = False,
                  ssim_threshold = 0.0,var_threshold = 0.1, finetune_freeze_bn = False, load_from_checkpoint_server = False, source_task = "cifar100", 
-                 save_activation_tensor = False, save_more_checkpoints = False, dataset_portion = 1.0, noniid = 1.0):
+                 save_activation_tensor = False, save_more_checkpoints = False, dataset_portion = 1.0, noniid = 1.0,
+                 cem_single_backward = True, data_resident = None):
         torch.manual_seed(random_seed)
         np.random.seed(random_seed)
         self.arch = arch
@@ -442,6 +443,12 @@ class MIA_train: # main class for every thing
        # self.dataset_portion = dataset_portion
        # self.noniid_ratio = noniid
         self.save_more_checkpoints = save_more_checkpoints
+        # t-SNE / curve plots are rendered in a background process
+        self.plot_worker = PlotWorker()
+        # True: mix the CEM gradient into the encoder with one backward pass (grad hook on z_private)
+        # False: legacy two-pass mixing (rob_loss.backward(retain_graph=True) + manual grad add)
+        self.cem_single_backward = cem_single_backward
+        self.data_resident = data_resident  # None, "gpu" or "pinned": tensor-resident client loaders for cifar10/100/svhn
 
         # setup save folder
         if save_dir is None:
@@ -458,6 +465,10 @@ class MIA_train: # main class for every thing
         self.writer = SummaryWriter(log_dir=tensorboard_path)
         
         self.save_activation_tensor = save_activation_tensor
+        # clean client features for the MIA decoder loops, see iter_feat_pairs
+        self.feature_cache = FeatureCache()
+        # RNG for the activation defences (noise / dropout), drawn on the device, reproducible from random_seed
+        self.defense_generator = defenses.make_generator("cuda" if torch.cuda.is_available() else "cpu", random_seed)
 
         # setup logger
         model_log_file = self.save_dir + '/MIA.log'
@@ -626,13 +637,15 @@ class MIA_train: # main class for every thing
                                                                                                         num_workers=num_workers,
                                                                                                         shuffle=True,
                                                                                                         num_client=actual_num_users,
-                                                                                                        collude_use_public=self.collude_use_public
+                                                                                                        collude_use_public=self.collude_use_public,
+                                                                                                        resident=self.data_resident
                                                                                                         )
             self.client_dataloader_rob, self.mem_trainloader_rob, self.mem_testloader_rob = get_cifar10_trainloader(batch_size=self.batch_size*20,
                                                                                                         num_workers=num_workers,
                                                                                                         shuffle=True,
                                                                                                         num_client=actual_num_users,
-                                                                                                        collude_use_public=self.collude_use_public
+                                                                                                        collude_use_public=self.collude_use_public,
+                                                                                                        resident=self.data_resident
                                                                                                         )
             self.pub_dataloader, self.nomem_trainloader, self.nomem_testloader = get_cifar10_testloader(batch_size=self.batch_size,
                                                                                                         num_workers=num_workers,
@@ -644,12 +657,14 @@ class MIA_train: # main class for every thing
                                                                                                          num_workers=num_workers,
                                                                                                          shuffle=True,
                                                                                                          num_client=actual_num_users,
-                                                                                                         collude_use_public=self.collude_use_public)
+                                                                                                         collude_use_public=self.collude_use_public,
+                                                                                                         resident=self.data_resident)
             self.client_dataloader_rob, self.mem_trainloader_rob, self.mem_testloader_rob = get_cifar100_trainloader(batch_size=self.batch_size*20,
                                                                                                          num_workers=num_workers,
                                                                                                          shuffle=True,
                                                                                                          num_client=actual_num_users,
-                                                                                                         collude_use_public=self.collude_use_public)                                                                                                    
+                                                                                                         collude_use_public=self.collude_use_public,
+                                                                                                         resident=self.data_resident)                                                                                                    
             self.pub_dataloader, self.nomem_trainloader, self.nomem_testloader = get_cifar100_testloader(batch_size=self.batch_size,
                                                                                                          num_workers=num_workers,
                                                                                                          shuffle=False)
@@ -660,7 +675,8 @@ class MIA_train: # main class for every thing
                                                                                                          num_workers=num_workers,
                                                                                                          shuffle=True,
                                                                                                          num_client=actual_num_users,
-                                                                                                         collude_use_public=self.collude_use_public)
+                                                                                                         collude_use_public=self.collude_use_public,
+                                                                                                         resident=self.data_resident)
             self.pub_dataloader, self.nomem_trainloader, self.nomem_testloader = get_SVHN_testloader(batch_size=self.batch_size,
                                                                                                          num_workers=num_workers,
                                                                                                          shuffle=False)
@@ -1099,137 +1115,64 @@ class MIA_train: # main class for every thing
     #     return loss, intra_class_mse
 
     def compute_class_means(self, features, labels, unique_labels, centroids_list, weights_list,cluster_variances_list):
-        class_means = []
-
+        # GPU-resident: every (class, cluster) pair is a segment labels * K + cluster (class-offset trick),
+        # per-segment statistics come from scatter_reduce / bincount, no host round-trip or Python loop over clusters
         len_dataset= len(self.client_dataloader[0])*self.batch_size
         class_length = len_dataset/self.num_class
         adaptive_avg_pool = nn.AdaptiveAvgPool2d((16, 16))
         if self.pooling:
             features=adaptive_avg_pool(features)*3.4
-        # Sort labels and get sorted indices
-        sorted_indices = torch.argsort(labels)
-        sorted_labels = labels[sorted_indices]
-        sorted_features = features[sorted_indices]
-
-        unique_labels = unique_labels.cpu().numpy()
-        sorted_labels = sorted_labels.cpu().numpy()
 
-        N, D = sorted_features.shape[0], sorted_features[0].numel()
-        sorted_features_flat = sorted_features.view(N, D)  # Flatten
-        num_centroids = len(centroids_list[0])
+        device = features.device
+        N = features.size(0)
+        features_flat = features.reshape(N, -1)  # Flatten
+        labels = labels.long().to(device)
         assert len(centroids_list[0])==len(weights_list[0]), print('the weights and centroids not match')
-        # centroids_all = torch.zeros((N, num_centroids, D), dtype=sorted_features_flat.dtype)
-
-        # # Assign the corresponding centroids to the centroids tensor
-        # for i in range(len(sorted_labels)):
-        #     label = sorted_labels[i]
-        #     centroids_all[i] = centroids_list[label].cuda()
-
-        label_indices = torch.tensor(sorted_labels).long()
-# 
-        centroids_all = torch.stack([centroids_list[label] for label in label_indices], dim=0)
-        weights_all = torch.stack([weights_list[label] for label in label_indices], dim=0)
-        cluster_variances_all = torch.stack([cluster_variances_list[label] for label in label_indices], dim=0)
-
-        distances = torch.cdist(sorted_features_flat.unsqueeze(1), centroids_all.cuda(), p=2)
-
-        distances=distances.squeeze(1).detach().cpu().numpy()
-
-        all_cluster_assignments = np.argmin(distances, axis=1)
-        nearest_centroids = centroids_all[torch.arange(N), all_cluster_assignments].cuda()
-        # nearest_centroids = torch.zeros_like(sorted_features_flat)
-        # for i in range(N):
-        #     nearest_centroids[i] = centroids_all[i, all_cluster_assignments[i]]
-
-        # Calculate the variance matrix
-        variance_matrix = (sorted_features_flat - nearest_centroids) ** 2
-
-        label_it = 0
-        current_index = 0
-        lb_count=0
-        for i in unique_labels:
-            weights_label= weights_all[lb_count]
-            variance_label= cluster_variances_all[lb_count]
-            # Get the range of indices corresponding to the current label
-            start_index = current_index
-            while current_index < len(sorted_labels) and sorted_labels[current_index] == i:
-                current_index += 1
-            end_index = current_index
-            lb_count+=1
-            # Get the features for the current class
-            # class_features_flat = sorted_features_flat[start_index:end_index]
-            
-            # class_mean = class_features_flat.mean(dim=0)
-
-            class_variance_matrix = variance_matrix[start_index:end_index]
-            cluster_assignments = all_cluster_assignments[start_index:end_index]
-
-            # Sort cluster assignments and get sorted indices
-            cluster_sorted_indices = np.argsort(cluster_assignments)
-            sorted_cluster_assignments = cluster_assignments[cluster_sorted_indices]
-            sorted_class_variance_matrix = class_variance_matrix[cluster_sorted_indices]
-# 
-            unique_cluster_assignments = np.unique(sorted_cluster_assignments)
-
-            num = 0
-            cluster_current_index = 0
-            for j in unique_cluster_assignments:
-                # Get the range of indices corresponding to the current cluster
-                cluster_start_index = cluster_current_index
-                while (cluster_current_index < len(sorted_cluster_assignments) and sorted_cluster_assignments[cluster_current_index] == j):
-                    cluster_current_index += 1
-                cluster_end_index = cluster_current_index
-
-                # Get the features for the current cluster
-                
-                # weight = (cluster_end_index - cluster_start_index) / (end_index - start_index)
-                weight= weights_label[j]
-                variance = variance_label[j]
-                totol_number= weight*class_length
-                num_samples= (cluster_end_index - cluster_start_index)
-                scaling_lambda= 10
-                var_lambda= (num_samples/totol_number)*scaling_lambda
-                if var_lambda>=1:
-                    var_lambda=0.99
-
-                variances = torch.mean(sorted_class_variance_matrix[cluster_start_index:cluster_end_index]).cuda() #variance is the mean of the cluster distance
-                variances = var_lambda*variances + (1-var_lambda)*variance
-
-                if self.log_entropy == 0:
-                    reg_variances = variances + 0.001
-                    reg_mutual_infor = reg_variances.mean() * weight
-                else:
-                    gamma=0.01
-                    mutual_infor = F.relu(torch.log(variances + gamma) - torch.log(self.var_threshold*torch.tensor(self.regularization_strength**2)+ 1*gamma))
-                    reg_mutual_infor = mutual_infor.mean() * weight
-                # print(totol_number,num_samples,weight) 
-                if torch.isnan(reg_mutual_infor):
-                    print(variances,num_samples,totol_number,var_lambda,variance) 
-                    print('rob_loss is nan')
 
-
-                if num == 0:
-                    average_variance = reg_mutual_infor 
-                else:
-                    average_variance += reg_mutual_infor 
-
-                num += 1
-
-            if label_it == 0:
-                intra_class_mse = average_variance
-            else:
-                intra_class_mse += average_variance
-
-            # class_means.append(class_mean)
-            label_it += 1
-
-        intra_class_mse /= len(unique_labels)
-        if torch.isnan(intra_class_mse):
-            print(len(unique_labels)) 
-            print('rob_loss is nan')
-        # class_means = torch.stack(class_means)
-        # class_mean_overall = class_means.mean(dim=0)
-        # inter_class_mse = F.mse_loss(class_means, class_mean_overall.expand_as(class_means))
+        centroids_table = torch.stack(list(centroids_list), dim=0).to(device)  # [C, K, D]
+        weights_table = torch.stack(list(weights_list), dim=0).to(device)  # [C, K]
+        cluster_variances_table = torch.stack(list(cluster_variances_list), dim=0).to(device)  # [C, K]
+        num_class, num_centroids = weights_table.shape
+        # weights / variances keep the original row order: the k-th class of unique_labels reads the table row
+        # of the k-th sample in label order (weights_all[lb_count] of the old per-sample stack)
+        row_class = torch.arange(num_class, device=device)
+        row_class[unique_labels.long().to(device)] = torch.sort(labels).values[:len(unique_labels)]
+        weights_table = weights_table[row_class]
+        cluster_variances_table = cluster_variances_table[row_class]
+
+        # nearest centroid of each sample among its own class' centroids
+        centroids_all = centroids_table[labels]  # [N, K, D]
+        distances = torch.cdist(features_flat.unsqueeze(1), centroids_all, p=2).squeeze(1)  # [N, K]
+        all_cluster_assignments = torch.argmin(distances, dim=1)
+        nearest_centroids = centroids_all[torch.arange(N, device=device), all_cluster_assignments]
+
+        # variance is the mean of the cluster distance, averaged per (class, cluster) segment
+        sample_variance = ((features_flat - nearest_centroids) ** 2).mean(dim=1)  # [N]
+        segment = labels * num_centroids + all_cluster_assignments
+        num_segments = num_class * num_centroids
+        num_samples = torch.bincount(segment, minlength=num_segments).to(features_flat.dtype)
+        cluster_mean_variance = torch.zeros(num_segments, device=device, dtype=features_flat.dtype).scatter_reduce(
+            0, segment, sample_variance, reduce='mean', include_self=False)
+
+        weight = weights_table.reshape(-1).to(features_flat.dtype)
+        variance = cluster_variances_table.reshape(-1).to(features_flat.dtype)
+        totol_number = weight*class_length
+        scaling_lambda = 10
+        var_lambda = (num_samples/totol_number)*scaling_lambda
+        var_lambda = torch.where(var_lambda >= 1, torch.full_like(var_lambda, 0.99), var_lambda)
+        variances = var_lambda*cluster_mean_variance + (1-var_lambda)*variance
+
+        if self.log_entropy == 0:
+            reg_mutual_infor = (variances + 0.001) * weight
+        else:
+            gamma=0.01
+            # threshold in float32 as before (0-dim tensor, broadcasts onto the device)
+            log_threshold = torch.log(self.var_threshold*torch.tensor(self.regularization_strength**2) + 1*gamma)
+            reg_mutual_infor = F.relu(torch.log(variances + gamma) - log_threshold) * weight
+
+        # only clusters that received samples in this batch contribute, averaged over the classes present
+        reg_mutual_infor = torch.where(num_samples > 0, reg_mutual_infor, torch.zeros_like(reg_mutual_infor))
+        intra_class_mse = reg_mutual_infor.sum() / len(unique_labels)
         loss = intra_class_mse
 
         return loss, intra_class_mse
@@ -1237,6 +1180,15 @@ class MIA_train: # main class for every thing
         # return torch.tensor(0.01), torch.tensor(0.01)
 
 
+    def cem_grad_scale(self):
+        # factor applied to the encoder gradient of rob_loss, LR-dependent unless fine-tuning from a checkpoint
+        if self.load_from_checkpoint:
+            return self.lambd
+        lr = self.train_scheduler.get_last_lr()[0]
+        if lr < 0.00041: #strat to enhance rob when lr is small and acc is high
+            return self.lambd
+        return self.lambd * (0.001 / lr)
+
     '''Main training function, the communication between client/server is implicit to keep a fast training speed'''
     def train_target_step(self, x_private, label_private, adding_noise,random_ini_centers,centroids_list,weights_list,cluster_variances_list,client_id=0):
         # 每个 step 必须先清梯度，避免跨 step 累积导致学习无效
@@ -1267,10 +1219,15 @@ class MIA_train: # main class for every thing
         )
 
         if use_attention:
-            if z_private.dim() == 4:
-                feats_flat = z_private.view(z_private.size(0), -1)
+            if self.cem_single_backward:
+                # pre-scaled gradient view: one backward pass yields grad(total_loss) + cem_grad_scale * grad(rob_loss)
+                z_cem = scale_grad(z_private, self.cem_grad_scale())
+            else:
+                z_cem = z_private
+            if z_cem.dim() == 4:
+                feats_flat = z_cem.view(z_cem.size(0), -1)
             else:
-                feats_flat = z_private
+                feats_flat = z_cem
             if torch.isnan(feats_flat).any() or torch.isinf(feats_flat).any():
                 print("Warning: NaN/Inf detected in features, skipping CEM calculation")
                 rob_loss = torch.zeros((), device=device)
@@ -1327,26 +1284,19 @@ class MIA_train: # main class for every thing
                     sigma = self.regularization_strength
             else:
                 sigma = self.regularization_strength
-            noise = sigma * torch.randn_like(z_private).cuda()
+            noise = defenses.gaussian_noise(z_private, sigma, generator=self.defense_generator)
             # z_private_c=z_private
             z_private_n =z_private + noise
         else:
             z_private_n=z_private
         # Perform various activation defenses, default no defense
         if self.local_DP:
-            if "laplace" in self.AT_regularization_option:
-                noise = torch.from_numpy(
-                    np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=z_private_n.size())).cuda()
-                z_private_n = z_private_n + noise.detach().float()
-            else:  # apply gaussian noise
-                delta = 10e-5
-                sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                noise = sigma * torch.randn_like(z_private_n).cuda()
-                z_private_n = z_private_n + noise.detach().float()
+            z_private_n = z_private_n + defenses.local_dp_noise(z_private_n, self.dp_epsilon, laplace="laplace" in self.AT_regularization_option,
+                                                                generator=self.defense_generator)
         if self.dropout_defense:
-            z_private_n = dropout_defense(z_private_n, self.dropout_ratio)
+            z_private_n = defenses.dropout_defense(z_private_n, self.dropout_ratio, generator=self.defense_generator)
         if self.topkprune:
-            z_private_n = prune_defense(z_private_n, self.topkprune_ratio)
+            z_private_n = defenses.prune_defense(z_private_n, self.topkprune_ratio)
         if self.gan_noise:
             epsilon = self.alpha2
             
@@ -1447,7 +1397,8 @@ class MIA_train: # main class for every thing
         attention_gradients = None
         encoder_gradients = {}
 
-        if not random_ini_centers and self.lambd>0 and rob_loss.requires_grad:
+        mix_cem = not random_ini_centers and self.lambd>0 and rob_loss.requires_grad
+        if mix_cem and not self.cem_single_backward:
             try:
                 # print(rob_loss)
                 rob_loss.backward(retain_graph=True)
@@ -1468,7 +1419,10 @@ class MIA_train: # main class for every thing
                 encoder_gradients = {}
                 attention_gradients = None
 
-        total_loss.backward()
+        if mix_cem and self.cem_single_backward:
+            (total_loss + rob_loss).backward()
+        else:
+            total_loss.backward()
 
         if not random_ini_centers and self.lambd>0 and encoder_gradients:
             for name, param in self.f.named_parameters():
@@ -1567,22 +1521,16 @@ class MIA_train: # main class for every thing
                     exit()
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(output).cuda()
+                    noise = defenses.gaussian_noise(output, sigma, generator=self.defense_generator)
                     output += noise
                 '''Optional, Test validation performance with local_DP/dropout (apply DP during query)'''
                 if self.local_DP:
-                    if "laplace" in self.AT_regularization_option:
-                        noise = torch.from_numpy(
-                            np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=output.size())).cuda()
-                    else:  # apply gaussian noise
-                        delta = 10e-5
-                        sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                        noise = sigma * torch.randn_like(output).cuda()
-                    output += noise
+                    output = output + defenses.local_dp_noise(output, self.dp_epsilon, laplace="laplace" in self.AT_regularization_option,
+                                                              generator=self.defense_generator)
                 if self.dropout_defense:
-                    output = dropout_defense(output, self.dropout_ratio)
+                    output = defenses.dropout_defense(output, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune:
-                    output = prune_defense(output, self.topkprune_ratio)
+                    output = defenses.prune_defense(output, self.topkprune_ratio)
             
             '''Optional, Test validation performance with gan_noise (apply gan_noise during query)'''
             if self.gan_noise:
@@ -2105,33 +2053,16 @@ class MIA_train: # main class for every thing
                 if epoch % 50 == 0 or epoch == self.n_epochs or epoch in epoch_save_list:  # save model
                     self.save_model(epoch)
             
-                epochs = list(range(1, len(acc_list) + 1))
                 logimg_path = str(self.save_dir) + "/log_img"
                 if not os.path.isdir(logimg_path):
                     os.makedirs(logimg_path)
-                plt.figure(figsize=(10, 6))
-                plt.plot(epochs, acc_list, label='Accuracy', marker='o', color='blue')
-                plt.xlabel('Epoch')
-                plt.ylabel('Accuracy')
-                plt.title('Accuracy over Epochs')
-                plt.legend()
-                plt.grid(True)
+                # curves are redrawn by the background plot worker
                 acc_img=logimg_path+'/acc.png'
-                plt.savefig(acc_img)
-                plt.close()
-
+                self.plot_worker.submit_curve(acc_list, acc_img, 'Accuracy', 'Accuracy over Epochs', color='blue')
                 # 绘制并保存 Robustness 的折线图
-                epochs = list(range(1, len(rob_list) + 1))
-                plt.figure(figsize=(10, 6))
-                plt.plot(epochs, rob_list, label='Robustness', marker='o', color='orange')
-                plt.xlabel('Epoch')
-                plt.ylabel('Robustness')
-                plt.title('Robustness over Epochs')
-                plt.legend()
-                plt.grid(True)
                 rob_img=logimg_path+'/rob.png'
-                plt.savefig(rob_img)
-                plt.close()
+                self.plot_worker.submit_curve(rob_list, rob_img, 'Robustness', 'Robustness over Epochs', color='orange')
+            self.plot_worker.close()
 
         if not self.call_resume:
 
@@ -2211,74 +2142,80 @@ class MIA_train: # main class for every thing
 
 
     def gen_ir(self, val_single_loader, local_model, img_folder="./tmp", intermed_reps_folder="./tmp", all_label=True,
-               select_label=0, attack_from_later_layer=-1, attack_option = "MIA"):
+               select_label=0, attack_from_later_layer=-1, attack_option = "MIA", ir_store = True):
         """
         Generate (Raw Input - Intermediate Representation) Pair for Training of the AutoEncoder
+
+        The client model runs at the loader's batch size. With ir_store=True the pairs (and labels) are written
+        into one contiguous memory-mapped store in intermed_reps_folder (see utils.IRStoreWriter), which
+        apply_transform / apply_transform_test load zero-copy; otherwise one .jpg + one .pt per sample.
         """
 
         # switch to evaluate mode
         local_model.eval()
+        img_folder = os.path.abspath(img_folder)
+        intermed_reps_folder = os.path.abspath(intermed_reps_folder)
+        if not os.path.isdir(intermed_reps_folder):
+            os.makedirs(intermed_reps_folder)
+        if not os.path.isdir(img_folder):
+            os.makedirs(img_folder)
+
+        hook_handle = None
+        activation_4 = {}
+        if attack_from_later_layer > -1 and (not self.confidence_score):
+            self.model.cloud.eval()
+
+            def get_activation_4(name):
+                def hook(model, input, output):
+                    activation_4[name] = output.detach()
+
+                return hook
+
+            # register the hook once (it used to be re-registered, and never removed, for every sample)
+            count = 0
+            for name, m in self.model.cloud.named_modules():
+                if attack_from_later_layer == count:
+                    hook_handle = m.register_forward_hook(get_activation_4("ACT-{}".format(name)))
+                    valid_key = "ACT-{}".format(name)
+                    break
+                count += 1
+
+        writer = IRStoreWriter(intermed_reps_folder, len(val_single_loader.dataset)) if ir_store else None
         file_id = 0
         for i, (input, target) in enumerate(val_single_loader):
-            # input = input.cuda(async=True)
-            input = input.cuda()
-            # print(input.shape,target)
-            target = target.item()
             if not all_label:
-                if target != select_label:
+                keep = target == select_label
+                if not keep.any():
                     continue
-
-            img_folder = os.path.abspath(img_folder)
-            intermed_reps_folder = os.path.abspath(intermed_reps_folder)
-            if not os.path.isdir(intermed_reps_folder):
-                os.makedirs(intermed_reps_folder)
-            if not os.path.isdir(img_folder):
-                os.makedirs(img_folder)
+                input, target = input[keep], target[keep]
+            input = input.cuda()
 
             # compute output
             with torch.no_grad():
                 ir = local_model(input)
-            
-            if self.confidence_score:
-                self.model.cloud.eval()
-                ir = self.model.cloud(ir)
-                if "mobilenetv2" in self.arch:
-                    ir = F.avg_pool2d(ir, 4)
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-                elif self.arch == "resnet20" or self.arch == "resnet32":
-                    ir = F.avg_pool2d(ir, 8)
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-                else:
-                    ir = ir.view(ir.size(0), -1)
-                    ir = self.classifier(ir)
-            
-            if attack_from_later_layer > -1 and (not self.confidence_score):
-                self.model.cloud.eval()
 
-                activation_4 = {}
-
-                def get_activation_4(name):
-                    def hook(model, input, output):
-                        activation_4[name] = output.detach()
-
-                    return hook
+                if self.confidence_score:
+                    self.model.cloud.eval()
+                    ir = self.model.cloud(ir)
+                    if "mobilenetv2" in self.arch:
+                        ir = F.avg_pool2d(ir, 4)
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
+                    elif self.arch == "resnet20" or self.arch == "resnet32":
+                        ir = F.avg_pool2d(ir, 8)
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
+                    else:
+                        ir = ir.view(ir.size(0), -1)
+                        ir = self.classifier(ir)
 
-                with torch.no_grad():
-                    activation_4 = {}
-                    count = 0
-                    for name, m in self.model.cloud.named_modules():
-                        if attack_from_later_layer == count:
-                            m.register_forward_hook(get_activation_4("ACT-{}".format(name)))
-                            valid_key = "ACT-{}".format(name)
-                            break
-                        count += 1
+                if attack_from_later_layer > -1 and (not self.confidence_score):
+                    activation_4.clear()
                     output = self.model.cloud(ir)
-                try:
-                    ir = activation_4[valid_key]
-                except:
-                    print("cannot attack from later layer, server-side model is empty or does not have enough layers")
+                    try:
+                        ir = activation_4[valid_key]
+                    except:
+                        print("cannot attack from later layer, server-side model is empty or does not have enough layers")
             ir = ir.float()
 
             if "truncate" in attack_option:
@@ -2287,15 +2224,22 @@ class MIA_train: # main class for every thing
                 except:
                     print("auto extract percentage fail. Use default percentage_left = 20")
                     percentage_left = 20
-                ir = prune_top_n_percent_left(ir, percentage_left)
+                ir = defenses.prune_top_n_percent_left(ir, percentage_left)
 
-            inp_img_path = "{}/{}.jpg".format(img_folder, file_id)
-            out_tensor_path = "{}/{}.pt".format(intermed_reps_folder, file_id)
-            
             input = denormalize(input, self.dataset)
-            save_image(input, inp_img_path)
-            torch.save(ir.cpu(), out_tensor_path)
-            file_id += 1
+            if ir_store:
+                # clamp as save_image did, but keep full precision (no JPEG round-trip)
+                writer.append(input.clamp(0, 1), ir, target)
+                file_id = writer.count
+            else:
+                for j in range(input.size(0)):
+                    save_image(input[j:j + 1], "{}/{}.jpg".format(img_folder, file_id))
+                    torch.save(ir[j:j + 1].cpu(), "{}/{}.pt".format(intermed_reps_folder, file_id))
+                    file_id += 1
+        if writer is not None:
+            writer.close()
+        if hook_handle is not None:
+            hook_handle.remove()
         print("Overall size of Training/Validation Datset for AE is {}: {}".format(int(file_id * 0.9),
                                                                                    int(file_id * 0.1)))
 
@@ -2308,6 +2252,31 @@ class MIA_train: # main class for every thing
         input = denormalize(input, self.dataset)
         return input,ir
 
+    def iter_feat_pairs(self, loader, local_model, feature_cache=True, model_key=None):
+        """
+        Yield (img, ir, target) batches for the decoder loops.
+        With feature_cache the frozen client model runs once per (checkpoint hash, split, cut layer) and later
+        epochs replay the cached clean features (shuffled if the loader shuffles); defence noise is added by the
+        caller on top, fresh every epoch.
+        model_key: model_state_hash(local_model), computed once by the caller (hashing copies every state_dict
+        tensor to the host); only computed here if not given.
+        """
+        if not feature_cache:
+            for input, target in loader:
+                img, ir = self.gen_inp_feat_pair(input, local_model)
+                yield img, ir, target
+            return
+        if model_key is None:
+            model_key = model_state_hash(local_model)
+        key = (model_key, loader_fingerprint(loader), self.cutting_layer)
+        dataset = self.feature_cache.get(key, loader, lambda input: self.gen_inp_feat_pair(input, local_model))
+        if isinstance(loader.sampler, torch.utils.data.RandomSampler):
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+        for img, ir, target in tensor_store_loader(dataset, loader.batch_size, sampler):
+            yield img, ir, target
+
 # pre-train a GAN with local data before SFL training
     def pre_GAN_train(self, num_epochs, select_client_list=[0]):
 
@@ -2345,22 +2314,22 @@ class MIA_train: # main class for every thing
                 rmtree(tensor_data_dir)
 
             if self.dataset == "cifar100":
-                val_loader, val_train_loader, val_test_loader= get_cifar100_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_loader, val_train_loader, val_test_loader= get_cifar100_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "cifar10":
-                val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_loader, val_train_loader, val_test_loader = get_cifar10_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "svhn":
-                val_single_loader, _, _ = get_SVHN_testloader(batch_size=1, num_workers=4, shuffle=False)
+                val_single_loader, _, _ = get_SVHN_testloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "mnist":
-                _, val_single_loader = get_mnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_mnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "fmnist":
-                _, val_single_loader = get_fmnist_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_single_loader = get_fmnist_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "facescrub":
-                _, val_loader,train_single_loader,val_train_loader,val_test_loader = get_facescrub_bothloader(batch_size=1, num_workers=4, shuffle=False)
-                # _, val_single_loader = get_facescrub_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_loader,train_single_loader,val_train_loader,val_test_loader = get_facescrub_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
+                # _, val_single_loader = get_facescrub_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "tinyimagenet":
-                _, val_loader,train_single_loader,val_train_loader,val_test_loader = get_tinyimagenet_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_loader,train_single_loader,val_train_loader,val_test_loader = get_tinyimagenet_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             elif self.dataset == "imagenet":
-                _, val_loader,train_single_loader,val_train_loader,val_test_loader = get_imagenet_bothloader(batch_size=1, num_workers=4, shuffle=False)
+                _, val_loader,train_single_loader,val_train_loader,val_test_loader = get_imagenet_bothloader(batch_size=attack_batchsize, num_workers=4, shuffle=False)
             attack_path = self.save_dir + '/MIA_attack_{}to{}'.format(client_id, client_id)
             if not os.path.isdir(attack_path):
                 os.makedirs(attack_path)
@@ -2741,11 +2710,17 @@ class MIA_train: # main class for every thing
 
     # This function means performing training of the attacker's inversion model, is used in MIA_attack function.
     def attack(self, num_epochs, local_model, decoder, optimizer,scheduler, trainloader, testloader, logger, path_dict, batch_size,
-               loss_type="MSE", pretrained_decoder=None, noise_aware=False):
+               loss_type="MSE", pretrained_decoder=None, noise_aware=False, feature_cache=True, recon_acc_freq=10):
+        """
+        Train the inversion decoder. Losses / accuracies are accumulated on the device and read once per epoch,
+        the reconstruction accuracy (re-inference of the reconstructions) only runs every recon_acc_freq epochs
+        and on the last one, and best checkpoints are written asynchronously.
+        """
         round_ = 0
         min_val_loss = 999.
         max_val_loss = 0.
         train_output_freq = 10
+        ckpt_writer = AsyncCheckpointWriter()
 
 
         # Optimize based on MSE distance
@@ -2763,6 +2738,8 @@ class MIA_train: # main class for every thing
         
         device = next(decoder.parameters()).device
         decoder.train()
+        # the client model is frozen during the attack: hash it once for the feature cache
+        model_key = model_state_hash(local_model) if feature_cache else None
         
         # summary(decoder.cuda(), input_size=(8,8, 8))
         # flops, params = get_model_complexity_info(decoder, (8,8, 8), as_strings=True, print_per_layer_stat=True)
@@ -2771,35 +2748,26 @@ class MIA_train: # main class for every thing
         # print(f"参数数量: {params}")
         
         for epoch in range(round_ * num_epochs, (round_ + 1) * num_epochs):
-            train_losses = AverageMeter()
-            val_losses = AverageMeter()
+            train_losses = DeviceAverageMeter()
+            val_losses = DeviceAverageMeter()
             val_losses_white = AverageMeter()
-            for i, (input, target) in enumerate(trainloader):
-                input = input.cuda()
-                img, ir=self.gen_inp_feat_pair(input,local_model)
-                # img, ir = data
-                img, ir = img.type(torch.FloatTensor), ir.type(torch.FloatTensor)
-                img, ir = Variable(img).to(device), Variable(ir).to(device)
+            for i, (img, ir, target) in enumerate(self.iter_feat_pairs(trainloader, local_model, feature_cache, model_key)):
+                img, ir = img.to(device, non_blocking=True).float(), ir.to(device, non_blocking=True).float()
                 # print(img)
                 # Use local DP for training the AE.
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(ir).cuda()
+                    noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                     ir += noise
 
                 if self.local_DP and noise_aware:
                     with torch.no_grad():
-                        if "laplace" in self.regularization_option:
-                            ir += torch.from_numpy(
-                                np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=ir.size())).cuda()
-                        else:  # apply gaussian noise
-                            delta = 10e-5
-                            sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                            ir += sigma * torch.randn_like(ir).cuda()
+                        ir = ir + defenses.local_dp_noise(ir, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                          generator=self.defense_generator)
                 if self.dropout_defense and noise_aware:
-                    ir = dropout_defense(ir, self.dropout_ratio)
+                    ir = defenses.dropout_defense(ir, self.dropout_ratio, generator=self.defense_generator)
                 if self.topkprune and noise_aware:
-                    ir = prune_defense(ir, self.topkprune_ratio)
+                    ir = defenses.prune_defense(ir, self.topkprune_ratio)
                 if pretrained_decoder is not None and "gan_adv_noise" in self.regularization_option and noise_aware:
                     epsilon = self.alpha2
                     
@@ -2838,7 +2806,7 @@ class MIA_train: # main class for every thing
                 train_loss.backward()
                 optimizer.step()
 
-                train_losses.update(train_loss.item(), ir.size(0))
+                train_losses.update(train_loss, ir.size(0))
                 # if i %50 ==0:
                 #     print('iter:',i,'loss:',train_loss.item())
             scheduler.step()
@@ -2846,22 +2814,21 @@ class MIA_train: # main class for every thing
             print(f"Epoch {epoch+1}, Current LR: {current_lr}")
             if (epoch + 1) % train_output_freq == 0:
                 save_images(img, output, epoch, path_dict["train_output_path"], offset=0, batch_size=batch_size)
-            top1 = AverageMeter()
+            top1 = DeviceAverageMeter()
+            check_acc = (epoch + 1) % recon_acc_freq == 0 or epoch + 1 == (round_ + 1) * num_epochs
+            best_val_loss = None
             # if epoch == 1:
             rec_inputs_list = []
             targets_list = []
-            for i, (input, target) in enumerate(testloader):
-                input = input.cuda()
-                img, ir=self.gen_inp_feat_pair(input,local_model)
+            for i, (img, ir, target) in enumerate(self.iter_feat_pairs(testloader, local_model, feature_cache, model_key)):
                 # decoder.eval()
-                # img, ir = data
-                img, ir = img.type(torch.FloatTensor), ir.type(torch.FloatTensor)
-                img, ir = Variable(img).to(device), Variable(ir).to(device)
+                img, ir = img.to(device, non_blocking=True).float(), ir.to(device, non_blocking=True).float()
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(ir).cuda()
+                    noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                     ir += noise
-                output = decoder(ir)
+                with torch.no_grad():
+                    output = decoder(ir)
                 criterion_test = nn.MSELoss()
                 reconstruction_loss = criterion_test(output, img)
 
@@ -2869,34 +2836,35 @@ class MIA_train: # main class for every thing
                 # if epoch==10:
                 #     self.save_dir = "new_saves/cifar10/Aresult_model/None_infocons_sgm_lg1_thre0.125/pretrain_False_lambd_0_noise_0.01_epoch_240_bottleneck_noRELU_C8S1_log_1_ATstrength_0.3_lr_0.05_varthres_0.125/"
                 #     self.resume(model_path_f=None)
-                rec_inputs = normalize(output,self.dataset)
-                rec_inputs_list.append(rec_inputs.clone().cpu())  # 保存 inputs
-                targets_list.append(target.clone().cpu())
-                
-                pred = self.model.local_list[0](rec_inputs.cuda())
-                with torch.no_grad():
-                    pred = self.f_tail(pred)
-                    # if "Gaussian" in self.regularization_option:
-                    #     sigma = self.regularization_strength
-                    #     noise = sigma * torch.randn_like(pred).cuda()
-                    #     pred += noise
-                    if "mobilenetv2" in self.arch:
-                        pred = F.avg_pool2d(pred, 4)
-                        pred = pred.view(pred.size(0), -1)
-                        pred = self.classifier(pred)
-                    elif self.arch == "resnet20" or self.arch == "resnet32":
-                        pred = F.avg_pool2d(pred, 8)
-                        pred = pred.view(pred.size(0), -1)
-                        pred = self.classifier(pred)
-                    else:
-                        pred = pred.view(pred.size(0), -1)
-                        pred = self.classifier(pred)
-                prec1 = accuracy(pred.data.cpu(), target.cpu())[
-                0] 
-                top1.update(prec1.item(), input.size(0))
-               
-                
-                
+                if check_acc or epoch == 49:
+                    rec_inputs = normalize(output,self.dataset)
+                if epoch == 49:
+                    rec_inputs_list.append(rec_inputs.clone().cpu())  # 保存 inputs
+                    targets_list.append(target.clone().cpu())
+
+                if check_acc:
+                    with torch.no_grad():
+                        pred = self.model.local_list[0](rec_inputs.cuda())
+                        pred = self.f_tail(pred)
+                        # if "Gaussian" in self.regularization_option:
+                        #     sigma = self.regularization_strength
+                        #     noise = sigma * torch.randn_like(pred).cuda()
+                        #     pred += noise
+                        if "mobilenetv2" in self.arch:
+                            pred = F.avg_pool2d(pred, 4)
+                            pred = pred.view(pred.size(0), -1)
+                            pred = self.classifier(pred)
+                        elif self.arch == "resnet20" or self.arch == "resnet32":
+                            pred = F.avg_pool2d(pred, 8)
+                            pred = pred.view(pred.size(0), -1)
+                            pred = self.classifier(pred)
+                        else:
+                            pred = pred.view(pred.size(0), -1)
+                            pred = self.classifier(pred)
+                    prec1 = accuracy(pred.data, target.to(pred.device, non_blocking=True))[
+                    0] 
+                    top1.update(prec1, img.size(0))
+
                 whitebox_con=0
                 # whitebox_con=
                 if whitebox_con==1:
@@ -2905,20 +2873,27 @@ class MIA_train: # main class for every thing
                     val_losses_white.update(val_loss_white.item(), ir.size(0))
                 val_loss = reconstruction_loss
 
-                if loss_type == "MSE" and val_loss < min_val_loss:
-                    min_val_loss = val_loss
-                    torch.save(decoder.state_dict(), path_dict["model_path"])
-                elif loss_type == "SSIM" and val_loss > max_val_loss:
-                    max_val_loss = val_loss
-                    torch.save(decoder.state_dict(), path_dict["model_path"])
-                elif loss_type == "PSNR" and val_loss > max_val_loss:
-                    max_val_loss = val_loss
-                    torch.save(decoder.state_dict(), path_dict["model_path"])
-                val_losses.update(val_loss.item(), ir.size(0))
-
-                self.writer.add_scalar('decoder_loss/val', val_loss.item(), len(testloader) * epoch + i)
-                self.writer.add_scalar('decoder_loss/val_loss/reconstruction', reconstruction_loss.item(),
-                                       len(testloader) * epoch + i)
+                # the decoder does not change during validation, so the best batch of the epoch decides
+                # whether this epoch's decoder is saved (same checkpoint as comparing batch by batch)
+                if best_val_loss is None:
+                    best_val_loss = val_loss.detach()
+                elif loss_type == "MSE":
+                    best_val_loss = torch.minimum(best_val_loss, val_loss.detach())
+                else:
+                    best_val_loss = torch.maximum(best_val_loss, val_loss.detach())
+                val_losses.update(val_loss, ir.size(0))
+
+            if best_val_loss is not None:
+                best_val_loss = best_val_loss.item()
+                if loss_type == "MSE" and best_val_loss < min_val_loss:
+                    min_val_loss = best_val_loss
+                    ckpt_writer.save(decoder.state_dict(), path_dict["model_path"])
+                elif loss_type in ["SSIM", "PSNR"] and best_val_loss > max_val_loss:
+                    max_val_loss = best_val_loss
+                    ckpt_writer.save(decoder.state_dict(), path_dict["model_path"])
+
+            self.writer.add_scalar('decoder_loss/val', val_losses.avg, epoch)
+            self.writer.add_scalar('decoder_loss/val_loss/reconstruction', val_losses.avg, epoch)
             if epoch ==49:
                 self.save_dir = "new_saves/cifar10/None_infocons_sgm_lg1_thre0.125/pretrain_False_lambd_0_noise_0.01_epoch_240_bottleneck_noRELU_C8S1_log_1_ATstrength_0.3_lr_0.05_varthres_0.125/"
                 self.resume(model_path_f=None)
@@ -2943,10 +2918,12 @@ class MIA_train: # main class for every thing
                             pred = self.classifier(pred)
                     prec1 = accuracy(pred.data.cpu(), targets.cpu())[
                     0] 
-                    top1.update(prec1.item(), input.size(0))
-            print('the pred acc is:',top1.avg)
-            for name, param in decoder.named_parameters():
-                self.writer.add_histogram("decoder_params/{}".format(name), param.clone().cpu().data.numpy(), epoch)
+                    top1.update(prec1, rec_inputs.size(0))
+            if check_acc:
+                print('the pred acc is:',top1.avg)
+            if (epoch + 1) % train_output_freq == 0:
+                for name, param in decoder.named_parameters():
+                    self.writer.add_histogram("decoder_params/{}".format(name), param.clone().cpu().data.numpy(), epoch)
 
             # torch.save(decoder.state_dict(), path_dict["model_path"])
             if whitebox_con==1:
@@ -2959,6 +2936,7 @@ class MIA_train: # main class for every thing
                     "epoch [{}/{}], train_loss {train_losses.val:.4f} ({train_losses.avg:.4f}), val_loss {val_losses.val:.4f} ({val_losses.avg:.4f})".format(
                         epoch + 1,
                         num_epochs, train_losses=train_losses, val_losses=val_losses))                
+        ckpt_writer.join()
         if loss_type == "MSE":
             logger.debug("Best Validation Loss is {}".format(min_val_loss))
         elif loss_type == "SSIM":
@@ -3013,7 +2991,7 @@ class MIA_train: # main class for every thing
                 gen_ir= model(X_rec)
                 if "Gaussian" in self.regularization_option:
                     sigma = self.regularization_strength
-                    noise = sigma * torch.randn_like(gen_ir).cuda()
+                    noise = defenses.gaussian_noise(gen_ir, sigma, generator=self.defense_generator)
                     gen_ir = gen_ir + noise
 
                 # loss = nn.MSELoss()(10*gen_ir.cuda(), 10*feature)
@@ -3059,7 +3037,7 @@ class MIA_train: # main class for every thing
 
     # This function means testing of the attacker's inversion model
     def test_attack(self, num_epochs, local_model,decoder, sp_testloader, logger, path_dict, batch_size, num_classes=10,
-                    select_label=0,sp_not=0):
+                    select_label=0,sp_not=0, feature_cache=True):
         device = next(decoder.parameters()).device
         # # print("Load the best Decoder Model...")
         # new_state_dict = torch.load(path_dict["model_path"])
@@ -3072,16 +3050,14 @@ class MIA_train: # main class for every thing
         ssim_loss = pytorch_ssim.SSIM()
 
         criterion = nn.MSELoss()
+        model_key = model_state_hash(local_model) if feature_cache else None
 
-        for i, (input, target) in enumerate(sp_testloader):
-            input = input.cuda()
-            img, ir=self.gen_inp_feat_pair(input,local_model)
+        for i, (img, ir, target) in enumerate(self.iter_feat_pairs(sp_testloader, local_model, feature_cache, model_key)):
             decoder.eval()
-            img, ir = img.type(torch.FloatTensor), ir.type(torch.FloatTensor)
-            img, ir = Variable(img).to(device), Variable(ir).to(device)
+            img, ir = img.to(device, non_blocking=True).float(), ir.to(device, non_blocking=True).float()
             if "Gaussian" in self.regularization_option:
                 sigma = self.regularization_strength
-                noise = sigma * torch.randn_like(ir).cuda()
+                noise = defenses.gaussian_noise(ir, sigma, generator=self.defense_generator)
                 ir += noise
             output_imgs = decoder(ir)
             reconstruction_loss = criterion(output_imgs, img)
@@ -3195,18 +3171,12 @@ class MIA_train: # main class for every thing
             #     # noise = 10000*sigma * torch.randn_like(save_activation).cuda()
             #     save_activation += noise
             if self.local_DP and not clean_option:  # local DP or additive noise
-                if "laplace" in self.regularization_option:
-                    save_activation += torch.from_numpy(
-                        np.random.laplace(loc=0, scale=1 / self.dp_epsilon, size=save_activation.size())).cuda()
-                    # the addtive work uses scale in (0.1 0.5 1.0) -> (1 2 10) regularization_strength (self.dp_epsilon)
-                else:  # apply gaussian noise
-                    delta = 10e-5
-                    sigma = np.sqrt(2 * np.log(1.25 / delta)) * 1 / self.dp_epsilon
-                    save_activation += sigma * torch.randn_like(save_activation).cuda()
+                save_activation = save_activation + defenses.local_dp_noise(save_activation, self.dp_epsilon, laplace="laplace" in self.regularization_option,
+                                                                            generator=self.defense_generator)
             if self.dropout_defense and not clean_option:  # activation dropout defense
-                save_activation = dropout_defense(save_activation, self.dropout_ratio)
+                save_activation = defenses.dropout_defense(save_activation, self.dropout_ratio, generator=self.defense_generator)
             if self.topkprune and not clean_option:
-                save_activation = prune_defense(save_activation, self.topkprune_ratio)
+                save_activation = defenses.prune_defense(save_activation, self.topkprune_ratio)
             
             img = denormalize(img, self.dataset)
                 
@@ -3231,7 +3201,7 @@ class MIA_train: # main class for every thing
 
                 save_activation = save_activation - grad.detach() * epsilon
             if "truncate" in attack_option:
-                save_activation = prune_top_n_percent_left(save_activation)
+                save_activation = defenses.prune_top_n_percent_left(save_activation)
             
             save_activation = save_activation.float()
             
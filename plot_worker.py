@@ -0,0 +1,144 @@
+import atexit
+import os
+
+import numpy as np
+import torch.multiprocessing as mp
+
+# ============================================================================
+# Background visualisation worker
+# t-SNE embeddings and matplotlib figures are produced in a dedicated process so the training loop never waits
+# on them. Feature snapshots are sent as CPU tensors through a torch.multiprocessing queue, i.e. they are moved
+# to shared memory and only a handle crosses the pipe.
+# ============================================================================
+
+
+def embed_2d(features, labels, max_points=5000, pca_dims=50, method="auto", seed=42):
+    """
+    2-D t-SNE embedding of features [N, D].
+
+    - max_points: random subsample before embedding (t-SNE cost grows super-linearly with N)
+    - pca_dims: PCA pre-reduction of the features, the embedding is also PCA-initialised
+    - method: "opentsne" (FFT-accelerated, if installed), "sklearn" or "auto" (openTSNE when available)
+
+    Returns:
+    - embedding [n, 2], labels [n] (numpy)
+    """
+    X = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+    y = np.asarray(labels)
+    rng = np.random.RandomState(seed)
+    if max_points and len(X) > max_points:
+        idx = np.sort(rng.choice(len(X), max_points, replace=False))
+        X, y = X[idx], y[idx]
+    if pca_dims and X.shape[1] > pca_dims and len(X) > pca_dims:
+        X = X - X.mean(axis=0, keepdims=True)
+        _, _, Vt = np.linalg.svd(X, full_matrices=False)
+        X = X @ Vt[:pca_dims].T
+
+    if method in ("auto", "opentsne"):
+        try:
+            from openTSNE import TSNE as OpenTSNE
+            embedding = OpenTSNE(perplexity=30, initialization="pca", negative_gradient_method="fft",
+                                 random_state=seed, n_jobs=-1).fit(X)
+            return np.asarray(embedding), y
+        except ImportError:
+            if method == "opentsne":
+                raise
+    from sklearn.manifold import TSNE
+    tsne = TSNE(n_components=2, perplexity=30, learning_rate=200, max_iter=1000, init="pca", random_state=seed)
+    return tsne.fit_transform(X), y
+
+
+def _plot_tsne(task):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    reduced_features, labels = embed_2d(task["features"].numpy(), task["labels"].numpy(),
+                                        max_points=task["max_points"], method=task["method"])
+    os.makedirs(os.path.dirname(task["file_name"]), exist_ok=True)
+    plt.figure(figsize=(10, 8))
+    scatter = plt.scatter(reduced_features[:, 0], reduced_features[:, 1], c=labels, cmap='viridis')
+    plt.colorbar(scatter)
+    plt.xlabel('t-SNE Component 1')
+    plt.ylabel('t-SNE Component 2')
+    plt.title(task["title"])
+    plt.savefig(task["file_name"])
+    plt.close()
+    print(task["file_name"])
+
+
+def _plot_curve(task):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    values = task["values"]
+    epochs = list(range(1, len(values) + 1))
+    os.makedirs(os.path.dirname(task["file_name"]), exist_ok=True)
+    plt.figure(figsize=(10, 6))
+    plt.plot(epochs, values, label=task["label"], marker='o', color=task["color"])
+    plt.xlabel('Epoch')
+    plt.ylabel(task["label"])
+    plt.title(task["title"])
+    plt.legend()
+    plt.grid(True)
+    plt.savefig(task["file_name"])
+    plt.close()
+
+
+_PLOTTERS = {"tsne": _plot_tsne, "curve": _plot_curve}
+
+
+def _worker_loop(queue):
+    while True:
+        task = queue.get()
+        if task is None:
+            break
+        try:
+            _PLOTTERS[task["kind"]](task)
+        except Exception as e:  # a failed plot must not kill the worker
+            print("plot worker: {} failed for {}: {}".format(task["kind"], task.get("file_name"), e))
+
+
+class PlotWorker(object):
+    """
+    Dedicated plotting process. submit_* only enqueues (features are copied to shared CPU memory once);
+    close() waits for the pending plots.
+
+    The process is forked where available: the training entry scripts have no __main__ guard, so a spawned
+    child would re-run them. The child never touches CUDA. background=False plots inline (debugging).
+    """
+    def __init__(self, background=True):
+        self.background = background
+        self.process = None
+        self.queue = None
+        if background:
+            ctx = mp.get_context("fork" if "fork" in mp.get_all_start_methods() else "spawn")
+            self.queue = ctx.Queue()
+            self.process = ctx.Process(target=_worker_loop, args=(self.queue,), daemon=True)
+            self.process.start()
+            atexit.register(self.close)
+
+    def _submit(self, task):
+        if self.process is not None and self.process.is_alive():
+            self.queue.put(task)
+        else:
+            _PLOTTERS[task["kind"]](task)
+
+    def submit_tsne(self, features, labels, file_name, title, max_points=5000, method="auto"):
+        features = features.detach().reshape(len(features), -1).float().cpu()
+        labels = labels.detach().cpu()
+        if self.background:
+            features.share_memory_()
+            labels.share_memory_()
+        self._submit({"kind": "tsne", "features": features, "labels": labels, "file_name": file_name,
+                      "title": title, "max_points": max_points, "method": method})
+
+    def submit_curve(self, values, file_name, label, title, color='blue'):
+        self._submit({"kind": "curve", "values": [float(v) for v in values], "file_name": file_name,
+                      "label": label, "title": title, "color": color})
+
+    def close(self):
+        if self.process is not None:
+            if self.process.is_alive():
+                self.queue.put(None)
+                self.process.join()
+            self.process = None
@@ -108,4 +108,9 @@ if __name__ == '__main__':
         total_num_files += files_count
     
     print("total number of validation file is {}".format(total_num_files))
+
+    # one-time packed cache (uint8 memmap + labels) read by get_facescrub_bothloader instead of the image files
+    from datasets_torch import pack_image_folder
+    pack_image_folder(train_dir)
+    pack_image_folder(validate_dir)
         
@@ -43,4 +43,8 @@ if __name__ == '__main__':
         if not os.path.exists(newpath):
             os.makedirs(newpath)
         if os.path.exists(os.path.join(val_img_dir, img)):
-            os.rename(os.path.join(val_img_dir, img), os.path.join(newpath, img))
\ No newline at end of file
+            os.rename(os.path.join(val_img_dir, img), os.path.join(newpath, img))
+    # one-time packed cache (uint8 memmap + labels) read by get_tinyimagenet_bothloader instead of the JPEG files
+    from datasets_torch import pack_image_folder
+    pack_image_folder(TRAIN_DIR)
+    pack_image_folder(val_img_dir)
@@ -38,38 +38,66 @@ def _ssim(img1, img2, window, window_size, channel, size_average = True):
     else:
         return ssim_map.mean(1).mean(1).mean(1)
 
+# ---------------------------------------------------------------------------
+# Fast path: the 2-D Gaussian window is the outer product of the 1-D one, so every blur is a horizontal
+# (1 x ws) and a vertical (ws x 1) depthwise conv (zero padding is preserved by the separation). The five
+# blurred maps (img1, img2, img1^2, img2^2, img1*img2) are stacked along the channel axis and filtered by a
+# single pair of grouped convs. The 1-D windows are cached per (window_size, channel, dtype, device).
+# ---------------------------------------------------------------------------
+_window_cache = {}
+
+def get_separable_window(window_size, channel, dtype, device):
+    key = (window_size, channel, dtype, device)
+    window = _window_cache.get(key)
+    if window is None:
+        g = gaussian(window_size, 1.5).to(device=device, dtype=dtype)
+        window = (g.view(1, 1, 1, window_size).expand(5 * channel, 1, 1, window_size).contiguous(),
+                  g.view(1, 1, window_size, 1).expand(5 * channel, 1, window_size, 1).contiguous())
+        _window_cache[key] = window
+    return window
+
+def _ssim_fast(img1, img2, window_size, channel, size_average = True):
+    """Same result as _ssim (up to float rounding). size_average=False returns one SSIM value per image [B]."""
+    window_h, window_v = get_separable_window(window_size, channel, img1.dtype, img1.device)
+    pad = window_size // 2
+    stacked = torch.cat([img1, img2, img1 * img1, img2 * img2, img1 * img2], dim=1)
+    blurred = F.conv2d(stacked, window_h, padding = (0, pad), groups = 5 * channel)
+    blurred = F.conv2d(blurred, window_v, padding = (pad, 0), groups = 5 * channel)
+    mu1, mu2, e11, e22, e12 = blurred.split(channel, dim=1)
+
+    mu1_sq = mu1.pow(2)
+    mu2_sq = mu2.pow(2)
+    mu1_mu2 = mu1*mu2
+
+    sigma1_sq = e11 - mu1_sq
+    sigma2_sq = e22 - mu2_sq
+    sigma12 = e12 - mu1_mu2
+
+    C1 = 0.01**2
+    C2 = 0.03**2
+
+    ssim_map = ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+
+    if size_average:
+        return ssim_map.mean()
+    else:
+        return ssim_map.flatten(1).mean(1)
+
 class SSIM(torch.nn.Module):
     def __init__(self, window_size = 11, size_average = True):
         super(SSIM, self).__init__()
         self.window_size = window_size
         self.size_average = size_average
-        self.channel = 1
-        self.window = create_window(window_size, self.channel)
 
     def forward(self, img1, img2):
         (_, channel, _, _) = img1.size()
-
-        if channel == self.channel and self.window.data.type() == img1.data.type():
-            window = self.window
-        else:
-            window = create_window(self.window_size, channel)
-            
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
-            
-            self.window = window
-            self.channel = channel
-
-
-        return _ssim(img1, img2, window, self.window_size, channel, self.size_average)
+        # windows come from the module-level cache, so building a fresh SSIM() per step is free
+        return _ssim_fast(img1, img2, self.window_size, channel, self.size_average)
 
 def ssim(img1, img2, window_size = 11, size_average = True):
     (_, channel, _, _) = img1.size()
-    window = create_window(window_size, channel)
-    
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
-    
-    return _ssim(img1, img2, window, window_size, channel, size_average)
+    return _ssim_fast(img1, img2, window_size, channel, size_average)
+
+def ssim_per_image(img1, img2, window_size = 11):
+    """SSIM of every image pair in the batch, [B] (for batched attack evaluation)."""
+    return ssim(img1, img2, window_size, size_average = False)
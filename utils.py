@@ -10,6 +10,7 @@ from torch.nn import functional as F
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 import matplotlib.pyplot as plt
 import copy
+import threading
 
 
 def freeze_model_bn(model):
@@ -36,30 +37,9 @@ def clustering_loss(model, lambda_coeff, l_norm=2):
     
     return pc_loss 
 
-def prune_top_n_percent_left(tensor, n = 20):
-    tensor_shape = tensor.size()
-    num_ele = int(np.prod(tensor_shape) * (100 - n) / 100.)
-    tensor = torch.flatten(tensor)
-    _, index = tensor.topk(k = num_ele, dim = 0, largest = False)
-    tensor[index] = 0.0
-    return tensor.view(tensor_shape)
-
-
-def dropout_defense(tensor, ratio = 0.5):
-    tensor_shape = tensor.size()
-    device = tensor.device
-    A_array = torch.rand(tensor_shape) < ratio
-    A_array = A_array.to(device)
-    tensor = tensor.masked_fill(A_array, 0)
-    return tensor
+# activation defences live in defenses.py (device-side RNG, per-sample pruning); re-exported for old imports
+from defenses import prune_top_n_percent_left, dropout_defense, prune_defense
 
-def prune_defense(tensor, ratio = 0.5):
-    tensor_shape = tensor.size()
-    num_ele = int(np.prod(tensor_shape) * ratio)
-    tensor = torch.flatten(tensor)
-    _, index = tensor.topk(k = num_ele, dim = 0, largest = False)
-    tensor[index] = 0.0
-    return tensor.view(tensor_shape)
 # def spurious_score_V0(var, lambda_coeff, l_norm):
 #     var1 = 1 / var.mean().pow(l_norm).sum()
 #     return lambda_coeff*(var1)
@@ -116,6 +96,17 @@ def load_grad(model, state_dict, print_option = False):
             print(param.grad)
 
 
+def scale_grad(tensor, scale):
+    """
+    Identity in the forward pass; the gradient flowing back through the returned view is multiplied by scale.
+    Only the branch built on the returned view is affected, other consumers of tensor keep the unscaled gradient.
+    """
+    if not tensor.requires_grad:
+        return tensor
+    tensor = tensor.view_as(tensor)
+    tensor.register_hook(lambda grad: grad * scale)
+    return tensor
+
 
 def torch_diff(tensor_val1, tensor_val2):
     return tensor_val1 - tensor_val2, tensor_val1 > tensor_val2
@@ -243,79 +234,272 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
-def pairwise_dist_torch(A):
-    sigma = torch.Tensor([1e-7]).to(A.device)
-    r = torch.sum(A*A, axis = 1)
-    r = r.view(-1, 1)
-    # print(r)
-    D = torch.maximum(r - 2*torch.matmul(A, A.t()) + r.t(), sigma)
-    D = torch.sqrt(D)
-    return D
+class DeviceAverageMeter(object):
+    """
+    AverageMeter whose running sum stays on the device. update() never synchronises;
+    .val / .avg copy to the host when they are read (once per epoch in the logs).
+    """
+    def __init__(self):
+        self.reset()
 
+    def reset(self):
+        self.last = None
+        self.sum = 0
+        self.count = 0
 
+    def update(self, val, n=1):
+        val = val.detach()
+        self.last = val
+        self.sum = self.sum + val * n
+        self.count += n
 
-class DistanceCorrelationLoss(torch.nn.modules.loss._Loss):
-    def forward(self, input_data, intermediate_data):
-        input_data = input_data.view(input_data.size(0), -1)
-        intermediate_data = intermediate_data.view(intermediate_data.size(0), -1)
+    @property
+    def val(self):
+        return 0 if self.last is None else float(self.last)
 
-        # Get A matrices of data
-        A_input = self._A_matrix(input_data)
-        A_intermediate = self._A_matrix(intermediate_data)
+    @property
+    def avg(self):
+        return 0 if self.count == 0 else float(self.sum) / self.count
 
-        # Get distance variances
-        input_dvar = self._distance_variance(A_input)
-        intermediate_dvar = self._distance_variance(A_intermediate)
+class AsyncCheckpointWriter(object):
+    """
+    torch.save in a background thread. save() snapshots the state dict with device-side clones, so training can
+    keep updating the parameters; the device -> host copy and the file write happen in the writer thread.
+    Only one write is in flight; a new save() (or join()) waits for the previous one.
+    """
+    def __init__(self):
+        self.thread = None
 
-        # Get distance covariance
-        dcov = self._distance_covariance(A_input, A_intermediate)
+    def save(self, state_dict, path):
+        snapshot = OrderedDict((k, v.detach().clone()) for k, v in state_dict.items())
+        self.join()
+        self.thread = threading.Thread(target=lambda: torch.save(
+            OrderedDict((k, v.cpu()) for k, v in snapshot.items()), path))
+        self.thread.start()
 
-        # Put it together
-        dcorr = dcov / (input_dvar * intermediate_dvar).sqrt()
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
 
-        return dcorr
+class ClassFeatureStats(object):
+    """
+    Streaming per-class count / mean / variance of flattened features (Chan et al. pairwise merge, one batch
+    at a time), plus a fixed-size reservoir sample of (feature, label) pairs kept on the CPU for visualisation.
+    Peak memory is O(num_class * D + reservoir_size * D), independent of the dataset size.
+    """
+    def __init__(self, num_class, reservoir_size=10000, seed=0):
+        self.num_class = num_class
+        self.reservoir_size = reservoir_size
+        self.generator = torch.Generator().manual_seed(seed)
+        self.reset()
 
-    def _distance_covariance(self, a_matrix, b_matrix):
-        return (a_matrix * b_matrix).sum().sqrt() / a_matrix.size(0)
+    def reset(self):
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.seen = 0
+        self.reservoir_feat = None
+        self.reservoir_label = None
+
+    def update(self, features, labels):
+        features = features.detach().reshape(features.size(0), -1)
+        labels = labels.to(features.device).long()
+        feats = features.double()
+        if self.count is None:
+            self.count = torch.zeros(self.num_class, dtype=torch.float64, device=features.device)
+            self.mean = torch.zeros(self.num_class, feats.size(1), dtype=torch.float64, device=features.device)
+            self.m2 = torch.zeros_like(self.mean)
+
+        # batch statistics with segment reductions
+        b_count = torch.bincount(labels, minlength=self.num_class).double()
+        b_mean = torch.zeros_like(self.mean).index_add_(0, labels, feats) / b_count.clamp_min(1).unsqueeze(1)
+        b_m2 = torch.zeros_like(self.m2).index_add_(0, labels, (feats - b_mean[labels]) ** 2)
+
+        # merge into the running statistics
+        n = self.count + b_count
+        delta = b_mean - self.mean
+        self.mean += delta * (b_count / n.clamp_min(1)).unsqueeze(1)
+        self.m2 += b_m2 + delta ** 2 * (self.count * b_count / n.clamp_min(1)).unsqueeze(1)
+        self.count = n
+
+        if self.reservoir_size > 0:
+            self._update_reservoir(features, labels)
+
+    def _update_reservoir(self, features, labels):
+        # vectorised Algorithm R: item number n is kept with probability K / (n + 1)
+        K, b = self.reservoir_size, features.size(0)
+        if self.reservoir_feat is None:
+            self.reservoir_feat = torch.empty(K, features.size(1), dtype=features.dtype)
+            self.reservoir_label = torch.empty(K, dtype=torch.long)
+        fill = max(0, min(K - self.seen, b))
+        if fill > 0:
+            self.reservoir_feat[self.seen:self.seen + fill] = features[:fill].cpu()
+            self.reservoir_label[self.seen:self.seen + fill] = labels[:fill].cpu()
+        if fill < b:
+            item_idx = torch.arange(self.seen + fill, self.seen + b, dtype=torch.float64)
+            slot = (torch.rand(b - fill, generator=self.generator, dtype=torch.float64) * (item_idx + 1)).long()
+            keep = slot < K
+            if keep.any():
+                rows = torch.nonzero(keep).squeeze(1) + fill
+                self.reservoir_feat[slot[keep]] = features[rows.to(features.device)].cpu()
+                self.reservoir_label[slot[keep]] = labels[rows.to(labels.device)].cpu()
+        self.seen += b
+
+    def variance(self, unbiased=False):
+        denom = self.count - 1 if unbiased else self.count
+        return self.m2 / denom.clamp_min(1).unsqueeze(1)
+
+    def sample(self):
+        n = min(self.seen, self.reservoir_size)
+        return self.reservoir_feat[:n], self.reservoir_label[:n]
+
+    def logvar_metric(self, var_threshold, reg_strength, eps_var=1e-4, gamma=1e-3):
+        # thresholded per-class log-variance (same surrogate as the CEM loss), averaged with class-frequency weights
+        log_threshold = np.log(var_threshold * (reg_strength ** 2) + gamma)
+        logvar = torch.log(self.variance() + eps_var + gamma)
+        per_class = F.relu(logvar - log_threshold).mean(dim=1)
+        weight = self.count * (self.count > 1).double()
+        return float((per_class * weight).sum() / self.count.sum().clamp_min(1))
+
+class FeatureRingBuffer(object):
+    """
+    Preallocated on-device ring buffer of the last `capacity` (feature, label) pairs. push() is a slice copy on the
+    device (no host sync); the storage is allocated on the first push and reused after reset().
+    """
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.feat = None
+        self.label = None
+        self.reset()
 
-    def _distance_variance(self, a_matrix):
-        return (a_matrix ** 2).sum().sqrt() / a_matrix.size(0)
+    def reset(self):
+        self.pos = 0
+        self.seen = 0
+
+    def push(self, features, labels):
+        features = features.detach().reshape(features.size(0), -1)
+        labels = labels.to(features.device, non_blocking=True).long()
+        if self.feat is None or self.feat.shape[1:] != features.shape[1:] or self.feat.device != features.device:
+            self.feat = features.new_empty(self.capacity, features.size(1))
+            self.label = torch.empty(self.capacity, dtype=torch.long, device=features.device)
+        b = features.size(0)
+        if b >= self.capacity:
+            features, labels = features[b - self.capacity:], labels[b - self.capacity:]
+            b = self.capacity
+        first = min(b, self.capacity - self.pos)
+        self.feat[self.pos:self.pos + first] = features[:first]
+        self.label[self.pos:self.pos + first] = labels[:first]
+        if first < b:
+            self.feat[:b - first] = features[first:]
+            self.label[:b - first] = labels[first:]
+        self.pos = (self.pos + b) % self.capacity
+        self.seen += b
+
+    def get(self):
+        """Buffered (features [n, D], labels [n]), n = min(seen, capacity), on the buffer's device."""
+        n = min(self.seen, self.capacity)
+        return self.feat[:n], self.label[:n]
+
+def pairwise_sq_dist_torch(A, B=None, matmul_dtype=None):
+    """
+    Squared Euclidean distances [n, m] via the Gram trick ||a||^2 - 2 a.b + ||b||^2, on the device of A.
+    matmul_dtype (e.g. torch.float16 / torch.bfloat16) runs only the Gram product in reduced precision
+    (mixed-precision path); norms and the result stay in A's dtype.
+    """
+    if B is None:
+        B = A
+    if matmul_dtype is not None and matmul_dtype != A.dtype:
+        gram = torch.matmul(A.to(matmul_dtype), B.to(matmul_dtype).t()).to(A.dtype)
+    else:
+        gram = torch.matmul(A, B.t())
+    ra = torch.sum(A*A, dim = 1).view(-1, 1)
+    rb = torch.sum(B*B, dim = 1).view(1, -1)
+    return torch.clamp(ra - 2*gram + rb, min = 0)
 
-    def _A_matrix(self, data):
-        distance_matrix = self._distance_matrix(data)
+def pairwise_dist_torch(A, B=None, matmul_dtype=None):
+    sigma = 1e-7
+    return torch.sqrt(torch.clamp(pairwise_sq_dist_torch(A, B, matmul_dtype), min = sigma))
 
-        row_mean = distance_matrix.mean(dim=0, keepdim=True)
-        col_mean = distance_matrix.mean(dim=1, keepdim=True)
-        data_mean = distance_matrix.mean()
+def centered_distance_sums(X, Y, squared=False, chunk_size=None, matmul_dtype=None):
+    """
+    sum(A*B), sum(A*A), sum(B*B) for the double-centred distance matrices A (of X) and B (of Y), the
+    building blocks of distance covariance / correlation.
 
-        return distance_matrix - row_mean - col_mean + data_mean
+    Args:
+    - X, Y (torch.Tensor): [n, ...] (flattened to [n, D])
+    - squared (bool): use squared distances (DistanceCorrelationLoss) instead of distances (dist_corr_torch)
+    - chunk_size (int, optional): process chunk_size rows at a time, so only [chunk_size, n] distance blocks
+      exist in the forward pass (two passes: row means, then centred products)
+    - matmul_dtype: reduced-precision Gram product, see pairwise_sq_dist_torch
+    """
+    n = X.size(0)
+    X = X.reshape(n, -1)
+    Y = Y.reshape(n, -1)
+    if squared:
+        dist_fn = lambda P, Q: pairwise_sq_dist_torch(P, Q, matmul_dtype)
+    else:
+        dist_fn = lambda P, Q: pairwise_dist_torch(P, Q, matmul_dtype)
+
+    if chunk_size is None or chunk_size >= n:
+        a = dist_fn(X, X)
+        b = dist_fn(Y, Y)
+        A = a - torch.mean(a, dim=0, keepdim=True) - torch.mean(a, dim=1, keepdim=True) + torch.mean(a)
+        B = b - torch.mean(b, dim=0, keepdim=True) - torch.mean(b, dim=1, keepdim=True) + torch.mean(b)
+        return torch.sum(A*B), torch.sum(A*A), torch.sum(B*B)
+
+    # distance matrices are symmetric: row means == column means
+    a_row = torch.cat([dist_fn(X[k:k + chunk_size], X).mean(dim=1) for k in range(0, n, chunk_size)])
+    b_row = torch.cat([dist_fn(Y[k:k + chunk_size], Y).mean(dim=1) for k in range(0, n, chunk_size)])
+    a_mean, b_mean = a_row.mean(), b_row.mean()
+    s_ab = s_aa = s_bb = 0
+    for k in range(0, n, chunk_size):
+        A = dist_fn(X[k:k + chunk_size], X) - a_row[k:k + chunk_size].unsqueeze(1) - a_row.unsqueeze(0) + a_mean
+        B = dist_fn(Y[k:k + chunk_size], Y) - b_row[k:k + chunk_size].unsqueeze(1) - b_row.unsqueeze(0) + b_mean
+        s_ab = s_ab + torch.sum(A*B)
+        s_aa = s_aa + torch.sum(A*A)
+        s_bb = s_bb + torch.sum(B*B)
+    return s_ab, s_aa, s_bb
 
-    def _distance_matrix(self, data):
-        n = data.size(0)
-        distance_matrix = torch.zeros((n, n))
 
-        for i in range(n):
-            for j in range(n):
-                row_diff = data[i] - data[j]
-                distance_matrix[i, j] = (row_diff ** 2).sum()
 
-        return distance_matrix
+class DistanceCorrelationLoss(torch.nn.modules.loss._Loss):
+    """
+    Distance correlation on squared pairwise distances (ttitcombe's NoPeek loss). Computed on the device
+    of the inputs; chunk_size / matmul_dtype are passed to centered_distance_sums.
+    """
+    def __init__(self, chunk_size=None, matmul_dtype=None):
+        super(DistanceCorrelationLoss, self).__init__()
+        self.chunk_size = chunk_size
+        self.matmul_dtype = matmul_dtype
+
+    def forward(self, input_data, intermediate_data):
+        n = input_data.size(0)
+        s_ab, s_aa, s_bb = centered_distance_sums(input_data, intermediate_data, squared=True,
+                                                  chunk_size=self.chunk_size, matmul_dtype=self.matmul_dtype)
+
+        # Get distance variances
+        input_dvar = s_aa.sqrt() / n
+        intermediate_dvar = s_bb.sqrt() / n
 
-def dist_corr_torch(X, Y):
+        # Get distance covariance
+        dcov = s_ab.sqrt() / n
 
+        # Put it together
+        dcorr = dcov / (input_dvar * intermediate_dvar).sqrt()
 
+        return dcorr
 
+    def _distance_matrix(self, data):
+        return pairwise_sq_dist_torch(data.view(data.size(0), -1))
+
+def dist_corr_torch(X, Y, chunk_size=None, matmul_dtype=None):
     n = float(X.size()[0])
-    sigma = torch.Tensor([1e-7]).to(X.device)
-    a = pairwise_dist_torch(X)
-    b = pairwise_dist_torch(Y)
-    # print(a, b)
-    A = a - torch.mean(a, axis=1) - torch.unsqueeze(torch.mean(a, axis=0), axis=1) + torch.mean(a)
-    B = b - torch.mean(b, axis=1) - torch.unsqueeze(torch.mean(b, axis=0), axis=1) + torch.mean(b)
-    # print(A,B)
-    dCovXY = torch.sqrt(sigma + torch.sum(A*B) / (n ** 2)) # Add sigma to avoid nan loss
-    dVarXX = torch.sqrt(sigma + torch.sum(A*A) / (n ** 2))
-    dVarYY = torch.sqrt(sigma + torch.sum(B*B) / (n ** 2))
+    sigma = 1e-7
+    s_ab, s_aa, s_bb = centered_distance_sums(X, Y, squared=False, chunk_size=chunk_size, matmul_dtype=matmul_dtype)
+    dCovXY = torch.sqrt(sigma + s_ab / (n ** 2)) # Add sigma to avoid nan loss
+    dVarXX = torch.sqrt(sigma + s_aa / (n ** 2))
+    dVarYY = torch.sqrt(sigma + s_bb / (n ** 2))
     dCorXY = dCovXY / (torch.sqrt(sigma + dVarXX * dVarYY) + sigma)  # Add sigma to avoid nan loss
     return dCorXY
 
@@ -699,6 +883,200 @@ class ImageTensorFolder(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.img_paths)
 
+import os
+import json
+import hashlib
+from torch.utils.data import TensorDataset, BatchSampler, SequentialSampler
+
+# ============================================================================
+# Contiguous (image, IR, label) store for decoder training
+# Written once by gen_ir as three memory-mapped .npy shards + index.json (valid row count and shapes),
+# instead of one .jpg + one .pt per sample. Images are kept as float32 in [0, 1] (no JPEG re-encoding).
+# ============================================================================
+IR_STORE_INDEX = "index.json"
+
+
+class IRStoreWriter(object):
+    """
+    Stream batches of (image, activation, label) into memory-mapped .npy shards.
+
+    The shards are allocated with `capacity` rows on the first append (shapes are taken from that batch);
+    index.json records how many rows are valid, so a filtered generation (all_label=False) can stop early.
+    """
+
+    def __init__(self, store_dir, capacity):
+        self.store_dir = os.path.abspath(store_dir)
+        self.capacity = capacity
+        self.count = 0
+        self.images = self.irs = self.labels = None
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def _open(self, name, first):
+        return np.lib.format.open_memmap(os.path.join(self.store_dir, name + ".npy"), mode="w+",
+                                         dtype=first.dtype, shape=(self.capacity,) + first.shape[1:])
+
+    def append(self, images, irs, labels):
+        images = images.detach().cpu().float().numpy()
+        irs = irs.detach().cpu().float().numpy()
+        labels = labels.detach().cpu().long().numpy()
+        if self.images is None:
+            self.images = self._open("images", images)
+            self.irs = self._open("activations", irs)
+            self.labels = self._open("labels", labels)
+        n = min(images.shape[0], self.capacity - self.count)
+        self.images[self.count:self.count + n] = images[:n]
+        self.irs[self.count:self.count + n] = irs[:n]
+        self.labels[self.count:self.count + n] = labels[:n]
+        self.count += n
+
+    def close(self):
+        if self.images is not None:
+            for arr in (self.images, self.irs, self.labels):
+                arr.flush()
+            index = {"count": self.count, "image_shape": list(self.images.shape[1:]),
+                     "ir_shape": list(self.irs.shape[1:])}
+        else:
+            index = {"count": 0, "image_shape": None, "ir_shape": None}
+        with open(os.path.join(self.store_dir, IR_STORE_INDEX), "w") as f:
+            json.dump(index, f)
+        self.images = self.irs = self.labels = None
+        return self.count
+
+
+def is_ir_store(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, IR_STORE_INDEX))
+
+
+def load_ir_store(store_dir, with_label=True, mmap=True):
+    """
+    Open an IR store as a TensorDataset (images, activations[, labels]).
+
+    With mmap=True the tensors are zero-copy views of the .npy files (copy-on-write mapping), so only the
+    rows a batch touches are read from disk.
+    """
+    with open(os.path.join(store_dir, IR_STORE_INDEX)) as f:
+        count = json.load(f)["count"]
+    mmap_mode = "c" if mmap else None
+    names = ["images", "activations", "labels"] if with_label else ["images", "activations"]
+    tensors = [torch.from_numpy(np.load(os.path.join(store_dir, name + ".npy"), mmap_mode=mmap_mode)[:count])
+               for name in names]
+    return TensorDataset(*tensors)
+
+
+def file_order(count):
+    """
+    Store rows in the order the old per-sample files "<file_id>.jpg / .pt" came out of sorted(glob(...))
+    (lexicographic: 0, 1, 10, 100, ..., 2, 20, ...), so the decoder train / validation split and the limited_num
+    selection pick the same samples as with the file folders.
+    """
+    return sorted(range(count), key=str)
+
+
+def select_limited_idx(labels, limited_num):
+    # same selection as ImageTensorFolder(limited_num=...): first limited_num // 10 samples of every label,
+    # in file order, until limited_num_10 samples are taken
+    limited_num_10 = (limited_num // 10) * 10
+    visited_label = {}
+    select_idx = []
+    for index, label in enumerate(labels.view(labels.size(0), -1)[:, 0].tolist()):
+        if len(select_idx) >= limited_num_10:
+            break
+        if visited_label.get(label, 0) < limited_num_10 // 10:
+            visited_label[label] = visited_label.get(label, 0) + 1
+            select_idx.append(index)
+    return select_idx
+
+
+def tensor_store_loader(dataset, batch_size, sampler=None):
+    # a whole batch is gathered with one fancy-indexing call per tensor (TensorDataset accepts index lists),
+    # no per-sample __getitem__ / collate and no worker processes copying the mapped tensors
+    if sampler is None:
+        sampler = SequentialSampler(dataset)
+    return torch.utils.data.DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False),
+                                       batch_size=None, num_workers=0)
+
+
+def model_state_hash(model):
+    """sha1 of a model's state_dict (names + raw bytes), identifies the checkpoint a feature cache was built from."""
+    h = hashlib.sha1()
+    for name, t in model.state_dict().items():
+        h.update(name.encode())
+        h.update(t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def loader_fingerprint(loader):
+    # identifies the dataset split behind a loader: dataset type/length, Subset indices and train flag
+    dataset = loader.dataset
+    h = hashlib.sha1("{}-{}".format(type(dataset).__name__, len(dataset)).encode())
+    indices = getattr(dataset, "indices", None)
+    if indices is not None:
+        h.update(np.asarray(indices, dtype=np.int64).tobytes())
+    h.update(str(getattr(getattr(dataset, "dataset", dataset), "train", None)).encode())
+    return h.hexdigest()[:12]
+
+
+class FeatureCache(object):
+    """
+    Clean (img, ir, target) triples of a frozen client model, computed once per key and replayed across
+    decoder epochs. Keys are (checkpoint hash, split, cut layer) tuples.
+
+    Entries are preallocated pinned host tensors, or memory-mapped IR stores under cache_dir (reused across
+    runs as long as the checkpoint hash matches). At most max_entries entries are kept in memory (LRU).
+    """
+
+    def __init__(self, cache_dir=None, pin_memory=True, max_entries=2):
+        self.cache_dir = cache_dir
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def _build_in_memory(self, loader, feat_fn):
+        capacity = len(loader.dataset)
+        buffers = None
+        count = 0
+        for input, target in loader:
+            img, ir = feat_fn(input)
+            batch = [img.detach().float(), ir.detach().float(), target.long()]
+            if buffers is None:
+                buffers = [torch.empty((capacity,) + t.shape[1:], dtype=t.dtype, pin_memory=self.pin_memory)
+                           for t in batch]
+            n = min(img.size(0), capacity - count)
+            for buf, t in zip(buffers, batch):
+                buf[count:count + n].copy_(t[:n])
+            count += n
+        return TensorDataset(*[buf[:count] for buf in buffers])
+
+    def get(self, key, loader, feat_fn):
+        """
+        Args:
+        - key (tuple): (checkpoint hash, split, cut layer)
+        - loader: DataLoader over (input, target), only iterated on a cache miss
+        - feat_fn: input batch -> (img, ir)
+
+        Returns:
+        - TensorDataset (img, ir, target) on the host
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir is not None:
+            store_dir = os.path.join(self.cache_dir, "_".join(str(k) for k in key))
+            if not is_ir_store(store_dir):
+                writer = IRStoreWriter(store_dir, len(loader.dataset))
+                for input, target in loader:
+                    img, ir = feat_fn(input)
+                    writer.append(img, ir, target)
+                writer.close()
+            dataset = load_ir_store(store_dir)
+        else:
+            dataset = self._build_in_memory(loader, feat_fn)
+        self.entries[key] = dataset
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return dataset
+
 from torch.utils.data import SubsetRandomSampler
 def apply_transform_test(batch_size, image_data_dir, tensor_data_dir, limited_num = None, shuffle_seed = 123, dataset = None):
     """
@@ -721,6 +1099,14 @@ def apply_transform_test(batch_size, image_data_dir, tensor_data_dir, limited_nu
     #     std = [0.5, 0.5, 0.5]
     #     mean = [0.5, 0.5, 0.5]
 
+    if isinstance(image_data_dir, TensorDataset) or is_ir_store(image_data_dir):
+        # in-RAM TensorDataset or IR store written by gen_ir: already float images in [0, 1] (mean 0, std 1)
+        dataset = image_data_dir if isinstance(image_data_dir, TensorDataset) else load_ir_store(image_data_dir)
+        order = file_order(len(dataset))
+        if limited_num is not None:
+            order = [order[i] for i in select_limited_idx(dataset.tensors[2][order], limited_num)]
+        return tensor_store_loader(dataset, batch_size, order)
+
     trainTransform = transforms.Compose([transforms.ToTensor(),
                                          transforms.Normalize(mean, std)
                                          ])
@@ -760,19 +1146,29 @@ def apply_transform(batch_size, image_data_dir, tensor_data_dir, shuffle_seed =
     #     mean = [0.5, 0.5, 0.5]
     
     train_split = 0.9
-    trainTransform = transforms.Compose([transforms.ToTensor(),
-                                         transforms.Normalize(mean, std)
-                                         ])
-    dataset = ImageTensorFolder(img_path=image_data_dir, tensor_path=tensor_data_dir,
-                                 img_fmt="jpg", tns_fmt="pt", transform=trainTransform)
+    store = isinstance(image_data_dir, TensorDataset) or is_ir_store(image_data_dir)
+    if store:
+        if isinstance(image_data_dir, TensorDataset):
+            dataset = TensorDataset(*image_data_dir.tensors[:2])
+        else:
+            dataset = load_ir_store(image_data_dir, with_label=False)
+    else:
+        trainTransform = transforms.Compose([transforms.ToTensor(),
+                                             transforms.Normalize(mean, std)
+                                             ])
+        dataset = ImageTensorFolder(img_path=image_data_dir, tensor_path=tensor_data_dir,
+                                     img_fmt="jpg", tns_fmt="pt", transform=trainTransform)
     dataset_size = len(dataset)
-    indices = list(range(dataset_size))
+    # store rows are in write order, the folder dataset is already in sorted file order
+    indices = file_order(dataset_size) if store else list(range(dataset_size))
     split = int(np.floor(train_split * dataset_size))
     # np.random.seed(shuffle_seed)
     # np.random.shuffle(indices)
     train_indices, test_indices = indices[:split], indices[split:]
     train_sampler = SubsetRandomSampler(train_indices)
     test_sampler = SubsetRandomSampler(test_indices)
+    if store:
+        return tensor_store_loader(dataset, batch_size, train_sampler), tensor_store_loader(dataset, batch_size, test_sampler)
 
     trainloader = torch.utils.data.DataLoader(dataset,
                                               batch_size=batch_size,
@@ -785,6 +1181,58 @@ def apply_transform(batch_size, image_data_dir, tensor_data_dir, shuffle_seed =
                                              sampler=test_sampler)
     return trainloader, testloader
 
+def test_distance_correlation(n=16, seed=0): # parity test: vectorised distance correlation vs. the original loops
+    torch.manual_seed(seed)
+    x = torch.randn(n, 3, 4, 4, dtype=torch.float64)
+    z = torch.tanh(x.view(n, -1)[:, :20] @ torch.randn(20, 12, dtype=torch.float64)) + 0.1 * torch.randn(n, 12, dtype=torch.float64)
+
+    def ref_distance_matrix(data): # original O(n^2) loop
+        distance_matrix = torch.zeros((n, n), dtype=data.dtype)
+        for i in range(n):
+            for j in range(n):
+                distance_matrix[i, j] = ((data[i] - data[j]) ** 2).sum()
+        return distance_matrix
+
+    def ref_A_matrix(data):
+        d = ref_distance_matrix(data.view(n, -1))
+        return d - d.mean(dim=0, keepdim=True) - d.mean(dim=1, keepdim=True) + d.mean()
+
+    A_x, A_z = ref_A_matrix(x), ref_A_matrix(z)
+    ref_dcorr = ((A_x * A_z).sum().sqrt() / n) / (((A_x ** 2).sum().sqrt() / n) * ((A_z ** 2).sum().sqrt() / n)).sqrt()
+
+    def ref_dist_corr_torch(X, Y): # original dist_corr_torch
+        def pdist(A):
+            r = torch.sum(A*A, axis = 1).view(-1, 1)
+            return torch.sqrt(torch.maximum(r - 2*torch.matmul(A, A.t()) + r.t(), torch.tensor(1e-7, dtype=A.dtype)))
+        a, b = pdist(X), pdist(Y)
+        A = a - torch.mean(a, axis=1) - torch.unsqueeze(torch.mean(a, axis=0), axis=1) + torch.mean(a)
+        B = b - torch.mean(b, axis=1) - torch.unsqueeze(torch.mean(b, axis=0), axis=1) + torch.mean(b)
+        dCovXY = torch.sqrt(1e-7 + torch.sum(A*B) / (n ** 2))
+        dVarXX = torch.sqrt(1e-7 + torch.sum(A*A) / (n ** 2))
+        dVarYY = torch.sqrt(1e-7 + torch.sum(B*B) / (n ** 2))
+        return dCovXY / (torch.sqrt(1e-7 + dVarXX * dVarYY) + 1e-7)
+
+    ref_dc = ref_dist_corr_torch(x.view(n, -1), z)
+    results = []
+    for chunk_size in [None, 5]:
+        results.append(torch.isclose(DistanceCorrelationLoss(chunk_size=chunk_size)(x, z), ref_dcorr))
+        results.append(torch.isclose(dist_corr(x, z), ref_dc) if chunk_size is None else
+                       torch.isclose(dist_corr_torch(x.view(n, -1), z, chunk_size=chunk_size), ref_dc))
+    return all(bool(r) for r in results)
+
+def test_class_feature_stats(num_class=4, seed=0): # streaming stats vs. torch.var, and logvar_metric after update()
+    torch.manual_seed(seed)
+    feats = torch.randn(200, 3, 2, 2, dtype=torch.float64)
+    labels = torch.randint(num_class, (200,))
+    stats = ClassFeatureStats(num_class, reservoir_size=50)
+    for start in range(0, 200, 32):
+        stats.update(feats[start:start + 32], labels[start:start + 32])
+    flat = feats.view(200, -1)
+    ref_var = torch.stack([flat[labels == c].var(dim=0, unbiased=False) for c in range(num_class)])
+    metric = stats.logvar_metric(var_threshold=0.1, reg_strength=1.0)
+    return torch.allclose(stats.variance(), ref_var) and isinstance(metric, float) and np.isfinite(metric) \
+        and len(stats.sample()[0]) == 50
+
 # if __name__ == "__main__":
 #     pred = torch.randn((4, 5))
 #     print(pred)